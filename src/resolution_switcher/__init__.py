@@ -4,31 +4,55 @@ from __future__ import annotations
 
 __version__ = "3.0.3"
 __all__ = [
+    "CommonMode",
+    "DeadlineException",
     "DisplayAdapter",
     "DisplayAdapterException",
     "DisplayMode",
     "DisplayMonitor",
     "DisplayMonitorException",
+    "DisplaySession",
     "HdrException",
+    "JournalException",
     "PrimaryMonitorException",
+    "RulesException",
+    "Snapshot",
+    "SnapshotException",
+    "SupersededException",
+    "common_display_modes",
     "get_all_display_monitors",
     "get_primary_monitor",
+    "load_rules",
+    "publish_snapshot",
+    "read_snapshot",
+    "resolve_display_mode",
     "set_display_mode_for_device",
     "set_hdr_state_for_monitor",
+    "set_hdr_state_for_monitors",
 ]
 
 from .custom_types import (
+    DeadlineException,
     DisplayAdapter,
     DisplayAdapterException,
     DisplayMode,
     DisplayMonitor,
     DisplayMonitorException,
     HdrException,
+    JournalException,
     PrimaryMonitorException,
+    RulesException,
+    SnapshotException,
+    SupersededException,
 )
 from .display_adapters import set_display_mode_for_device
 from .display_monitors import (
     get_all_display_monitors,
     get_primary_monitor,
     set_hdr_state_for_monitor,
+    set_hdr_state_for_monitors,
 )
+from .display_session import DisplaySession
+from .mode_filters import CommonMode, common_display_modes
+from .rules import load_rules, resolve_display_mode
+from .snapshot import Snapshot, publish_snapshot, read_snapshot
@@ -0,0 +1,283 @@
+"""Execution of NDJSON operation scripts against a single, shared DisplaySession."""
+
+from __future__ import annotations
+
+import json
+import math
+from time import perf_counter
+from typing import Callable, Iterable
+
+from resolution_switcher.custom_types import (
+    BatchException,
+    DisplayAdapterException,
+    DisplayMode,
+    DisplayMonitor,
+    DisplayMonitorException,
+    HdrException,
+    PrimaryMonitorException,
+    RulesException,
+    SupersededException,
+)
+from resolution_switcher.device_info_cache import device_info_cache
+from resolution_switcher.display_adapters import wait_for_display_mode
+from resolution_switcher.display_session import DisplaySession
+from resolution_switcher.rules import parse_display_mode
+
+OPERATIONS: set[str] = {"list", "refresh", "set_mode", "hdr", "verify"}
+
+# Errors that fail a single operation rather than the whole batch
+OPERATION_ERRORS = (
+    BatchException,
+    DisplayAdapterException,
+    DisplayMonitorException,
+    HdrException,
+    PrimaryMonitorException,
+    RulesException,
+    SupersededException,
+)
+
+
+class BatchOperation:
+    def __init__(self, line: int, operation: dict):
+        # Line of the script the operation was read from, starting at 1
+        self.line: int = line
+        self.operation: dict = operation
+        self.name: str = operation["op"]
+        self.start: float = perf_counter()
+
+    def result(self, ok: bool, **fields) -> dict:
+        result: dict = {
+            "line": self.line,
+            "op": self.name,
+            "ok": ok,
+            "elapsed_ms": round((perf_counter() - self.start) * 1000, 3),
+        }
+        result.update(fields)
+
+        return result
+
+
+def parse_operation(line: str) -> dict:
+    try:
+        operation = json.loads(line)
+    except ValueError as e:
+        raise BatchException(f"Invalid JSON: {e}")
+
+    if not isinstance(operation, dict) or operation.get("op") not in OPERATIONS:
+        raise BatchException(f"Expected an object with an 'op' of {', '.join(sorted(OPERATIONS))}")
+
+    return operation
+
+
+def monitor_to_dict(monitor: DisplayMonitor) -> dict:
+    active_mode: DisplayMode | None = monitor.active_mode()
+    hdr_supported: bool = monitor.is_hdr_supported()
+
+    return {
+        "id": monitor.identifier(),
+        "name": monitor.name,
+        "adapter": monitor.adapter.display_name,
+        "mode": str(active_mode) if active_mode is not None else None,
+        "primary": monitor.is_primary(),
+        "attached": monitor.is_attached(),
+        "hdr_supported": hdr_supported,
+        "hdr_enabled": monitor.is_hdr_enabled() if hdr_supported else False,
+    }
+
+
+def _operation_monitor(session: DisplaySession, operation: dict) -> DisplayMonitor:
+    identifier = operation.get("monitor")
+
+    if identifier is None:
+        return session.primary()
+
+    return session.find(str(identifier))
+
+
+def _operation_mode(operation: dict) -> DisplayMode:
+    mode = operation.get("mode")
+
+    if not isinstance(mode, str):
+        raise BatchException("Expected a 'mode' of <width>x<height>@<refresh>")
+
+    return parse_display_mode(mode)
+
+
+def _operation_seconds(operation: dict, field: str, default: float) -> float:
+    seconds = operation.get(field, default)
+
+    # bool is an int, but true is not a number of seconds
+    if (
+        isinstance(seconds, bool)
+        or not isinstance(seconds, (int, float))
+        or not math.isfinite(seconds)
+        or seconds < 0
+    ):
+        raise BatchException(f"Expected '{field}' to be a number of seconds of at least 0")
+
+    return float(seconds)
+
+
+def _run_operation(session: DisplaySession, operation: BatchOperation) -> dict:
+    if operation.name == "list":
+        return operation.result(True, monitors=[monitor_to_dict(m) for m in session.monitors])
+
+    if operation.name == "refresh":
+        return operation.result(
+            True, changed=session.refresh_if_changed(), cache=device_info_cache.stats()
+        )
+
+    monitor: DisplayMonitor = _operation_monitor(session, operation.operation)
+
+    if operation.name == "set_mode":
+        display_mode: DisplayMode = _operation_mode(operation.operation)
+        session.set_display_mode(monitor, display_mode, bool(operation.operation.get("temp")))
+
+        return operation.result(True, monitor=monitor.identifier(), mode=str(display_mode))
+
+    if operation.name == "hdr":
+        enabled = operation.operation.get("enabled")
+
+        if not isinstance(enabled, bool):
+            raise BatchException("Expected 'enabled' to be true or false")
+
+        if not monitor.is_hdr_supported():
+            raise HdrException(f"{monitor.identifier()} does not support HDR")
+
+        session.set_hdr_state(monitor, enabled)
+
+        return operation.result(True, monitor=monitor.identifier(), enabled=enabled)
+
+    display_mode: DisplayMode = _operation_mode(operation.operation)
+    settled: float = wait_for_display_mode(
+        display_mode,
+        monitor.identifier(),
+        _operation_seconds(operation.operation, "timeout", 5.0),
+        _operation_seconds(operation.operation, "interval", 0.05),
+    )
+
+    return operation.result(
+        True,
+        monitor=monitor.identifier(),
+        mode=str(display_mode),
+        settle_ms=round(settled * 1000, 3),
+    )
+
+
+def _is_stageable(operation: BatchOperation) -> bool:
+    # Staged changes are always written to the registry, so temporary ones are applied alone
+    return operation.name == "set_mode" and not operation.operation.get("temp")
+
+
+def _run_staged(session: DisplaySession, staged: list[BatchOperation]) -> list[dict]:
+    start: float = perf_counter()
+
+    for operation in staged:
+        operation.start = start
+
+    if len(staged) == 1:
+        try:
+            return [_run_operation(session, staged[0])]
+        except OPERATION_ERRORS as e:
+            return [staged[0].result(False, error=str(e))]
+
+    changes: list[tuple[DisplayMonitor, DisplayMode]] = []
+
+    try:
+        for operation in staged:
+            changes.append(
+                (
+                    _operation_monitor(session, operation.operation),
+                    _operation_mode(operation.operation),
+                )
+            )
+
+        session.set_display_modes(changes)
+    except OPERATION_ERRORS as e:
+        return [operation.result(False, error=str(e), batched=len(staged)) for operation in staged]
+
+    return [
+        operation.result(
+            True, monitor=monitor.identifier(), mode=str(display_mode), batched=len(staged)
+        )
+        for operation, (monitor, display_mode) in zip(staged, changes)
+    ]
+
+
+def run_batch(
+    lines: Iterable[str],
+    session: DisplaySession,
+    write: Callable[[dict], None],
+    continue_on_error: bool = False,
+) -> bool:
+    # Adjacent mode changes to different monitors are held back and applied with a single display
+    # reset once an operation of another kind, or another change to one of the monitors, comes in
+    staged: list[BatchOperation] = []
+    staged_monitors: set[str] = set()
+    failed: bool = False
+
+    def flush() -> bool:
+        results: list[dict] = _run_staged(session, staged) if len(staged) > 0 else []
+        staged.clear()
+        staged_monitors.clear()
+
+        for result in results:
+            write(result)
+
+        return all(result["ok"] for result in results)
+
+    for number, line in enumerate(lines, start=1):
+        if line.strip() == "":
+            continue
+
+        # The error of a line that is not an operation, and the monitor of a stageable change
+        error: str = ""
+        identifier: str = ""
+
+        try:
+            operation = BatchOperation(number, parse_operation(line))
+        except BatchException as e:
+            operation = None
+            error = str(e)
+
+        if operation is not None and _is_stageable(operation):
+            try:
+                # Checked before joining a group, so that malformed input fails on its own rather
+                # than failing the whole group when it is applied
+                _operation_mode(operation.operation)
+                identifier = _operation_monitor(session, operation.operation).identifier()
+            except OPERATION_ERRORS:
+                # Left to fail on its own below
+                identifier = ""
+
+            if identifier != "" and identifier not in staged_monitors:
+                staged.append(operation)
+                staged_monitors.add(identifier)
+                continue
+
+        if not flush():
+            failed = True
+
+            if not continue_on_error:
+                return False
+
+        if operation is None:
+            write({"line": number, "op": None, "ok": False, "elapsed_ms": 0, "error": error})
+            failed = True
+        elif _is_stageable(operation) and identifier != "":
+            staged.append(operation)
+            staged_monitors.add(identifier)
+            continue
+        else:
+            operation.start = perf_counter()
+
+            try:
+                write(_run_operation(session, operation))
+            except OPERATION_ERRORS as e:
+                write(operation.result(False, error=str(e)))
+                failed = True
+
+        if failed and not continue_on_error:
+            return False
+
+    return flush() and not failed
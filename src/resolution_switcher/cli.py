@@ -1,41 +1,264 @@
 from __future__ import annotations
 
-from argparse import ArgumentParser
-from sys import exit, stderr, stdout
+import atexit
+import json
+from argparse import SUPPRESS, ArgumentParser, ArgumentTypeError
+from copy import copy
+from shutil import get_terminal_size
+from sys import exit, stderr, stdin, stdout
+from time import perf_counter, sleep
 from typing import Iterable
 
 from termcolor import colored, cprint
 from termcolor._types import Attribute, Color
 
+from resolution_switcher.batch import run_batch
 from resolution_switcher.custom_types import (
+    DeadlineException,
     DisplayAdapterException,
+    DisplayMonitorException,
     HdrException,
+    JournalException,
     PrimaryMonitorException,
+    RulesException,
+    SnapshotException,
+    SunshineException,
+    SupersededException,
+)
+from resolution_switcher.deadlines import set_call_timeout, set_command_deadline
+from resolution_switcher.display_adapters import (
+    DisplayMode,
+    iter_display_modes,
+    set_display_mode_for_device,
+    set_display_modes_for_devices,
+    test_display_mode_for_device,
+    wait_for_display_device,
+    wait_for_display_mode,
+)
+from resolution_switcher.display_config import (
+    ENGINES,
+    set_display_modes_with_display_config,
+    validate_display_modes_with_display_config,
 )
-from resolution_switcher.display_adapters import DisplayMode, set_display_mode_for_device
 from resolution_switcher.display_monitors import (
+    HDR_SETTLE_SECONDS,
     DisplayMonitor,
     get_all_display_monitors,
     get_primary_monitor,
-    set_hdr_state_for_monitor,
+    set_hdr_state_for_monitors,
+)
+from resolution_switcher.display_session import DisplaySession
+from resolution_switcher.journal import (
+    CHECKPOINT,
+    HDR_CHANGE,
+    JOURNAL_FILE,
+    MODE_CHANGE,
+    JournalEntry,
+    append_entries,
+    plan_undo,
+    read_pending,
+    set_journal,
+    suspended_journal,
+)
+from resolution_switcher.metrics import write_textfile
+from resolution_switcher.mode_filters import (
+    SORT_KEYS,
+    CommonMode,
+    ModeFilter,
+    common_display_modes,
+    filter_display_modes,
+    group_display_modes,
+    parse_aspect_ratio,
+)
+from resolution_switcher.recording import start_recording, start_replaying
+from resolution_switcher.retry import RetryPolicy
+from resolution_switcher.rules import (
+    client_mode_from_environment,
+    load_rules,
+    parse_display_mode,
+    resolve_display_mode,
+)
+from resolution_switcher.snapshot import (
+    SNAPSHOT_FILE,
+    SNAPSHOT_MAX_AGE,
+    publish_snapshot,
+    read_snapshot,
+)
+from resolution_switcher.sunshine import (
+    STATE_FILE,
+    client_hdr_from_environment,
+    end_session,
+    start_session,
 )
 
 # Application metadata
 VERSION: str = "v3.0.3"
 NAME: str = "ResolutionSwitcher"
 
+# Exit status of an invocation whose change was dropped in favor of a newer, queued one
+EXIT_SUPERSEDED: int = 3
 
-def print_all_available_modes_for_monitor(monitor: DisplayMonitor):
-    number_of_columns: int = 3
+# Exit status of an invocation that gave up on a Win32 call after its deadline passed
+EXIT_DEADLINE: int = 4
 
-    print_message("[Available Modes]\n", "blue", attrs=["bold"])
 
-    if monitor.adapter.available_modes is not None:
-        for i in range(0, len(monitor.adapter.available_modes)):
-            print_message(f"{monitor.adapter.available_modes[i]}".ljust(25), end="")
+class VerifyOptions:
+    def __init__(self, timeout: float, interval: float):
+        self.timeout: float = timeout
+        self.interval: float = interval
 
-            if (i + 1) % number_of_columns == 0:
-                print_message("")
+
+def mode_table_rows(cells: list[str]) -> list[str]:
+    # Every column is as wide as the widest cell, and as many fit as the terminal is wide
+    if len(cells) == 0:
+        return []
+
+    width: int = max(len(cell) for cell in cells) + 2
+    number_of_columns: int = max(1, get_terminal_size().columns // width)
+
+    return [
+        "".join(cell.ljust(width) for cell in cells[i : i + number_of_columns]).rstrip()
+        for i in range(0, len(cells), number_of_columns)
+    ]
+
+
+def page_rows(rows: list[str], page_size: int | None, page: int | None) -> list[str] | None:
+    # Rows of the requested page, or None if there is no such page
+    if page is None:
+        return rows if page_size is None else rows[:page_size]
+
+    if page_size is None:
+        # Leaves room for the header and the page number
+        page_size = max(1, get_terminal_size().lines - 4)
+
+    number_of_pages: int = max(1, -(-len(rows) // page_size))
+
+    if page > number_of_pages:
+        print_error(f"Page {page} does not exist, there are {number_of_pages}")
+        return None
+
+    print_message(f"Page {page} of {number_of_pages}", is_error=True)
+
+    return rows[(page - 1) * page_size : page * page_size]
+
+
+def write_lines(lines: list[str]):
+    # A single write, as every one of them is slow on a Windows console
+    if len(lines) > 0:
+        stdout.write("\n".join(lines) + "\n")
+        stdout.flush()
+
+
+def print_all_available_modes_for_monitor(
+    monitor: DisplayMonitor, grouped: bool = False, page: int | None = None
+) -> bool:
+    modes: list[DisplayMode] = (
+        monitor.adapter.available_modes
+        if monitor.adapter.available_modes is not None
+        else list(iter_display_modes(monitor.identifier()))
+    )
+    rows: list[str] | None = page_rows(
+        [str(group) for group in group_display_modes(modes)]
+        if grouped
+        else mode_table_rows([str(mode) for mode in modes]),
+        None,
+        page,
+    )
+
+    if rows is None:
+        return False
+
+    write_lines([colored("[Available Modes]", "blue", attrs=["bold"]), "", *rows])
+
+    return True
+
+
+def print_filtered_modes_for_monitor(
+    monitor: DisplayMonitor, mode_filter: ModeFilter, grouped: bool = False, page: int | None = None
+) -> bool:
+    modes: Iterable[DisplayMode] = (
+        monitor.adapter.available_modes
+        if monitor.adapter.available_modes is not None
+        else iter_display_modes(monitor.identifier())
+    )
+
+    # Grouped and paged listings apply the limit to the lines, not the modes
+    limit: int | None = mode_filter.limit
+
+    if grouped or page is not None:
+        mode_filter = copy(mode_filter)
+        mode_filter.limit = None
+
+    matches: list[DisplayMode] = filter_display_modes(modes, mode_filter)
+    rows: list[str] | None = page_rows(
+        [str(group) for group in group_display_modes(matches, mode_filter.sort)]
+        if grouped
+        else [str(mode) for mode in matches],
+        limit,
+        page,
+    )
+
+    if rows is None:
+        return False
+
+    write_lines(rows)
+
+    return True
+
+
+def print_common_modes(
+    monitors: list[DisplayMonitor], mode_filter: ModeFilter, nearest: bool = False
+) -> bool:
+    # Modes already loaded are reused, the rest are streamed from the driver in a single pass
+    common: list[CommonMode] = common_display_modes(
+        (
+            m.adapter.available_modes
+            if m.adapter.available_modes is not None
+            else iter_display_modes(m.identifier())
+            for m in monitors
+        ),
+        nearest,
+        mode_filter,
+    )
+
+    if len(common) == 0:
+        print_error(
+            f"No modes are supported by all of {', '.join(m.identifier() for m in monitors)}"
+        )
+        return False
+
+    for mode in common:
+        print_message(str(mode))
+
+    return True
+
+
+def select_monitors(text: str, all_monitors: list[DisplayMonitor]) -> list[DisplayMonitor]:
+    # A comma separated list of identifiers, or "all"
+    if text.strip().lower() == "all":
+        return all_monitors
+
+    monitors: dict[str, DisplayMonitor] = {m.identifier(): m for m in all_monitors}
+    requested: list[str] = [i.strip() for i in text.split(",") if i.strip() != ""]
+    missing: list[str] = [i for i in requested if i not in monitors]
+
+    if len(missing) > 0:
+        raise DisplayMonitorException(f"Device {', '.join(missing)} not found")
+
+    return [monitors[i] for i in requested]
+
+
+def print_hdr_status(monitors: list[DisplayMonitor]):
+    # Only the color info of these monitors is looked up
+    for monitor in monitors:
+        if not monitor.is_hdr_supported():
+            print_message(f"{monitor.identifier()}: HDR not supported")
+            continue
+
+        print_message(
+            f"{monitor.identifier()}: HDR {'enabled' if monitor.is_hdr_enabled() else 'disabled'}, "
+            f"{monitor.bits_per_color_channel} bits per color channel"
+        )
 
 
 def print_monitor_info(monitor: DisplayMonitor):
@@ -56,12 +279,32 @@ def print_monitor_info(monitor: DisplayMonitor):
         print_message("HDR Enabled:".ljust(justification) + f"{monitor.is_hdr_enabled()}")
 
 
+def aspect_ratio(text: str) -> tuple[int, int]:
+    try:
+        return parse_aspect_ratio(text)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+
+
+def positive_count(text: str) -> int:
+    try:
+        count: int = int(text)
+    except ValueError:
+        raise ArgumentTypeError(f"'{text}' is not a number")
+
+    if count < 1:
+        raise ArgumentTypeError("The count must be at least 1")
+
+    return count
+
+
 def argument_parser() -> ArgumentParser:
     p = ArgumentParser(
         prog=NAME,
         description="Command line tool to change Windows display settings",
         usage=f"{NAME} --version | --monitors | --monitor <ID> | --width <width> --height <height> --refresh "
-        f"<refresh> | --hdr <true/false>",
+        f"<refresh> | --rules <file> --client <W>x<H>@<Hz> | --rules <file> --from-env | --hdr <true/false> "
+        f"| --batch <file|-> | --undo [<count>] | --recover | sunshine-do | sunshine-undo",
     )
 
     version_group = p.add_argument_group()
@@ -74,6 +317,75 @@ def argument_parser() -> ArgumentParser:
         type=str,
         help="List all available modes for a monitor (e.g. \\\\.\\DISPLAY1)",
     )
+    monitor_group.add_argument(
+        "--common-modes",
+        type=str,
+        metavar="<ID,...|all>",
+        help="List the modes supported by every one of a comma separated list of monitors",
+    )
+    monitor_group.add_argument(
+        "--read-snapshot",
+        action="store_true",
+        help="List all active monitors from the published snapshot, enumerating them if it is stale",
+    )
+
+    wait_group = p.add_argument_group()
+    wait_group.add_argument(
+        "--wait-for-monitor",
+        type=str,
+        metavar="<ID>",
+        help="Wait for a monitor to be attached before doing anything else (e.g. \\\\.\\DISPLAY9)",
+    )
+    wait_group.add_argument(
+        "--timeout",
+        type=float,
+        default=10.0,
+        metavar="<seconds>",
+        help="How long to wait for the monitor to be attached (default 10)",
+    )
+
+    modes_group = p.add_argument_group()
+    modes_group.add_argument(
+        "--modes",
+        action="store_true",
+        help="List only the modes of the monitor that match the filters below, one per line",
+    )
+    modes_group.add_argument(
+        "--min-refresh", type=int, metavar="<Hz>", help="Lowest refresh rate to list"
+    )
+    modes_group.add_argument(
+        "--max-refresh", type=int, metavar="<Hz>", help="Highest refresh rate to list"
+    )
+    modes_group.add_argument(
+        "--aspect", type=aspect_ratio, metavar="<W>:<H>", help="Aspect ratio (e.g. 16:9)"
+    )
+    modes_group.add_argument("--min-width", type=int, metavar="<width>", help="Smallest width")
+    modes_group.add_argument("--exact-width", type=int, metavar="<width>", help="Exact width")
+    modes_group.add_argument(
+        "--sort",
+        choices=sorted(SORT_KEYS),
+        help="List modes from the highest resolution or refresh rate down",
+    )
+    modes_group.add_argument(
+        "--limit", type=positive_count, metavar="<count>", help="List at most this many"
+    )
+    modes_group.add_argument(
+        "--grouped",
+        action="store_true",
+        help="List each resolution once, with all of its refresh rates",
+    )
+    modes_group.add_argument(
+        "--page",
+        type=positive_count,
+        metavar="<n>",
+        help="List only page <n>, of --limit lines each or as many as fit in the terminal",
+    )
+    modes_group.add_argument(
+        "--nearest",
+        action="store_true",
+        help="With --common-modes, also list shared resolutions with each monitor's closest refresh "
+        "rate",
+    )
 
     mode_change_group = p.add_argument_group()
     mode_change_group.add_argument(
@@ -93,12 +405,276 @@ def argument_parser() -> ArgumentParser:
         help="Make resolution change temporary (do not persist to registry)",
     )
 
+    mode_change_group.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="legacy",
+        help="Apply the change per device (legacy) or to the whole topology at once (displayconfig)",
+    )
+    mode_change_group.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only check whether the display mode can be applied",
+    )
+    mode_change_group.add_argument(
+        "--verify",
+        action="store_true",
+        help="Wait until the new mode is active and report how long it took to settle",
+    )
+    mode_change_group.add_argument(
+        "--verify-timeout",
+        type=float,
+        default=5.0,
+        metavar="<seconds>",
+        help="How long to wait for the new mode to become active (default 5)",
+    )
+    mode_change_group.add_argument(
+        "--verify-interval",
+        type=int,
+        default=50,
+        metavar="<ms>",
+        help="How often to check whether the new mode is active (default 50)",
+    )
+
+    rules_group = p.add_argument_group()
+    rules_group.add_argument(
+        "--rules",
+        type=str,
+        metavar="<file>",
+        help="Rules file mapping client modes to display modes",
+    )
+    rules_group.add_argument(
+        "--client",
+        type=str,
+        metavar="<W>x<H>@<Hz>",
+        help="The mode requested by the streaming client (e.g. 1280x800@90)",
+    )
+    rules_group.add_argument(
+        "--from-env",
+        action="store_true",
+        help="Read the client mode from the SUNSHINE_CLIENT_* environment variables",
+    )
+    rules_group.add_argument(
+        "--rules-cache",
+        type=str,
+        metavar="<file>",
+        help="Where to memoize resolved rules (defaults to <rules file>.cache.json)",
+    )
+
+    retry_group = p.add_argument_group()
+    retry_group.add_argument(
+        "--retries",
+        type=int,
+        default=1,
+        metavar="<attempts>",
+        help="Attempts to make when Windows reports a transient failure (default 1)",
+    )
+    retry_group.add_argument(
+        "--retry-delay",
+        type=int,
+        default=100,
+        metavar="<ms>",
+        help="Delay before the first retry, doubled for every further one (default 100)",
+    )
+    retry_group.add_argument(
+        "--retry-jitter",
+        type=float,
+        default=0.2,
+        metavar="<fraction>",
+        help="Fraction of every retry delay that is randomized (default 0.2)",
+    )
+    retry_group.add_argument(
+        "--retry-deadline",
+        type=float,
+        default=10.0,
+        metavar="<seconds>",
+        help="Time after which no further retry is attempted (default 10)",
+    )
+
+    deadline_group = p.add_argument_group()
+    deadline_group.add_argument(
+        "--call-timeout",
+        type=float,
+        metavar="<seconds>",
+        help="Give up on a mode or HDR change call that has not returned after this long",
+    )
+    deadline_group.add_argument(
+        "--deadline",
+        type=float,
+        metavar="<seconds>",
+        help="Give up on any Win32 call still running this long after the command started",
+    )
+
+    metrics_group = p.add_argument_group()
+    metrics_group.add_argument(
+        "--metrics-file",
+        type=str,
+        metavar="<file>",
+        help="Add switch latency and failure metrics to a Prometheus textfile (e.g. switcher.prom)",
+    )
+
+    recording_group = p.add_argument_group()
+    recording_group.add_argument(
+        "--record",
+        type=str,
+        metavar="<file>",
+        help="Record every Win32 call, with its results and timings, to a file",
+    )
+    recording_group.add_argument(
+        "--replay",
+        type=str,
+        metavar="<file>",
+        help="Serve Win32 calls from a recording instead of the system (works on any platform)",
+    )
+    recording_group.add_argument(
+        "--replay-timing",
+        action="store_true",
+        help="Make replayed calls take as long as the recorded ones did",
+    )
+
+    snapshot_group = p.add_argument_group()
+    snapshot_group.add_argument(
+        "--publish-snapshot",
+        action="store_true",
+        help="Publish the monitors to the snapshot once the command is done",
+    )
+    snapshot_group.add_argument(
+        "--serve-snapshot",
+        type=float,
+        metavar="<seconds>",
+        help="Keep publishing the monitors to the snapshot at this interval",
+    )
+    snapshot_group.add_argument(
+        "--snapshot-file",
+        type=str,
+        default=SNAPSHOT_FILE,
+        metavar="<file>",
+        help=f"Where the snapshot is published (default {SNAPSHOT_FILE})",
+    )
+    snapshot_group.add_argument(
+        "--snapshot-max-age",
+        type=float,
+        default=SNAPSHOT_MAX_AGE,
+        metavar="<seconds>",
+        help=f"Age after which a snapshot is stale (default {SNAPSHOT_MAX_AGE:g})",
+    )
+
+    batch_group = p.add_argument_group()
+    batch_group.add_argument(
+        "--batch",
+        type=str,
+        metavar="<file|->",
+        help="Run the NDJSON operations of a script file, or of stdin with -, and print their results",
+    )
+    batch_group.add_argument(
+        "--continue-on-error",
+        action="store_true",
+        help="Keep running the batch after an operation fails",
+    )
+
+    journal_group = p.add_argument_group()
+    journal_group.add_argument(
+        "--journal",
+        type=str,
+        nargs="?",
+        const=JOURNAL_FILE,
+        metavar="<file>",
+        help=f"Record every mode and HDR change in a journal, so that it can be undone (default "
+        f"{JOURNAL_FILE})",
+    )
+    undo_group = journal_group.add_mutually_exclusive_group()
+    undo_group.add_argument(
+        "--undo",
+        type=positive_count,
+        nargs="?",
+        const=1,
+        metavar="<count>",
+        help="Undo the last change recorded in the journal, or the last <count> changes",
+    )
+    undo_group.add_argument(
+        "--recover",
+        action="store_true",
+        help="Undo every change recorded in the journal since it was last recovered",
+    )
+
     hdr_group = p.add_argument_group()
     hdr_group.add_argument(
         "--hdr",
         type=str,
         metavar="<true|false>",
-        help="Enable/Disable HDR on the monitor",
+        help="Enable/Disable HDR on the monitor, on a comma separated list of monitors given with "
+        "--monitor, or on every monitor that supports it with --monitor all",
+    )
+    hdr_group.add_argument(
+        "--hdr-status",
+        action="store_true",
+        help="Show the HDR state of the monitor, or of the comma separated list of monitors given "
+        "with --monitor (or all)",
+    )
+    hdr_group.add_argument(
+        "--hdr-settle",
+        type=float,
+        default=HDR_SETTLE_SECONDS,
+        metavar="<seconds>",
+        help=f"How long to let displays settle after changing HDR (default {HDR_SETTLE_SECONDS:g})",
+    )
+
+    # Options shared with the main parser are suppressed unless given after the subcommand, so
+    # they do not overwrite the ones given before it
+    sunshine_parsers = p.add_subparsers(dest="command", metavar="<command>")
+    sunshine_do = sunshine_parsers.add_parser(
+        "sunshine-do",
+        prog=f"{NAME} sunshine-do",
+        help="Apply the SUNSHINE_CLIENT_* mode and HDR state, saving what they replace",
+    )
+    sunshine_undo = sunshine_parsers.add_parser(
+        "sunshine-undo",
+        prog=f"{NAME} sunshine-undo",
+        help="Restore what sunshine-do changed",
+    )
+
+    for sunshine_parser in (sunshine_do, sunshine_undo):
+        sunshine_parser.add_argument(
+            "--state-file",
+            type=str,
+            default=STATE_FILE,
+            metavar="<file>",
+            help=f"Where sunshine-do saves the settings it replaces (default {STATE_FILE})",
+        )
+        sunshine_parser.add_argument(
+            "--hdr-settle",
+            type=float,
+            default=SUPPRESS,
+            metavar="<seconds>",
+            help="How long to let the display settle after changing HDR",
+        )
+
+    sunshine_do.add_argument(
+        "--monitor",
+        type=str,
+        default=SUPPRESS,
+        metavar="<ID>",
+        help="The monitor to change (defaults to the primary monitor)",
+    )
+    sunshine_do.add_argument(
+        "--rules",
+        type=str,
+        default=SUPPRESS,
+        metavar="<file>",
+        help="Rules file mapping the client mode to a display mode",
+    )
+    sunshine_do.add_argument(
+        "--rules-cache",
+        type=str,
+        default=SUPPRESS,
+        metavar="<file>",
+        help="Where to memoize resolved rules (defaults to <rules file>.cache.json)",
+    )
+    sunshine_do.add_argument(
+        "--temp",
+        action="store_true",
+        default=SUPPRESS,
+        help="Change the mode temporarily, without persisting it",
     )
 
     return p
@@ -112,78 +688,696 @@ def print_message(
     is_error: bool = False,
 ):
     file = stderr if is_error else stdout
-    colored_message = colored(message, color, attrs=attrs)
-    cprint(colored_message, color, attrs=attrs, end=end, file=file)
+    cprint(message, color, attrs=attrs, end=end, file=file)
 
 
 def print_success(message: str):
-    colored_message = colored(message, "green")
-    cprint(colored_message)
+    cprint(message, "green")
 
 
 def print_error(error: str):
     print_message("Error: " + error, "red", attrs=["bold"])
 
 
+def print_retry_records(retry_policy: RetryPolicy | None):
+    if retry_policy is None:
+        return
+
+    for record in retry_policy.records:
+        print_message(str(record), "yellow" if record.attempts > 1 else None)
+
+    retry_policy.records.clear()
+
+
 def change_resolution(
-    monitor_identifier: str, width: int, height: int, refresh: int, temp: bool = False
+    monitor_identifier: str,
+    width: int,
+    height: int,
+    refresh: int,
+    temp: bool = False,
+    retry_policy: RetryPolicy | None = None,
+    verify: VerifyOptions | None = None,
+    engine: str = "legacy",
+    dry_run: bool = False,
 ):
     display_mode: DisplayMode = DisplayMode(width, height, refresh)
+
+    if dry_run:
+        print_message(f"Checking whether {monitor_identifier} supports {str(display_mode)}")
+
+        try:
+            if engine == "displayconfig":
+                validate_display_modes_with_display_config(
+                    [(display_mode, monitor_identifier)], retry_policy
+                )
+            else:
+                test_display_mode_for_device(display_mode, monitor_identifier, retry_policy)
+        finally:
+            print_retry_records(retry_policy)
+
+        print_success("Display mode can be applied")
+        return
+
     print_message(f"Attempting to change {monitor_identifier} settings to {str(display_mode)}")
-    set_display_mode_for_device(display_mode, monitor_identifier, temp)
+
+    start: float = perf_counter()
+
+    try:
+        if engine == "displayconfig":
+            set_display_modes_with_display_config(
+                [(display_mode, monitor_identifier)], temp, retry_policy
+            )
+        else:
+            set_display_mode_for_device(display_mode, monitor_identifier, temp, retry_policy)
+    finally:
+        print_retry_records(retry_policy)
+
+    applied: float = perf_counter() - start
+
     print_success("Display settings changed successfully")
 
+    if verify is not None:
+        wait_for_display_mode(display_mode, monitor_identifier, verify.timeout, verify.interval)
+        settled: float = perf_counter() - start
+
+        print_success(
+            f"Display mode settled {settled * 1000:.0f} ms after the change was requested "
+            f"(apply {applied * 1000:.0f} ms, settle {(settled - applied) * 1000:.0f} ms)"
+        )
+
 
-def change_hdr(monitor_identifier: str, hdr: str, all_monitors: list[DisplayMonitor]):
+def change_hdr(
+    monitor_identifiers: list[str] | None,
+    hdr: str,
+    all_monitors: list[DisplayMonitor],
+    settle_seconds: float = HDR_SETTLE_SECONDS,
+) -> bool:
     hdr_state = True if hdr.lower() == "true" else False
 
+    # Without identifiers, every monitor that supports HDR is changed
+    if monitor_identifiers is None:
+        monitor_identifiers = [m.identifier() for m in all_monitors if m.is_hdr_supported()]
+
+        if len(monitor_identifiers) == 0:
+            raise HdrException("None of the monitors support HDR")
+
+    monitors: dict[str, DisplayMonitor] = {m.identifier(): m for m in all_monitors}
+    outcomes: dict[str, str | None] = {}
+    targets: list[DisplayMonitor] = []
+
+    for identifier in monitor_identifiers:
+        if identifier not in monitors:
+            outcomes[identifier] = f"Device {identifier} not found"
+        elif not monitors[identifier].is_hdr_supported():
+            outcomes[identifier] = f"{identifier} does not support HDR"
+        else:
+            targets.append(monitors[identifier])
+
+    if len(targets) > 0:
+        print_message(
+            f"Attempting to {'enable' if hdr_state else 'disable'} HDR on "
+            f"{', '.join(m.identifier() for m in targets)}"
+        )
+
+        errors = set_hdr_state_for_monitors(hdr_state, targets, settle_seconds)
+
+        for monitor, error in zip(targets, errors):
+            outcomes[monitor.identifier()] = None if error is None else str(error)
+
+    for identifier in monitor_identifiers:
+        outcome: str | None = outcomes[identifier]
+
+        if outcome is None:
+            print_success(
+                f"HDR {'enabled' if hdr_state else 'disabled'} successfully on {identifier}"
+            )
+        else:
+            print_error(outcome)
+
+    return all(outcome is None for outcome in outcomes.values())
+
+
+def change_resolution_from_rules(
+    monitor_identifier: str,
+    rules_path: str,
+    client: str | None,
+    cache_path: str | None,
+    all_monitors: list[DisplayMonitor],
+    temp: bool = False,
+    retry_policy: RetryPolicy | None = None,
+    verify: VerifyOptions | None = None,
+    engine: str = "legacy",
+    dry_run: bool = False,
+):
+    client_mode: DisplayMode = (
+        client_mode_from_environment() if client is None else parse_display_mode(client)
+    )
+
     for monitor in all_monitors:
         if monitor.adapter.identifier == monitor_identifier:
-            if not monitor.is_hdr_supported():
-                print_success(f"{monitor.adapter.identifier} does not support HDR")
-                print_success("Exiting...")
-                exit(-1)
+            decision = resolve_display_mode(
+                load_rules(rules_path),
+                monitor,
+                client_mode,
+                all_monitors,
+                cache_path if cache_path is not None else f"{rules_path}.cache.json",
+            )
 
             print_message(
-                f"Attempting to {'enable' if hdr_state else 'disable'} HDR on {monitor_identifier}"
+                f"Rule '{decision.rule_name}' matched client mode {client_mode} with candidate "
+                f"{decision.candidate_index + 1} ({decision.mode}) in "
+                f"{decision.elapsed * 1000:.2f} ms{' (cached)' if decision.cached else ''}"
+            )
+            change_resolution(
+                monitor_identifier,
+                decision.mode.width,
+                decision.mode.height,
+                decision.mode.refresh,
+                temp,
+                retry_policy,
+                verify,
+                engine,
+                dry_run,
             )
-            set_hdr_state_for_monitor(hdr_state, monitor)
-            print_success(f"HDR {'enabled' if hdr_state else 'disabled'} successfully")
+            return
+
+    raise RulesException(f"Device {monitor_identifier} not found")
+
+
+def write_metrics(path: str):
+    try:
+        write_textfile(path)
+    except OSError as e:
+        print_error(f"Failed to write metrics to {path} with error {e}")
+
+
+def write_batch_result(result: dict):
+    stdout.write(json.dumps(result) + "\n")
+    stdout.flush()
+
+
+def run_batch_script(path: str, continue_on_error: bool, retry_policy: RetryPolicy | None) -> bool:
+    session = DisplaySession(retry_policy)
+
+    if path == "-":
+        return run_batch(stdin, session, write_batch_result, continue_on_error)
+
+    with open(path, encoding="utf-8") as script:
+        return run_batch(script, session, write_batch_result, continue_on_error)
+
+
+def _describe_hdr(enabled: bool) -> str:
+    return "on" if enabled else "off"
+
+
+def sunshine_do(
+    monitor_identifier: str | None,
+    rules_path: str | None,
+    cache_path: str | None,
+    all_monitors: list[DisplayMonitor],
+    state_path: str,
+    temp: bool = False,
+    retry_policy: RetryPolicy | None = None,
+    settle_seconds: float = HDR_SETTLE_SECONDS,
+):
+    client_mode: DisplayMode = client_mode_from_environment()
+    client_hdr: bool | None = client_hdr_from_environment()
+
+    if monitor_identifier is None:
+        monitor_identifier = get_primary_monitor(all_monitors).identifier()
+
+    monitor: DisplayMonitor | None = next(
+        (m for m in all_monitors if m.identifier() == monitor_identifier), None
+    )
+
+    if monitor is None:
+        raise DisplayMonitorException(f"Device {monitor_identifier} not found")
+
+    display_mode: DisplayMode = client_mode
+
+    if rules_path is not None:
+        decision = resolve_display_mode(
+            load_rules(rules_path),
+            monitor,
+            client_mode,
+            all_monitors,
+            cache_path if cache_path is not None else f"{rules_path}.cache.json",
+        )
+        display_mode = decision.mode
+
+        print_message(
+            f"Rule '{decision.rule_name}' matched client mode {client_mode} with candidate "
+            f"{decision.candidate_index + 1} ({decision.mode})"
+        )
+
+    if client_hdr is not None and not monitor.is_hdr_supported():
+        print_message(f"{monitor_identifier} does not support HDR, leaving it unchanged", "yellow")
+
+    state = start_session(
+        monitor, display_mode, client_hdr, state_path, temp, retry_policy, settle_seconds
+    )
+
+    print_success(
+        f"{monitor_identifier} set to {display_mode}"
+        + (f", HDR {_describe_hdr(client_hdr)}" if client_hdr is not None else "")
+    )
+
+    if state.mode is not None or state.hdr is not None:
+        saved: list[str] = [str(state.mode)] if state.mode is not None else []
+
+        if state.hdr is not None:
+            saved.append(f"HDR {_describe_hdr(state.hdr)}")
+
+        print_message(f"Saved previous {', '.join(saved)} to {state_path}")
+
+
+def sunshine_undo(
+    all_monitors: list[DisplayMonitor],
+    state_path: str,
+    retry_policy: RetryPolicy | None = None,
+    settle_seconds: float = HDR_SETTLE_SECONDS,
+):
+    state = end_session(all_monitors, state_path, retry_policy, settle_seconds)
+
+    if state is None:
+        print_message("Nothing to restore, sunshine-do made no changes")
+        return
+
+    restored: list[str] = [str(state.mode)] if state.mode is not None else []
+
+    if state.hdr is not None:
+        restored.append(f"HDR {_describe_hdr(state.hdr)}")
+
+    if len(restored) == 0:
+        print_success(f"{state.monitor} was left unchanged, nothing to restore")
+    else:
+        print_success(f"{state.monitor} restored to {', '.join(restored)}")
+
+
+def run_sunshine_command(args, retry_policy: RetryPolicy | None):
+    rules_path: str | None = getattr(args, "rules", None)
+
+    try:
+        # Rules only list the monitor's modes when their decision is not cached
+        all_monitors: list[DisplayMonitor] = get_all_display_monitors(retry_policy, False)
+    finally:
+        print_retry_records(retry_policy)
+
+    if len(all_monitors) == 0:
+        print_error("No monitors found")
+        exit(-1)
+
+    try:
+        if args.command == "sunshine-do":
+            sunshine_do(
+                getattr(args, "monitor", None),
+                rules_path,
+                getattr(args, "rules_cache", None),
+                all_monitors,
+                args.state_file,
+                getattr(args, "temp", False),
+                retry_policy,
+                args.hdr_settle,
+            )
+        else:
+            sunshine_undo(all_monitors, args.state_file, retry_policy, args.hdr_settle)
+
+    except (
+        DisplayAdapterException,
+        DisplayMonitorException,
+        HdrException,
+        PrimaryMonitorException,
+        RulesException,
+        SunshineException,
+    ) as e:
+        print_error(str(e))
+        exit(-1)
+
+    except OSError as e:
+        print_error(f"Failed to save Sunshine state to {args.state_file} with error {e}")
+        exit(-1)
+
+    except SupersededException as e:
+        print_superseded(e)
+        exit(EXIT_SUPERSEDED)
+
+    exit(0)
+
+
+def publish_current_snapshot(path: str, retry_policy: RetryPolicy | None) -> bool:
+    # Enumerated again, as the monitors seen at the start are outdated by any change made since
+    try:
+        publish_snapshot(get_all_display_monitors(retry_policy, False), path)
+        return True
+    except (
+        DeadlineException,
+        DisplayAdapterException,
+        DisplayMonitorException,
+        SnapshotException,
+        OSError,
+    ) as e:
+        print_error(f"Failed to publish snapshot to {path} with error {e}")
+        return False
+
+
+def serve_snapshot(path: str, interval: float, retry_policy: RetryPolicy | None):
+    print_message(f"Publishing monitors to {path} every {interval:g} s")
+
+    try:
+        while True:
+            publish_current_snapshot(path, retry_policy)
+            sleep(interval)
+    except KeyboardInterrupt:
+        exit(0)
+
+
+def print_snapshot(path: str, max_age: float) -> bool:
+    snapshot = read_snapshot(path, max_age)
+
+    if snapshot is None:
+        return False
+
+    print_message(
+        f"Monitors found: {len(snapshot.monitors)} (snapshot from {snapshot.age():.1f} s ago)\n"
+    )
+
+    for monitor in snapshot.monitors:
+        print_monitor_info(monitor)
+        print_message("")
+
+    return True
+
+
+def undo_changes(
+    path: str,
+    count: int | None,
+    all_monitors: list[DisplayMonitor],
+    retry_policy: RetryPolicy | None = None,
+    settle_seconds: float = HDR_SETTLE_SECONDS,
+) -> bool:
+    # Without a count, every change made since the journal was last recovered is undone
+    entries: list[JournalEntry] = read_pending(path, count)
+
+    if len(entries) == 0:
+        print_message(f"Nothing to undo in {path}")
+        return True
+
+    for entry in entries:
+        print_message(f"Undoing change {entry.sequence}: {entry}")
+
+    mode_changes, hdr_changes = plan_undo(entries)
+    monitors: dict[str, DisplayMonitor] = {m.identifier(): m for m in all_monitors}
+    # Monitor and kind of every change that could not be undone
+    failed: set[tuple[str, int]] = set()
+
+    with suspended_journal():
+        # HDR is put back before the modes, the reverse of the order sunshine-do changes them in
+        for enabled, identifiers in hdr_changes.items():
+            targets: list[DisplayMonitor] = []
+
+            for identifier in identifiers:
+                if identifier not in monitors:
+                    print_error(f"Device {identifier} not found")
+                    failed.add((identifier, HDR_CHANGE))
+                elif monitors[identifier].is_hdr_enabled() != enabled:
+                    targets.append(monitors[identifier])
+
+            if len(targets) == 0:
+                continue
+
+            errors = set_hdr_state_for_monitors(enabled, targets, settle_seconds)
+
+            for monitor, error in zip(targets, errors):
+                if error is not None:
+                    print_error(str(error))
+                    failed.add((monitor.identifier(), HDR_CHANGE))
+
+        # Every mode is applied at once, so the displays only reset once
+        staged: list[tuple[DisplayMode, str]] = [
+            (display_mode, identifier)
+            for display_mode, identifier in mode_changes
+            if identifier not in monitors or monitors[identifier].active_mode() != display_mode
+        ]
+
+        if len(staged) > 0:
+            try:
+                set_display_modes_for_devices(staged, retry_policy)
+            except DisplayAdapterException as e:
+                print_error(str(e))
+                failed.update((identifier, MODE_CHANGE) for _, identifier in staged)
+            finally:
+                print_retry_records(retry_policy)
+
+    records: list[JournalEntry] = [
+        entry.revert()
+        for entry in entries
+        if (entry.monitor, entry.flags & (MODE_CHANGE | HDR_CHANGE)) not in failed
+    ]
+
+    # Once everything is undone, later recoveries stop reading the journal here
+    if count is None and len(failed) == 0:
+        records.append(JournalEntry(CHECKPOINT))
+
+    append_entries(records, path)
+
+    if len(failed) > 0:
+        return False
+
+    print_success(f"Undid {len(entries)} change{'s' if len(entries) > 1 else ''}")
+    return True
+
+
+def print_superseded(error: SupersededException):
+    print_message(f"{error}, exiting without changes", "yellow")
 
 
 def main():
     """Main entry point for the CLI application."""
+    try:
+        run()
+    except DeadlineException as e:
+        # The call that timed out is left behind on its worker thread, which does not keep the
+        # process from exiting
+        print_error(str(e))
+        exit(EXIT_DEADLINE)
+    except JournalException as e:
+        print_error(str(e))
+        exit(-1)
+
+
+def run():
     parser = argument_parser()
     args = parser.parse_args()
 
-    all_monitors: list[DisplayMonitor] = get_all_display_monitors()
+    if args.record is not None and args.replay is not None:
+        print_error("Calls cannot be recorded and replayed at the same time")
+        exit(-1)
+
+    try:
+        if args.record is not None:
+            atexit.register(start_recording(args.record).close)
+
+        if args.replay is not None:
+            start_replaying(args.replay, args.replay_timing)
+    except (OSError, ValueError) as e:
+        print_error(f"Failed to open recording with error {e}")
+        exit(-1)
+
+    if args.metrics_file is not None:
+        # Metrics are written however the command exits, including on failure
+        atexit.register(write_metrics, args.metrics_file)
+
+    set_command_deadline(args.deadline)
+    set_call_timeout(args.call_timeout)
+    set_journal(args.journal)
+
+    if args.wait_for_monitor is not None:
+        try:
+            waited: float = wait_for_display_device(args.wait_for_monitor, args.timeout)
+        except DisplayAdapterException as e:
+            print_error(str(e))
+            exit(-1)
+
+        # Batch results are the only thing written to stdout
+        print_message(
+            f"{args.wait_for_monitor} attached after {waited * 1000:.0f} ms",
+            is_error=args.batch is not None,
+        )
+
+    retry_policy: RetryPolicy | None = None
+
+    if args.retries > 1:
+        retry_policy = RetryPolicy(
+            max_attempts=args.retries,
+            base_delay=args.retry_delay / 1000,
+            jitter=args.retry_jitter,
+            deadline=args.retry_deadline,
+        )
+
+    if args.read_snapshot:
+        if print_snapshot(args.snapshot_file, args.snapshot_max_age):
+            exit(0)
+
+        print_message(
+            "Snapshot is missing or stale, enumerating the monitors", "yellow", is_error=True
+        )
+
+    if args.serve_snapshot is not None:
+        serve_snapshot(args.snapshot_file, args.serve_snapshot, retry_policy)
+
+    if args.publish_snapshot:
+        atexit.register(publish_current_snapshot, args.snapshot_file, retry_policy)
+
+    if args.batch is not None:
+        try:
+            exit(0 if run_batch_script(args.batch, args.continue_on_error, retry_policy) else -1)
+        except OSError as e:
+            print_error(f"Failed to read batch {args.batch} with error {e}")
+            exit(-1)
+        except (DisplayAdapterException, DisplayMonitorException) as e:
+            print_error(str(e))
+            exit(-1)
+
+    if args.command is not None:
+        run_sunshine_command(args, retry_policy)
+
+    verify: VerifyOptions | None = None
+
+    if args.verify:
+        verify = VerifyOptions(args.verify_timeout, args.verify_interval / 1000)
+
+    mode_filter = ModeFilter(
+        args.min_refresh,
+        args.max_refresh,
+        args.aspect,
+        args.min_width,
+        args.exact_width,
+        args.sort,
+        args.limit,
+    )
+
+    # Grouping or paging without a monitor lists the primary monitor's modes
+    list_filtered_modes: bool = (
+        args.modes
+        or any(value is not None for value in vars(mode_filter).values())
+        or (args.monitor is None and (args.grouped or args.page is not None))
+    )
+
+    # No command needs the modes of every adapter. Listings stream the modes of the one adapter
+    # they show, and client rules only list them when the decision is not cached.
+    try:
+        all_monitors: list[DisplayMonitor] = get_all_display_monitors(retry_policy, False)
+    finally:
+        print_retry_records(retry_policy)
 
     if len(all_monitors) == 0:
         print_error("No monitors found")
         exit(-1)
 
+    if args.undo is not None or args.recover:
+        try:
+            undone: bool = undo_changes(
+                args.journal if args.journal is not None else JOURNAL_FILE,
+                None if args.recover else args.undo,
+                all_monitors,
+                retry_policy,
+                args.hdr_settle,
+            )
+
+            exit(0 if undone else -1)
+
+        except DisplayMonitorException as e:
+            print_error(str(e))
+            exit(-1)
+
+        except SupersededException as e:
+            print_superseded(e)
+            exit(EXIT_SUPERSEDED)
+
+    if args.common_modes is not None:
+        try:
+            targets: list[DisplayMonitor] = select_monitors(args.common_modes, all_monitors)
+            exit(0 if print_common_modes(targets, mode_filter, args.nearest) else -1)
+        except (DisplayAdapterException, DisplayMonitorException) as e:
+            print_error(str(e))
+            exit(-1)
+
+    if args.hdr_status:
+        try:
+            if args.monitor is None:
+                print_hdr_status([get_primary_monitor(all_monitors)])
+            else:
+                print_hdr_status(select_monitors(args.monitor, all_monitors))
+
+            exit(0)
+        except (DisplayMonitorException, PrimaryMonitorException) as e:
+            print_error(str(e))
+            exit(-1)
+
     if args.hdr is not None:
         if args.hdr.lower() not in ["true", "false"]:
             print_error("Valid values for HDR are 'true' or 'false'")
             exit(-1)
 
+        try:
+            identifiers: list[str] | None = None
+
+            if args.monitor is None:
+                identifiers = [get_primary_monitor(all_monitors).identifier()]
+            elif args.monitor.lower() != "all":
+                identifiers = [i.strip() for i in args.monitor.split(",") if i.strip() != ""]
+
+            exit(0 if change_hdr(identifiers, args.hdr, all_monitors, args.hdr_settle) else -1)
+
+        except PrimaryMonitorException as e:
+            print_error(str(e))
+            exit(-1)
+
+        except (DisplayMonitorException, HdrException) as e:
+            print_error(f"Error when trying to change HDR state. Failed with error {str(e)}")
+            exit(-1)
+
+        except SupersededException as e:
+            print_superseded(e)
+            exit(EXIT_SUPERSEDED)
+
+    if args.client is not None or args.from_env:
+        if args.rules is None:
+            print_error("A rules file is required when selecting a mode for a client")
+            exit(-1)
+
+        if args.width or args.height or args.refresh:
+            print_error("Width, height, and refresh rate cannot be combined with a client mode")
+            exit(-1)
+
         try:
             identifier: str = args.monitor
 
             if identifier is None:
                 identifier = get_primary_monitor(all_monitors).identifier()
 
-            change_hdr(identifier, args.hdr, all_monitors)
+            change_resolution_from_rules(
+                identifier,
+                args.rules,
+                args.client,
+                args.rules_cache,
+                all_monitors,
+                args.temp,
+                retry_policy,
+                verify,
+                args.engine,
+                args.dry_run,
+            )
 
             exit(0)
 
-        except PrimaryMonitorException as e:
+        except (DisplayAdapterException, PrimaryMonitorException, RulesException) as e:
             print_error(str(e))
             exit(-1)
 
-        except HdrException as e:
-            print_error(f"Error when trying to change HDR state. Failed with error {str(e)}")
-            exit(-1)
+        except SupersededException as e:
+            print_superseded(e)
+            exit(EXIT_SUPERSEDED)
 
     if args.width or args.height or args.refresh:
         should_change_resolution: bool = (
@@ -200,7 +1394,17 @@ def main():
             if identifier is None:
                 identifier = get_primary_monitor(all_monitors).identifier()
 
-            change_resolution(identifier, args.width, args.height, args.refresh, args.temp)
+            change_resolution(
+                identifier,
+                args.width,
+                args.height,
+                args.refresh,
+                args.temp,
+                retry_policy,
+                verify,
+                args.engine,
+                args.dry_run,
+            )
 
             exit(0)
 
@@ -212,27 +1416,59 @@ def main():
             print_error(str(e))
             exit(-1)
 
-    if args.monitor is not None:
-        identifier: str = args.monitor
+        except SupersededException as e:
+            print_superseded(e)
+            exit(EXIT_SUPERSEDED)
+
+    if list_filtered_modes:
+        try:
+            identifier: str = args.monitor
+
+            if identifier is None:
+                identifier = get_primary_monitor(all_monitors).identifier()
+
+        except PrimaryMonitorException as e:
+            print_error(str(e))
+            exit(-1)
 
         for target_monitor in all_monitors:
             if target_monitor.adapter.identifier == identifier:
-                print_message("")
-                print_monitor_info(target_monitor)
-                print_message("")
-                print_all_available_modes_for_monitor(target_monitor)
-
-                exit(0)
+                listed: bool = print_filtered_modes_for_monitor(
+                    target_monitor, mode_filter, args.grouped, args.page
+                )
+                exit(0 if listed else -1)
 
         print_error(f"Device {identifier} not found")
         exit(-1)
 
-    else:
-        print_message(f"Monitors found: {len(all_monitors)}\n")
+    # Looking up the HDR state or the modes of the listed monitors can still fail
+    try:
+        if args.monitor is not None:
+            identifier: str = args.monitor
 
-        for target_monitor in all_monitors:
-            print_monitor_info(target_monitor)
-            print_message("")
+            for target_monitor in all_monitors:
+                if target_monitor.adapter.identifier == identifier:
+                    print_message("")
+                    print_monitor_info(target_monitor)
+                    print_message("")
+                    listed: bool = print_all_available_modes_for_monitor(
+                        target_monitor, args.grouped, args.page
+                    )
+                    exit(0 if listed else -1)
+
+            print_error(f"Device {identifier} not found")
+            exit(-1)
+
+        else:
+            print_message(f"Monitors found: {len(all_monitors)}\n")
+
+            for target_monitor in all_monitors:
+                print_monitor_info(target_monitor)
+                print_message("")
+
+    except (DisplayAdapterException, DisplayMonitorException) as e:
+        print_error(str(e))
+        exit(-1)
 
 
 if __name__ == "__main__":
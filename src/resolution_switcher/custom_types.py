@@ -1,22 +1,60 @@
 from __future__ import annotations
 
+from ctypes import sizeof
+from typing import Callable
+
 from resolution_switcher.windows_types import (
+    DISPLAYCONFIG_DEVICE_INFO_TYPE,
     DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO,
     DISPLAYCONFIG_MODE_INFO,
+    DISPLAYCONFIG_MODE_INFO_TYPE,
 )
 
+# Looks up the color info of a monitor's target
+ColorInfoLoader = Callable[[DISPLAYCONFIG_MODE_INFO], DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO]
+
+# Bits of DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO.value
+ADVANCED_COLOR_SUPPORTED: int = 0x1
+ADVANCED_COLOR_ENABLED: int = 0x2
+
 
 class DisplayMode:
-    def __init__(self, width: int, height: int, refresh: int):
+    __slots__ = ("width", "height", "refresh", "refresh_rate")
+
+    def __init__(self, width: int, height: int, refresh: int, refresh_rate: float | None = None):
         self.width: int = width
         self.height: int = height
         self.refresh: int = refresh
+        # Exact refresh rate, when known, e.g. 59.94 for a mode Windows lists as 59Hz. Modes are
+        # still compared by their whole refresh rate only.
+        self.refresh_rate: float | None = refresh_rate
 
     def __str__(self):
+        if self.refresh_rate is not None and round(self.refresh_rate, 2) != self.refresh:
+            return f"{self.width}x{self.height} @ {self.refresh_rate:.2f}Hz"
+
         return str(self.width) + "x" + str(self.height) + " @ " + str(self.refresh) + "Hz"
 
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, DisplayMode):
+            return NotImplemented
+
+        return (self.width, self.height, self.refresh) == (other.width, other.height, other.refresh)
+
+    def __hash__(self) -> int:
+        return hash((self.width, self.height, self.refresh))
+
 
 class DisplayAdapter:
+    __slots__ = (
+        "identifier",
+        "display_name",
+        "active_mode",
+        "available_modes",
+        "is_attached",
+        "is_primary",
+    )
+
     def __init__(
         self,
         identifier: str = "",
@@ -35,17 +73,105 @@ class DisplayAdapter:
 
 
 class DisplayMonitor:
+    # Only the fields that are actually used are kept. The ctypes structures they come from hold
+    # on to the whole QueryDisplayConfig buffer, so they are rebuilt on demand instead.
+    __slots__ = (
+        "name",
+        "adapter",
+        "adapter_id_low",
+        "adapter_id_high",
+        "target_id",
+        "hdr_supported",
+        "hdr_enabled",
+        "bits_per_color_channel",
+        "color_encoding",
+        "color_info_loader",
+    )
+
     def __init__(
         self,
         name: str = "",
-        adapter: DisplayAdapter = DisplayAdapter(),
+        adapter: DisplayAdapter | None = None,
         mode_info: DISPLAYCONFIG_MODE_INFO | None = None,
         color_info: DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO | None = None,
     ):
         self.name: str = name
-        self.adapter: DisplayAdapter = adapter
-        self.mode_info: DISPLAYCONFIG_MODE_INFO | None = mode_info
-        self.color_info: DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO | None = color_info
+        self.adapter: DisplayAdapter = adapter if adapter is not None else DisplayAdapter()
+        self.adapter_id_low: int = 0
+        self.adapter_id_high: int = 0
+        # None until the monitor is matched with a display config target
+        self.target_id: int | None = None
+        self.hdr_supported: bool = False
+        self.hdr_enabled: bool = False
+        self.bits_per_color_channel: int = 0
+        self.color_encoding: int = 0
+        # Set while the color info is yet to be looked up, which happens on first use
+        self.color_info_loader: ColorInfoLoader | None = None
+
+        self.mode_info = mode_info
+        self.color_info = color_info
+
+    @property
+    def mode_info(self) -> DISPLAYCONFIG_MODE_INFO | None:
+        if self.target_id is None:
+            return None
+
+        mode_info = DISPLAYCONFIG_MODE_INFO()
+        mode_info.infoType = DISPLAYCONFIG_MODE_INFO_TYPE.DISPLAYCONFIG_MODE_INFO_TYPE_TARGET
+        mode_info.id = self.target_id
+        mode_info.adapterId.lowPart = self.adapter_id_low
+        mode_info.adapterId.highPart = self.adapter_id_high
+
+        return mode_info
+
+    @mode_info.setter
+    def mode_info(self, mode_info: DISPLAYCONFIG_MODE_INFO | None):
+        if mode_info is None:
+            self.target_id = None
+            return
+
+        self.target_id = mode_info.id
+        self.adapter_id_low = mode_info.adapterId.lowPart
+        self.adapter_id_high = mode_info.adapterId.highPart
+
+    @property
+    def color_info(self) -> DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO | None:
+        if self.target_id is None:
+            return None
+
+        self.load_color_info()
+
+        color_info = DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO()
+        color_info.header.type = (
+            DISPLAYCONFIG_DEVICE_INFO_TYPE.DISPLAYCONFIG_DEVICE_INFO_GET_ADVANCED_COLOR_INFO
+        )
+        color_info.header.size = sizeof(DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO)
+        color_info.header.adapterId.lowPart = self.adapter_id_low
+        color_info.header.adapterId.highPart = self.adapter_id_high
+        color_info.header.id = self.target_id
+        color_info.value = (ADVANCED_COLOR_SUPPORTED if self.hdr_supported else 0) | (
+            ADVANCED_COLOR_ENABLED if self.hdr_enabled else 0
+        )
+        color_info.colorEncoding = self.color_encoding
+        color_info.bitsPerColorChannel = self.bits_per_color_channel
+
+        return color_info
+
+    @color_info.setter
+    def color_info(self, color_info: DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO | None):
+        self.color_info_loader = None
+
+        if color_info is None:
+            self.hdr_supported = False
+            self.hdr_enabled = False
+            self.bits_per_color_channel = 0
+            self.color_encoding = 0
+            return
+
+        self.hdr_supported = color_info.value & ADVANCED_COLOR_SUPPORTED == ADVANCED_COLOR_SUPPORTED
+        self.hdr_enabled = color_info.value & ADVANCED_COLOR_ENABLED == ADVANCED_COLOR_ENABLED
+        self.bits_per_color_channel = color_info.bitsPerColorChannel
+        self.color_encoding = color_info.colorEncoding
 
     def identifier(self) -> str:
         return self.adapter.identifier
@@ -59,21 +185,36 @@ class DisplayMonitor:
     def is_attached(self) -> bool:
         return self.adapter.is_attached
 
-    def is_hdr_supported(self) -> bool:
-        if self.color_info is None:
-            return False
+    def load_color_info(self):
+        loader: ColorInfoLoader | None = self.color_info_loader
 
-        return self.color_info.value & 0x1 == 0x1  # type: ignore[reportOperatorIssue]
+        # Once loaded, nothing is built until the color info is invalidated again
+        if loader is None:
+            return
 
-    def is_hdr_enabled(self) -> bool:
-        if self.color_info is None:
-            return False
+        mode_info: DISPLAYCONFIG_MODE_INFO | None = self.mode_info
 
-        return self.color_info.value & 0x2 == 0x2  # type: ignore[reportOperatorIssue]
+        if mode_info is not None:
+            # Any error is raised again on the next use, rather than leaving stale values behind
+            self.color_info = loader(mode_info)
+
+    def invalidate_color_info(self, loader: ColorInfoLoader):
+        self.color_info_loader = loader
+
+    def is_hdr_supported(self) -> bool:
+        self.load_color_info()
+        return self.hdr_supported
+
+    def is_hdr_enabled(self) -> bool:
+        self.load_color_info()
+        return self.hdr_enabled
 
 
 class DisplayMonitorException(Exception):
-    pass
+    def __init__(self, message: str = "", result: int | None = None):
+        super().__init__(message)
+        # Result code of the Win32 call that failed, None if it did not return one
+        self.result: int | None = result
 
 
 class PrimaryMonitorException(Exception):
@@ -85,4 +226,35 @@ class HdrException(Exception):
 
 
 class DisplayAdapterException(Exception):
+    def __init__(self, message: str = "", result: int | None = None):
+        super().__init__(message)
+        # Result code of the Win32 call that failed, None if it did not return one
+        self.result: int | None = result
+
+
+class RulesException(Exception):
+    pass
+
+
+class SupersededException(Exception):
+    pass
+
+
+class BatchException(Exception):
+    pass
+
+
+class SunshineException(Exception):
+    pass
+
+
+class SnapshotException(Exception):
+    pass
+
+
+class DeadlineException(Exception):
+    pass
+
+
+class JournalException(Exception):
     pass
@@ -0,0 +1,130 @@
+"""Deadlines for Win32 calls, which run on a worker thread so that a call that hangs can be abandoned."""
+
+from __future__ import annotations
+
+import threading
+from queue import SimpleQueue
+from time import perf_counter
+from typing import Callable
+
+from resolution_switcher.custom_types import DeadlineException
+from resolution_switcher.windows_types import install_call_runner
+
+# Calls that some drivers have been seen to block in for tens of seconds
+BLOCKING_FUNCTIONS: frozenset[str] = frozenset(
+    {"ChangeDisplaySettingsExW", "DisplayConfigSetDeviceInfo", "SetDisplayConfig"}
+)
+
+
+class _Call:
+    __slots__ = ("function", "args", "result", "error", "done")
+
+    def __init__(self, function: Callable[..., int], args: tuple):
+        self.function: Callable[..., int] = function
+        self.args: tuple = args
+        self.result: int = 0
+        self.error: BaseException | None = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.function(*self.args)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+
+class _Worker:
+    def __init__(self):
+        self.calls: SimpleQueue[_Call] = SimpleQueue()
+        # A daemon thread, so that a call that never returns does not keep the process alive
+        self.thread = threading.Thread(target=self._serve, name="win32-calls", daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            self.calls.get().run()
+
+
+_worker: _Worker | None = None
+_worker_lock = threading.Lock()
+
+_call_timeout: float | None = None
+_call_timeout_functions: frozenset[str] = BLOCKING_FUNCTIONS
+
+# perf_counter() time by which the whole command has to be done
+_command_deadline: float | None = None
+
+
+def _timeout_for(name: str) -> tuple[float | None, bool]:
+    # Seconds the call may take, and whether it is the command deadline that limits it
+    timeout: float | None = _call_timeout if name in _call_timeout_functions else None
+
+    if _command_deadline is not None:
+        remaining: float = _command_deadline - perf_counter()
+
+        if timeout is None or remaining < timeout:
+            return remaining, True
+
+    return timeout, False
+
+
+def _run_call(name: str, function: Callable[..., int], args: tuple) -> int:
+    global _worker
+
+    timeout, is_command_deadline = _timeout_for(name)
+
+    if timeout is None:
+        return function(*args)
+
+    if timeout <= 0:
+        raise DeadlineException(f"The command deadline passed before {name} was called")
+
+    call = _Call(function, args)
+
+    with _worker_lock:
+        if _worker is None:
+            _worker = _Worker()
+
+        worker: _Worker = _worker
+
+    worker.calls.put(call)
+
+    if not call.done.wait(timeout):
+        # The worker is stuck in the call, so later calls get a new one
+        with _worker_lock:
+            if _worker is worker:
+                _worker = None
+
+        if is_command_deadline:
+            raise DeadlineException(f"The command deadline passed while waiting for {name}")
+
+        raise DeadlineException(f"{name} did not return within {timeout * 1000:.0f} ms")
+
+    if call.error is not None:
+        raise call.error
+
+    return call.result
+
+
+def _update_call_runner():
+    # Without deadlines, calls are made on the calling thread as before
+    install_call_runner(
+        _run_call if _call_timeout is not None or _command_deadline is not None else None
+    )
+
+
+def set_call_timeout(seconds: float | None, functions: frozenset[str] = BLOCKING_FUNCTIONS):
+    global _call_timeout, _call_timeout_functions
+
+    _call_timeout = seconds
+    _call_timeout_functions = functions
+    _update_call_runner()
+
+
+def set_command_deadline(seconds: float | None):
+    global _command_deadline
+
+    _command_deadline = perf_counter() + seconds if seconds is not None else None
+    _update_call_runner()
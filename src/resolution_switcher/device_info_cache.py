@@ -0,0 +1,99 @@
+"""Memoization of the DisplayConfigGetDeviceInfo lookups that only change with the topology."""
+
+from __future__ import annotations
+
+from hashlib import sha1
+from typing import Callable
+
+from resolution_switcher.metrics import count_cache_lookup
+from resolution_switcher.windows_types import DISPLAYCONFIG_MODE_INFO, DISPLAYCONFIG_PATH_INFO, LUID
+
+# Type of the request, adapter LUID (low and high part) and source or target id
+CacheKey = tuple[int, int, int, int]
+
+
+def topology_fingerprint(
+    paths: list[DISPLAYCONFIG_PATH_INFO], modes: list[DISPLAYCONFIG_MODE_INFO]
+) -> str:
+    # Besides which source is connected to which target, the connector, availability and status of
+    # every path and the modes are covered, so that a different monitor plugged into the same
+    # connector is looked up again
+    fingerprint = sha1()
+
+    for path in paths:
+        source, target = path.sourceInfo, path.targetInfo
+
+        fingerprint.update(bytes(source.adapterId))
+        fingerprint.update(bytes(target.adapterId))
+
+        for value in (
+            source.id,
+            source.statusFlags,
+            target.id,
+            target.outputTechnology,
+            target.targetAvailable,
+            target.statusFlags,
+            path.flags,
+        ):
+            fingerprint.update(value.to_bytes(4, "little"))
+
+    for mode in modes:
+        fingerprint.update(bytes(mode))
+
+    return fingerprint.hexdigest()
+
+
+class DeviceInfoCache:
+    def __init__(self):
+        self.entries: dict[CacheKey, str] = {}
+        # Topology the entries were looked up in, None until the display config is first queried
+        self.fingerprint: str | None = None
+        self.hits: int = 0
+        self.misses: int = 0
+        self.invalidations: int = 0
+
+    def validate(self, paths: list[DISPLAYCONFIG_PATH_INFO], modes: list[DISPLAYCONFIG_MODE_INFO]):
+        fingerprint: str = topology_fingerprint(paths, modes)
+
+        if fingerprint == self.fingerprint:
+            return
+
+        if len(self.entries) > 0:
+            self.invalidations += 1
+
+        self.entries.clear()
+        self.fingerprint = fingerprint
+
+    def lookup(self, info_type: int, adapter_id: LUID, id: int, query: Callable[[], str]) -> str:
+        key: CacheKey = (int(info_type), adapter_id.lowPart, adapter_id.highPart, id)
+        value: str | None = self.entries.get(key)
+
+        if value is not None:
+            self.hits += 1
+            count_cache_lookup("device_info", "hit")
+            return value
+
+        self.misses += 1
+        count_cache_lookup("device_info", "miss")
+
+        # Failed lookups raise, and are queried again next time
+        value = query()
+        self.entries[key] = value
+
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.fingerprint = None
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+# Shared by every lookup in the process
+device_info_cache = DeviceInfoCache()
@@ -1,7 +1,21 @@
+from contextlib import contextmanager
 from ctypes import byref, sizeof
-
-from resolution_switcher.custom_types import DisplayAdapter, DisplayAdapterException, DisplayMode
+from time import perf_counter, sleep
+from typing import Iterator
+
+from resolution_switcher.custom_types import (
+    DeadlineException,
+    DisplayAdapter,
+    DisplayAdapterException,
+    DisplayMode,
+)
+from resolution_switcher.journal import FAILED, UNCERTAIN, is_journaling, record_mode_changes
+from resolution_switcher.locking import display_change_lock
+from resolution_switcher.metrics import DISP_CHANGE_RESULT_NAMES, count_result, measure_phase
+from resolution_switcher.retry import TRANSIENT_DISP_CHANGE_RESULTS, RetryPolicy, run_with_retry
 from resolution_switcher.windows_types import (
+    CDS_NORESET,
+    CDS_TEST,
     CDS_UPDATEREGISTRY,
     DEVMODEW,
     DISP_CHANGE_BADDUALVIEW,
@@ -37,7 +51,9 @@ def is_primary_device(adapter: DISPLAY_DEVICEW) -> bool:
     return state_flags & DISPLAY_DEVICE_PRIMARY_DEVICE == DISPLAY_DEVICE_PRIMARY_DEVICE
 
 
-def get_all_display_adapters() -> list[DisplayAdapter]:
+def get_all_display_adapters(
+    include_modes: bool = True, include_active_modes: bool = True
+) -> list[DisplayAdapter]:
     adapters: list[DisplayAdapter] = []
 
     # This will hold display device information on every iteration of the loop
@@ -64,10 +80,18 @@ def get_all_display_adapters() -> list[DisplayAdapter]:
                 display_adapter = DisplayAdapter()
                 display_adapter.identifier = str(display_device.DeviceName)
                 display_adapter.display_name = str(display_device.DeviceString)
-                display_adapter.active_mode = get_active_display_mode_for_adapter(display_device)
-                display_adapter.available_modes = get_all_available_display_modes_for_adapter(
-                    display_device
-                )
+
+                # Without it, the caller fills in the active modes from elsewhere
+                if include_active_modes:
+                    display_adapter.active_mode = get_active_display_mode_for_adapter(
+                        display_device
+                    )
+
+                if include_modes:
+                    display_adapter.available_modes = get_all_available_display_modes_for_adapter(
+                        display_device
+                    )
+
                 display_adapter.is_attached = is_attached_to_desktop(display_device)
                 display_adapter.is_primary = is_primary_device(display_device)
 
@@ -80,12 +104,56 @@ def get_all_display_adapters() -> list[DisplayAdapter]:
     return adapters
 
 
+def is_display_device_attached(device_identifier: str) -> bool:
+    # Only walks the adapters, without looking up any of their modes, so it is cheap to poll
+    display_device = DISPLAY_DEVICEW()
+    display_device.cb = sizeof(DISPLAY_DEVICEW)
+    index: int = 0
+
+    while EnumDisplayDevicesW(None, index, byref(display_device)) != 0:
+        if display_device.DeviceName == device_identifier:
+            return is_attached_to_desktop(display_device)
+
+        index += 1
+
+    return False
+
+
+def wait_for_display_device(
+    device_identifier: str,
+    timeout: float = 10.0,
+    interval: float = 0.02,
+    max_interval: float = 0.5,
+) -> float:
+    start: float = perf_counter()
+
+    # Headless displays usually show up within a few hundred milliseconds, so polling starts fast
+    # and backs off the longer it takes
+    while True:
+        try:
+            if is_display_device_attached(device_identifier):
+                return perf_counter() - start
+        except OSError as e:
+            raise DisplayAdapterException(f"Failed to get list of available display devices: {e}")
+
+        elapsed: float = perf_counter() - start
+
+        if elapsed >= timeout:
+            raise DisplayAdapterException(
+                f"Device {device_identifier} did not appear within {timeout * 1000:.0f} ms"
+            )
+
+        sleep(min(interval, timeout - elapsed))
+        interval = min(interval * 2, max_interval)
+
+
 def get_all_available_display_modes_for_adapter(
     adapter: DISPLAY_DEVICEW,
 ) -> list[DisplayMode]:
-    identifier: str = adapter.DeviceName
-    display_modes: list[DisplayMode] = []
+    return list(iter_display_modes(adapter.DeviceName))
 
+
+def iter_display_modes(identifier: str) -> Iterator[DisplayMode]:
     # This will store the display mode information on every loop iteration
     devmodew: DEVMODEW = DEVMODEW()
     devmodew.dmSize = sizeof(DEVMODEW)
@@ -105,32 +173,32 @@ def get_all_available_display_modes_for_adapter(
         )
 
     index_of_current_mode: int = 1
-    finished_getting_modes: bool = False
 
-    while not finished_getting_modes:
+    # Modes are handed out as the driver reports them, so callers that stop iterating early never
+    # pay for the rest of the list
+    while True:
         try:
             result: int = EnumDisplaySettingsW(identifier, index_of_current_mode, byref(devmodew))
-
-            if result == 0:
-                finished_getting_modes = True
-            else:
-                display_mode = DisplayMode(
-                    devmodew.dmPelsWidth,
-                    devmodew.dmPelsHeight,
-                    devmodew.dmDisplayFrequency,
-                )
-                display_modes.append(display_mode)
-
-                index_of_current_mode += 1
         except OSError:
-            finished_getting_modes = True
+            return
+
+        if result == 0:
+            return
+
+        yield DisplayMode(
+            devmodew.dmPelsWidth,
+            devmodew.dmPelsHeight,
+            devmodew.dmDisplayFrequency,
+        )
 
-    return display_modes
+        index_of_current_mode += 1
 
 
 def get_active_display_mode_for_adapter(adapter: DISPLAY_DEVICEW) -> DisplayMode:
-    identifier = adapter.DeviceName
+    return get_active_display_mode(adapter.DeviceName)
 
+
+def get_active_display_mode(identifier: str) -> DisplayMode:
     try:
         display_modew = DEVMODEW()
         display_modew.dmSize = sizeof(DEVMODEW)
@@ -153,15 +221,46 @@ def get_active_display_mode_for_adapter(adapter: DISPLAY_DEVICEW) -> DisplayMode
         )
 
 
-def set_display_mode_for_device(
-    display_mode: DisplayMode, device_identifier: str, temp: bool = False
-):
-    if device_identifier is None:
-        raise DisplayAdapterException("Device identifier cannot be empty")
+def wait_for_display_mode(
+    display_mode: DisplayMode,
+    device_identifier: str,
+    timeout: float = 5.0,
+    interval: float = 0.05,
+) -> float:
+    start: float = perf_counter()
+    active_mode: DisplayMode | None = None
+    error: DisplayAdapterException | None = None
 
-    if display_mode is None:
-        raise DisplayAdapterException("Display settings cannot be empty")
+    # The driver can report success before the new mode is actually active, so poll the current
+    # settings until they match or the deadline passes
+    while True:
+        try:
+            active_mode = get_active_display_mode(device_identifier)
+            error = None
+
+            if active_mode == display_mode:
+                return perf_counter() - start
+        except DisplayAdapterException as e:
+            error = e
+
+        if perf_counter() - start >= timeout:
+            break
+
+        sleep(interval)
+
+    if error is not None:
+        raise DisplayAdapterException(
+            f"Display mode of {device_identifier} did not settle on {display_mode} within "
+            f"{timeout * 1000:.0f} ms: {error}"
+        )
+
+    raise DisplayAdapterException(
+        f"Display mode of {device_identifier} did not settle on {display_mode} within "
+        f"{timeout * 1000:.0f} ms, active mode is {active_mode}"
+    )
 
+
+def _display_mode_devmodew(display_mode: DisplayMode, device_identifier: str) -> DEVMODEW:
     devmodew = DEVMODEW()
     devmodew.dmDeviceName = device_identifier
     devmodew.dmSize = sizeof(DEVMODEW)
@@ -170,37 +269,169 @@ def set_display_mode_for_device(
     devmodew.dmDisplayFrequency = display_mode.refresh
     devmodew.dmFields = DM_PELSWIDTH | DM_PELSHEIGHT | DM_DISPLAYFREQUENCY
 
+    return devmodew
+
+
+@contextmanager
+def journaled_mode_changes(changes: list[tuple[DisplayMode, str]], temp: bool) -> Iterator[None]:
+    if not is_journaling():
+        yield
+        return
+
+    # Looked up while the display change lock is held, so these are the modes being replaced
+    previous: list[tuple[str, DisplayMode | None, DisplayMode]] = []
+
+    for display_mode, device_identifier in changes:
+        try:
+            previous.append(
+                (device_identifier, get_active_display_mode(device_identifier), display_mode)
+            )
+        except DisplayAdapterException:
+            previous.append((device_identifier, None, display_mode))
+
+    try:
+        yield
+    except DisplayAdapterException as e:
+        record_mode_changes(previous, temp, FAILED, e.result if e.result is not None else 0)
+        raise
+    except DeadlineException:
+        record_mode_changes(previous, temp, UNCERTAIN)
+        raise
+
+    record_mode_changes(previous, temp)
+
+
+def set_display_mode_for_device(
+    display_mode: DisplayMode,
+    device_identifier: str,
+    temp: bool = False,
+    retry_policy: RetryPolicy | None = None,
+):
+    if device_identifier is None:
+        raise DisplayAdapterException("Device identifier cannot be empty")
+
+    if display_mode is None:
+        raise DisplayAdapterException("Display settings cannot be empty")
+
+    devmodew: DEVMODEW = _display_mode_devmodew(display_mode, device_identifier)
+
     # Use CDS_UPDATEREGISTRY to persist changes to registry (default behavior)
     # Use 0 for temporary changes that don't persist
     flags: int = 0 if temp else CDS_UPDATEREGISTRY
 
+    with display_change_lock(f"mode:{device_identifier}"):
+        with (
+            journaled_mode_changes([(display_mode, device_identifier)], temp),
+            measure_phase("set_display_mode", device_identifier),
+        ):
+            _change_display_settings(device_identifier, devmodew, flags, retry_policy)
+
+
+def test_display_mode_for_device(
+    display_mode: DisplayMode,
+    device_identifier: str,
+    retry_policy: RetryPolicy | None = None,
+):
+    with measure_phase("test_display_mode", device_identifier):
+        _change_display_settings(
+            device_identifier,
+            _display_mode_devmodew(display_mode, device_identifier),
+            CDS_TEST,
+            retry_policy,
+        )
+
+
+def set_display_modes_for_devices(
+    changes: list[tuple[DisplayMode, str]],
+    retry_policy: RetryPolicy | None = None,
+):
+    # Every mode is staged in the registry with CDS_NORESET, then a single call without a device
+    # applies all of them at once, so the displays only reset once. CDS_NORESET only works
+    # together with CDS_UPDATEREGISTRY, which is why staged changes are always persisted.
+    identifiers: list[str] = [device_identifier for _, device_identifier in changes]
+
+    if len(set(identifiers)) != len(identifiers):
+        raise DisplayAdapterException("A device can only be changed once per staged change")
+
+    with display_change_lock("mode:" + ",".join(sorted(identifiers))):
+        # Staged modes stay in the registry until the next reset, so every mode is checked before
+        # any of them is staged
+        for display_mode, device_identifier in changes:
+            test_display_mode_for_device(display_mode, device_identifier, retry_policy)
+
+        with journaled_mode_changes(changes, False):
+            for display_mode, device_identifier in changes:
+                with measure_phase("stage_display_mode", device_identifier):
+                    _change_display_settings(
+                        device_identifier,
+                        _display_mode_devmodew(display_mode, device_identifier),
+                        CDS_UPDATEREGISTRY | CDS_NORESET,
+                        retry_policy,
+                    )
+
+            with measure_phase("apply_display_modes", "all"):
+                _change_display_settings(None, None, 0, retry_policy)
+
+
+def _change_display_settings(
+    device_identifier: str | None,
+    devmodew: DEVMODEW | None,
+    flags: int,
+    retry_policy: RetryPolicy | None = None,
+):
+    # Without a device or mode, the changes staged with CDS_NORESET are applied
+    monitor: str = device_identifier if device_identifier is not None else "all"
+
+    def attempt() -> int:
+        try:
+            result: int = ChangeDisplaySettingsExW(
+                device_identifier,
+                byref(devmodew) if devmodew is not None else None,
+                None,
+                flags,
+                None,
+            )
+        except OSError:
+            count_result("set_display_mode", monitor, "OSError")
+            raise
+
+        count_result("set_display_mode", monitor, DISP_CHANGE_RESULT_NAMES.get(result, str(result)))
+
+        return result
+
     try:
-        result: int = ChangeDisplaySettingsExW(
-            device_identifier, byref(devmodew), None, flags, None
+        result: int = run_with_retry(
+            f"ChangeDisplaySettingsExW({monitor})",
+            attempt,
+            lambda result: result in TRANSIENT_DISP_CHANGE_RESULTS,
+            retry_policy,
         )
 
         if result == DISP_CHANGE_SUCCESSFUL:
             return
         elif result == DISP_CHANGE_RESTART:
             raise DisplayAdapterException(
-                "The computer must be restarted for the graphics mode to work"
+                "The computer must be restarted for the graphics mode to work", result
             )
         elif result == DISP_CHANGE_BADFLAGS:
-            raise DisplayAdapterException("An invalid set of flags was passed in")
+            raise DisplayAdapterException("An invalid set of flags was passed in", result)
         elif result == DISP_CHANGE_BADMODE:
-            raise DisplayAdapterException("The graphics mode is not supported")
+            raise DisplayAdapterException("The graphics mode is not supported", result)
         elif result == DISP_CHANGE_BADPARAM:
-            raise DisplayAdapterException("An invalid parameter was passed in")
+            raise DisplayAdapterException("An invalid parameter was passed in", result)
         elif result == DISP_CHANGE_FAILED:
-            raise DisplayAdapterException("The display driver failed the specified graphics mode")
+            raise DisplayAdapterException(
+                "The display driver failed the specified graphics mode", result
+            )
         elif result == DISP_CHANGE_NOTUPDATED:
-            raise DisplayAdapterException("Unable to write settings to the registry")
+            raise DisplayAdapterException("Unable to write settings to the registry", result)
         elif result == DISP_CHANGE_BADDUALVIEW:
             raise DisplayAdapterException(
-                "The settings change was unsuccessful because the system is DualView capable"
+                "The settings change was unsuccessful because the system is DualView capable",
+                result,
             )
         else:
-            raise DisplayAdapterException("An unknown error occurred")
+            raise DisplayAdapterException("An unknown error occurred", result)
 
     except OSError as e:
         raise DisplayAdapterException(
@@ -0,0 +1,212 @@
+"""Mode changes applied to the whole display topology with a single SetDisplayConfig call."""
+
+from __future__ import annotations
+
+from ctypes import byref
+
+from resolution_switcher.custom_types import DisplayAdapterException, DisplayMode
+from resolution_switcher.display_adapters import journaled_mode_changes
+from resolution_switcher.display_monitors import get_monitor_source_name, query_display_config
+from resolution_switcher.locking import display_change_lock
+from resolution_switcher.metrics import count_result, measure_phase
+from resolution_switcher.retry import TRANSIENT_DISPLAY_CONFIG_RESULTS, RetryPolicy, run_with_retry
+from resolution_switcher.windows_types import (
+    DISPLAYCONFIG_MODE_INFO,
+    DISPLAYCONFIG_MODE_INFO_TYPE,
+    DISPLAYCONFIG_PATH_INFO,
+    DISPLAYCONFIG_PATH_MODE_IDX_INVALID,
+    ERROR_ACCESS_DENIED,
+    ERROR_BAD_CONFIGURATION,
+    ERROR_GEN_FAILURE,
+    ERROR_INVALID_PARAMETER,
+    ERROR_NOT_SUPPORTED,
+    ERROR_SUCCESS,
+    SDC_ALLOW_CHANGES,
+    SDC_APPLY,
+    SDC_SAVE_TO_DATABASE,
+    SDC_USE_SUPPLIED_DISPLAY_CONFIG,
+    SDC_VALIDATE,
+    SetDisplayConfig,
+)
+
+ENGINES: list[str] = ["legacy", "displayconfig"]
+
+SET_DISPLAY_CONFIG_RESULT_NAMES: dict[int, str] = {
+    ERROR_SUCCESS: "ERROR_SUCCESS",
+    ERROR_INVALID_PARAMETER: "ERROR_INVALID_PARAMETER",
+    ERROR_NOT_SUPPORTED: "ERROR_NOT_SUPPORTED",
+    ERROR_ACCESS_DENIED: "ERROR_ACCESS_DENIED",
+    ERROR_GEN_FAILURE: "ERROR_GEN_FAILURE",
+    ERROR_BAD_CONFIGURATION: "ERROR_BAD_CONFIGURATION",
+}
+
+
+def _query_for_update(
+    retry_policy: RetryPolicy | None,
+) -> tuple[list[DISPLAYCONFIG_PATH_INFO], list[DISPLAYCONFIG_MODE_INFO]]:
+    result, paths, modes = run_with_retry(
+        "QueryDisplayConfig",
+        query_display_config,
+        lambda query: query[0] in TRANSIENT_DISPLAY_CONFIG_RESULTS,
+        retry_policy,
+    )
+
+    if result != ERROR_SUCCESS:
+        raise DisplayAdapterException(f"Failed to get display config with result {result}")
+
+    return paths, modes
+
+
+def _source_key(adapter_id, source_id: int) -> tuple[int, int, int]:
+    return adapter_id.highPart, adapter_id.lowPart, source_id
+
+
+def _apply_display_modes(
+    paths: list[DISPLAYCONFIG_PATH_INFO],
+    modes: list[DISPLAYCONFIG_MODE_INFO],
+    changes: list[tuple[DisplayMode, str]],
+):
+    requested: dict[str, DisplayMode] = {
+        device_identifier: display_mode for display_mode, device_identifier in changes
+    }
+    # Cloned monitors are separate paths from the same source, so the source of every path is
+    # named once and all of its paths change together
+    source_names: dict[tuple[int, int, int], str] = {}
+    changed: dict[tuple[int, int, int], DisplayMode] = {}
+
+    for path in paths:
+        key = _source_key(path.sourceInfo.adapterId, path.sourceInfo.id)
+
+        if key not in source_names:
+            source_names[key] = get_monitor_source_name(path.sourceInfo)
+
+        source_name: str = source_names[key]
+
+        if source_name not in requested:
+            continue
+
+        display_mode: DisplayMode = requested[source_name]
+        source_index: int = path.sourceInfo.dummyUnion.modeInfoIdx
+
+        if (
+            source_index == DISPLAYCONFIG_PATH_MODE_IDX_INVALID
+            or modes[source_index].infoType
+            != DISPLAYCONFIG_MODE_INFO_TYPE.DISPLAYCONFIG_MODE_INFO_TYPE_SOURCE
+        ):
+            raise DisplayAdapterException(f"{source_name} has no source mode to change")
+
+        changed[key] = display_mode
+
+        # Without a target mode, Windows picks the timing that best fits the source mode and the
+        # refresh rate requested on the path. A fractional rate such as 59.94 is requested exactly,
+        # since its whole part would ask for 59Hz
+        path.targetInfo.dummyUnion.modeInfoIdx = DISPLAYCONFIG_PATH_MODE_IDX_INVALID
+
+        if display_mode.refresh_rate is not None:
+            path.targetInfo.rational.numerator = round(display_mode.refresh_rate * 1000)
+            path.targetInfo.rational.denominator = 1000
+        else:
+            path.targetInfo.rational.numerator = display_mode.refresh
+            path.targetInfo.rational.denominator = 1
+
+    # Paths of a clone group may share one source mode or each hold a copy of it
+    for mode in modes:
+        if mode.infoType != DISPLAYCONFIG_MODE_INFO_TYPE.DISPLAYCONFIG_MODE_INFO_TYPE_SOURCE:
+            continue
+
+        source_mode: DisplayMode | None = changed.get(_source_key(mode.adapterId, mode.id))
+
+        if source_mode is not None:
+            mode.dummyUnion.sourceMode.width = source_mode.width
+            mode.dummyUnion.sourceMode.height = source_mode.height
+
+    missing: list[str] = [
+        device_identifier
+        for device_identifier in requested
+        if device_identifier not in source_names.values()
+    ]
+
+    if len(missing) > 0:
+        raise DisplayAdapterException(f"Device {', '.join(missing)} not found")
+
+
+def _set_display_config(
+    changes: list[tuple[DisplayMode, str]],
+    flags: int,
+    retry_policy: RetryPolicy | None = None,
+):
+    paths, modes = _query_for_update(retry_policy)
+    _apply_display_modes(paths, modes, changes)
+
+    path_array = (DISPLAYCONFIG_PATH_INFO * len(paths))(*paths)
+    mode_array = (DISPLAYCONFIG_MODE_INFO * len(modes))(*modes)
+    phase: str = "validate_display_config" if flags & SDC_VALIDATE else "set_display_config"
+
+    def attempt() -> int:
+        try:
+            result: int = SetDisplayConfig(
+                len(paths), byref(path_array[0]), len(modes), byref(mode_array[0]), flags
+            )
+        except OSError:
+            count_result(phase, "all", "OSError")
+            raise
+
+        count_result(phase, "all", SET_DISPLAY_CONFIG_RESULT_NAMES.get(result, str(result)))
+
+        return result
+
+    try:
+        result: int = run_with_retry(
+            "SetDisplayConfig",
+            attempt,
+            lambda result: result in TRANSIENT_DISPLAY_CONFIG_RESULTS,
+            retry_policy,
+        )
+    except OSError as e:
+        raise DisplayAdapterException(f"Failed to set display config with error {e}")
+
+    if result == ERROR_SUCCESS:
+        return
+    elif result == ERROR_INVALID_PARAMETER or result == ERROR_BAD_CONFIGURATION:
+        raise DisplayAdapterException("The graphics mode is not supported", result)
+    elif result == ERROR_NOT_SUPPORTED:
+        raise DisplayAdapterException(
+            "The graphics driver does not support SetDisplayConfig", result
+        )
+    elif result == ERROR_ACCESS_DENIED:
+        raise DisplayAdapterException(
+            "Display settings cannot be changed from this session", result
+        )
+    else:
+        raise DisplayAdapterException(f"Failed to set display config with result {result}", result)
+
+
+def set_display_modes_with_display_config(
+    changes: list[tuple[DisplayMode, str]],
+    temp: bool = False,
+    retry_policy: RetryPolicy | None = None,
+):
+    # Every change is made to a copy of the active topology, which is then applied as a whole, so
+    # the displays only reset once however many of them change
+    flags: int = SDC_APPLY | SDC_USE_SUPPLIED_DISPLAY_CONFIG | SDC_ALLOW_CHANGES
+
+    if not temp:
+        flags |= SDC_SAVE_TO_DATABASE
+
+    identifiers: list[str] = sorted(device_identifier for _, device_identifier in changes)
+
+    with display_change_lock("mode:" + ",".join(identifiers)):
+        with (
+            journaled_mode_changes(changes, temp),
+            measure_phase("set_display_config", ",".join(identifiers)),
+        ):
+            _set_display_config(changes, flags, retry_policy)
+
+
+def validate_display_modes_with_display_config(
+    changes: list[tuple[DisplayMode, str]],
+    retry_policy: RetryPolicy | None = None,
+):
+    _set_display_config(
+        changes, SDC_VALIDATE | SDC_USE_SUPPLIED_DISPLAY_CONFIG | SDC_ALLOW_CHANGES, retry_policy
+    )
@@ -1,20 +1,35 @@
 from ctypes import byref, c_ulong, sizeof
 from ctypes.wintypes import BOOL
-from time import sleep  # type: ignore[reportMissingImports]
+from hashlib import sha1
+from time import perf_counter, sleep  # type: ignore[reportMissingImports]
 
 from resolution_switcher.custom_types import (
+    DisplayAdapterException,
+    DisplayMode,
     DisplayMonitor,
     DisplayMonitorException,
     PrimaryMonitorException,
 )
-from resolution_switcher.display_adapters import DisplayAdapter, get_all_display_adapters
+from resolution_switcher.device_info_cache import device_info_cache
+from resolution_switcher.display_adapters import (
+    DisplayAdapter,
+    get_active_display_mode,
+    get_all_display_adapters,
+)
+from resolution_switcher.journal import FAILED, UNCERTAIN, is_journaling, record_hdr_changes
+from resolution_switcher.locking import display_change_lock
+from resolution_switcher.metrics import count_result, measure_phase, observe_hdr_settle
+from resolution_switcher.retry import TRANSIENT_DISPLAY_CONFIG_RESULTS, RetryPolicy, run_with_retry
 from resolution_switcher.windows_types import (
     DISPLAYCONFIG_ADAPTER_NAME,
     DISPLAYCONFIG_DEVICE_INFO_TYPE,
     DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO,
     DISPLAYCONFIG_MODE_INFO,
+    DISPLAYCONFIG_MODE_INFO_TYPE,
     DISPLAYCONFIG_PATH_INFO,
+    DISPLAYCONFIG_PATH_MODE_IDX_INVALID,
     DISPLAYCONFIG_PATH_SOURCE_INFO,
+    DISPLAYCONFIG_RATIONAL,
     DISPLAYCONFIG_SET_ADVANCED_COLOR_STATE,
     DISPLAYCONFIG_SOURCE_DEVICE_NAME,
     DISPLAYCONFIG_TARGET_DEVICE_NAME,
@@ -30,6 +45,15 @@ from resolution_switcher.windows_types import (
 
 
 def get_adapter_name(mode_info: DISPLAYCONFIG_MODE_INFO) -> str:
+    return device_info_cache.lookup(
+        DISPLAYCONFIG_DEVICE_INFO_TYPE.DISPLAYCONFIG_DEVICE_INFO_GET_ADAPTER_NAME,
+        mode_info.adapterId,
+        0,
+        lambda: _query_adapter_name(mode_info),
+    )
+
+
+def _query_adapter_name(mode_info: DISPLAYCONFIG_MODE_INFO) -> str:
     adapter_info = DISPLAYCONFIG_ADAPTER_NAME()
     adapter_info.header.type = (
         DISPLAYCONFIG_DEVICE_INFO_TYPE.DISPLAYCONFIG_DEVICE_INFO_GET_ADAPTER_NAME
@@ -49,6 +73,15 @@ def get_adapter_name(mode_info: DISPLAYCONFIG_MODE_INFO) -> str:
 
 
 def get_monitor_source_name(path_source_info: DISPLAYCONFIG_PATH_SOURCE_INFO) -> str:
+    return device_info_cache.lookup(
+        DISPLAYCONFIG_DEVICE_INFO_TYPE.DISPLAYCONFIG_DEVICE_INFO_GET_SOURCE_NAME,
+        path_source_info.adapterId,
+        path_source_info.id,
+        lambda: _query_monitor_source_name(path_source_info),
+    )
+
+
+def _query_monitor_source_name(path_source_info: DISPLAYCONFIG_PATH_SOURCE_INFO) -> str:
     device_info = DISPLAYCONFIG_SOURCE_DEVICE_NAME()
     device_info.header.type = (
         DISPLAYCONFIG_DEVICE_INFO_TYPE.DISPLAYCONFIG_DEVICE_INFO_GET_SOURCE_NAME
@@ -70,6 +103,15 @@ def get_monitor_source_name(path_source_info: DISPLAYCONFIG_PATH_SOURCE_INFO) ->
 
 
 def get_monitor_name(mode_info: DISPLAYCONFIG_MODE_INFO) -> str:
+    return device_info_cache.lookup(
+        DISPLAYCONFIG_DEVICE_INFO_TYPE.DISPLAYCONFIG_DEVICE_INFO_GET_TARGET_NAME,
+        mode_info.adapterId,
+        mode_info.id,
+        lambda: _query_monitor_name(mode_info),
+    )
+
+
+def _query_monitor_name(mode_info: DISPLAYCONFIG_MODE_INFO) -> str:
     device_info = DISPLAYCONFIG_TARGET_DEVICE_NAME()
     device_info.header.type = (
         DISPLAYCONFIG_DEVICE_INFO_TYPE.DISPLAYCONFIG_DEVICE_INFO_GET_TARGET_NAME
@@ -93,6 +135,7 @@ def get_monitor_name(mode_info: DISPLAYCONFIG_MODE_INFO) -> str:
 def get_monitor_color_info(
     mode_info: DISPLAYCONFIG_MODE_INFO,
 ) -> DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO:
+    # HDR state changes without the topology changing, so it is never cached across monitors
     color_info = DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO()
     color_info.header.type = (
         DISPLAYCONFIG_DEVICE_INFO_TYPE.DISPLAYCONFIG_DEVICE_INFO_GET_ADVANCED_COLOR_INFO
@@ -114,11 +157,20 @@ def get_monitor_color_info(
         raise DisplayMonitorException(f"Failed to get monitor color info with error {e}")
 
 
-def set_hdr_state_for_monitor(enabled: bool, monitor: DisplayMonitor):
-    if monitor.mode_info is None:
-        raise DisplayMonitorException("Cannot change HDR state for monitor without mode info")
+# How long displays take to settle after their HDR state changed, before calibration is refreshed
+HDR_SETTLE_SECONDS: float = 3
 
-    mode_info: DISPLAYCONFIG_MODE_INFO = monitor.mode_info
+# How long to wait before reading the HDR state back for the first time while displays settle. The
+# wait doubles after every read, so a display that never reports the new state costs a handful of
+# reads per settle wait rather than one every interval.
+HDR_POLL_INTERVAL: float = 0.05
+
+
+def _request_hdr_state(enabled: bool, monitor: DisplayMonitor) -> DisplayMonitorException | None:
+    mode_info: DISPLAYCONFIG_MODE_INFO | None = monitor.mode_info
+
+    if mode_info is None:
+        return DisplayMonitorException("Cannot change HDR state for monitor without mode info")
 
     color_state = DISPLAYCONFIG_SET_ADVANCED_COLOR_STATE()
     color_state.header.type = (
@@ -130,23 +182,145 @@ def set_hdr_state_for_monitor(enabled: bool, monitor: DisplayMonitor):
     color_state.header.id = mode_info.id
     color_state.enableAdvancedColor = enabled
 
+    identifier: str = monitor.identifier()
+
     try:
         result: int = DisplayConfigSetDeviceInfo(byref(color_state.header))
+    except OSError as e:
+        count_result("set_hdr", identifier, "OSError")
+        return DisplayMonitorException(f"Failed to change HDR state with error {e}")
 
-        if result != ERROR_SUCCESS:
-            raise DisplayMonitorException(f"Failed to change HDR state  with result {result}")
+    count_result("set_hdr", identifier, "ERROR_SUCCESS" if result == ERROR_SUCCESS else str(result))
 
-        sleep(3)
+    if result != ERROR_SUCCESS:
+        return DisplayMonitorException(f"Failed to change HDR state  with result {result}", result)
 
-        is_calibration_management_enabled = BOOL()
+    return None
 
-        if not WcsGetCalibrationManagementState(byref(is_calibration_management_enabled)):
-            raise DisplayMonitorException("Failed to get calibration management state")
 
-        InternalRefreshCalibration(0, 0)
+def _hdr_state_or_none(monitor: DisplayMonitor) -> bool | None:
+    try:
+        return monitor.is_hdr_enabled()
+    except DisplayMonitorException:
+        return None
+
+
+def _journal_hdr_changes(
+    enabled: bool,
+    monitors: list[DisplayMonitor],
+    previous: list[bool | None],
+    errors: list[DisplayMonitorException | None],
+):
+    outcomes: list[tuple[int, int]] = [
+        (0, 0) if error is None else (FAILED, error.result if error.result is not None else 0)
+        for error in errors
+    ]
+
+    # A request that raised, e.g. because it was abandoned after its deadline, may have been made
+    if len(outcomes) < len(monitors):
+        outcomes.append((UNCERTAIN, 0))
+
+    record_hdr_changes(
+        [
+            (monitor.identifier(), before, enabled, outcome, result)
+            for monitor, before, (outcome, result) in zip(monitors, previous, outcomes)
+        ]
+    )
 
-    except OSError as e:
-        raise DisplayMonitorException(f"Failed to change HDR state with error {e}")
+
+def _wait_for_hdr_state(
+    enabled: bool, monitors: list[DisplayMonitor], start: float, deadline: float
+):
+    # The state is read back during the settle wait, so that the metric tells how long each display
+    # actually took to report it. Displays that never do within the wait are not observed.
+    pending: list[DisplayMonitor] = list(monitors)
+    interval: float = HDR_POLL_INTERVAL
+
+    while True:
+        for monitor in list(pending):
+            monitor.invalidate_color_info(get_monitor_color_info)
+
+            if _hdr_state_or_none(monitor) == enabled:
+                observe_hdr_settle(monitor.identifier(), perf_counter() - start)
+                pending.remove(monitor)
+
+        remaining: float = deadline - perf_counter()
+
+        if len(pending) == 0 or remaining <= 0:
+            return
+
+        sleep(min(interval, remaining))
+        interval *= 2
+
+
+def set_hdr_state_for_monitors(
+    enabled: bool,
+    monitors: list[DisplayMonitor],
+    settle_seconds: float = HDR_SETTLE_SECONDS,
+) -> list[DisplayMonitorException | None]:
+    # Every monitor is switched first, so that they all settle during the same wait and share a
+    # single calibration refresh. The outcome of every monitor is returned in order, None meaning
+    # success.
+    identifiers: list[str] = [monitor.identifier() for monitor in monitors]
+
+    with (
+        display_change_lock("hdr:" + ",".join(sorted(identifiers))),
+        measure_phase("set_hdr", ",".join(identifiers)),
+    ):
+        # Looked up before anything changes, for the journal
+        previous: list[bool | None] | None = (
+            [_hdr_state_or_none(monitor) for monitor in monitors] if is_journaling() else None
+        )
+        errors: list[DisplayMonitorException | None] = []
+
+        try:
+            for monitor in monitors:
+                errors.append(_request_hdr_state(enabled, monitor))
+        finally:
+            if previous is not None:
+                _journal_hdr_changes(enabled, monitors, previous, errors)
+
+        if all(error is not None for error in errors):
+            return errors
+
+        settle_start: float = perf_counter()
+        deadline: float = settle_start + settle_seconds
+
+        _wait_for_hdr_state(
+            enabled,
+            [monitor for monitor, error in zip(monitors, errors) if error is None],
+            settle_start,
+            deadline,
+        )
+        sleep(max(0.0, deadline - perf_counter()))
+
+        try:
+            is_calibration_management_enabled = BOOL()
+
+            if not WcsGetCalibrationManagementState(byref(is_calibration_management_enabled)):
+                raise DisplayMonitorException("Failed to get calibration management state")
+
+            InternalRefreshCalibration(0, 0)
+        except OSError as e:
+            raise DisplayMonitorException(f"Failed to change HDR state with error {e}")
+
+        for monitor, error in zip(monitors, errors):
+            if error is None:
+                # Bits per color channel and the encoding change along with the HDR state
+                monitor.invalidate_color_info(get_monitor_color_info)
+
+    return errors
+
+
+def set_hdr_state_for_monitor(
+    enabled: bool, monitor: DisplayMonitor, settle_seconds: float = HDR_SETTLE_SECONDS
+):
+    error: DisplayMonitorException | None = set_hdr_state_for_monitors(
+        enabled, [monitor], settle_seconds
+    )[0]
+
+    if error is not None:
+        raise error
 
 
 def get_primary_monitor(monitors: list[DisplayMonitor]) -> DisplayMonitor:
@@ -160,10 +334,25 @@ def get_primary_monitor(monitors: list[DisplayMonitor]) -> DisplayMonitor:
     raise PrimaryMonitorException("Primary monitor not found")
 
 
-def get_all_display_monitors() -> list[DisplayMonitor]:
-    display_adapters: list[DisplayAdapter] = get_all_display_adapters()
-    connected_monitors: list[DisplayMonitor] = []
+def get_topology_fingerprint(monitors: list[DisplayMonitor]) -> str:
+    # Identifies a set of monitors by their device names and display config targets, so that
+    # decisions derived from their modes can be reused for as long as the same monitors stay
+    # connected to the same outputs. Only what enumeration already looked up is hashed, never the
+    # available modes, which cost a call per mode to list.
+    fingerprint = sha1()
+
+    for monitor in monitors:
+        fingerprint.update(
+            f"{monitor.identifier()}|{monitor.name}|{monitor.adapter.display_name}|"
+            f"{monitor.adapter_id_high}:{monitor.adapter_id_low}:{monitor.target_id};".encode()
+        )
+
+    return fingerprint.hexdigest()
 
+
+def query_display_config() -> tuple[
+    int, list[DISPLAYCONFIG_PATH_INFO], list[DISPLAYCONFIG_MODE_INFO]
+]:
     # Get display config buffer sizes
     number_of_active_display_paths = c_ulong()
     number_of_active_display_modes = c_ulong()
@@ -175,6 +364,10 @@ def get_all_display_monitors() -> list[DisplayMonitor]:
             byref(number_of_active_display_modes),
         )
 
+        # Transient failures are left to the caller to retry
+        if config_buffers_result in TRANSIENT_DISPLAY_CONFIG_RESULTS:
+            return config_buffers_result, [], []
+
         # We don't want to continue if we don't know the buffer sizes
         if config_buffers_result != ERROR_SUCCESS:
             raise DisplayMonitorException(
@@ -201,23 +394,128 @@ def get_all_display_monitors() -> list[DisplayMonitor]:
             None,
         )
 
-        # We don't want to continue if we don't know the display config
-        if display_config_result != ERROR_SUCCESS:
-            raise DisplayMonitorException(
-                f"Failed to get display config with result {display_config_result}"
-            )
-
     except OSError as e:
         raise DisplayMonitorException(f"Failed to get display config with error {e}")
 
-    # For every path we retrieve, we identify the target (a monitor) and the source (a display adapter), and pair
-    # them together to create what we call a DisplayMonitor object
-    for i in range(number_of_active_display_paths.value):
-        path: DISPLAYCONFIG_PATH_INFO = paths[i]
+    # Cached names are dropped as soon as the topology they were looked up in is gone
+    if display_config_result == ERROR_SUCCESS:
+        device_info_cache.validate(
+            paths[: number_of_active_display_paths.value],
+            modes[: number_of_active_display_modes.value],
+        )
+
+    # The query reports how many entries it actually filled in
+    return (
+        display_config_result,
+        paths[: number_of_active_display_paths.value],
+        modes[: number_of_active_display_modes.value],
+    )
+
+
+def get_display_config_fingerprint(retry_policy: RetryPolicy | None = None) -> str:
+    # Hashes the raw paths and modes of the active display config, which change whenever a display
+    # is added, removed, rearranged or switched to a different mode
+    display_config_result, paths, modes = run_with_retry(
+        "QueryDisplayConfig",
+        query_display_config,
+        lambda query: query[0] in TRANSIENT_DISPLAY_CONFIG_RESULTS,
+        retry_policy,
+    )
+
+    if display_config_result != ERROR_SUCCESS:
+        raise DisplayMonitorException(
+            f"Failed to get display config with result {display_config_result}"
+        )
+
+    fingerprint = sha1()
+
+    for info in [*paths, *modes]:
+        fingerprint.update(bytes(info))
+
+    return fingerprint.hexdigest()
+
+
+def display_mode_from_rational(
+    width: int, height: int, refresh_rate: DISPLAYCONFIG_RATIONAL
+) -> DisplayMode | None:
+    if refresh_rate.numerator == 0 or refresh_rate.denominator == 0:
+        return None
+
+    rate: float = refresh_rate.numerator / refresh_rate.denominator
+
+    # Windows lists fractional rates by their whole part (59.94 as 59), but rounds rates that are
+    # only off by timing inaccuracies (143.998 as 144)
+    refresh: int = round(rate) if abs(rate - round(rate)) < 0.01 else int(rate)
+
+    return DisplayMode(width, height, refresh, rate)
+
 
-        for j in range(number_of_active_display_modes.value):
-            mode_info: DISPLAYCONFIG_MODE_INFO = modes[j]
+def _get_active_mode_from_display_config(
+    path: DISPLAYCONFIG_PATH_INFO, modes: list[DISPLAYCONFIG_MODE_INFO]
+) -> DisplayMode | None:
+    source_index: int = path.sourceInfo.dummyUnion.modeInfoIdx
+    target_index: int = path.targetInfo.dummyUnion.modeInfoIdx
 
+    if (
+        source_index == DISPLAYCONFIG_PATH_MODE_IDX_INVALID
+        or source_index >= len(modes)
+        or modes[source_index].infoType
+        != DISPLAYCONFIG_MODE_INFO_TYPE.DISPLAYCONFIG_MODE_INFO_TYPE_SOURCE
+    ):
+        return None
+
+    source_mode = modes[source_index].dummyUnion.sourceMode
+    # The refresh rate the path asks for, unless the target reports the timing it actually runs at
+    refresh_rate: DISPLAYCONFIG_RATIONAL = path.targetInfo.rational
+
+    if (
+        target_index != DISPLAYCONFIG_PATH_MODE_IDX_INVALID
+        and target_index < len(modes)
+        and modes[target_index].infoType
+        == DISPLAYCONFIG_MODE_INFO_TYPE.DISPLAYCONFIG_MODE_INFO_TYPE_TARGET
+    ):
+        refresh_rate = modes[target_index].dummyUnion.targetMode.targetVideoSignalInfo.vSyncFreq
+
+    return display_mode_from_rational(source_mode.width, source_mode.height, refresh_rate)
+
+
+def get_all_display_monitors(
+    retry_policy: RetryPolicy | None = None,
+    include_modes: bool = True,
+    legacy_active_modes: bool = False,
+) -> list[DisplayMonitor]:
+    with measure_phase("enumerate", "all"):
+        return _get_all_display_monitors(retry_policy, include_modes, legacy_active_modes)
+
+
+def _get_all_display_monitors(
+    retry_policy: RetryPolicy | None, include_modes: bool, legacy_active_modes: bool
+) -> list[DisplayMonitor]:
+    # Without the available modes, enumeration costs a handful of calls per adapter instead of one
+    # per mode the driver reports. Active modes are taken from the display config queried below,
+    # rather than asking for the current settings of every adapter, attached or not.
+    display_adapters: list[DisplayAdapter] = get_all_display_adapters(
+        include_modes, legacy_active_modes
+    )
+    connected_monitors: list[DisplayMonitor] = []
+
+    display_config_result, paths, modes = run_with_retry(
+        "QueryDisplayConfig",
+        query_display_config,
+        lambda query: query[0] in TRANSIENT_DISPLAY_CONFIG_RESULTS,
+        retry_policy,
+    )
+
+    # We don't want to continue if we don't know the display config
+    if display_config_result != ERROR_SUCCESS:
+        raise DisplayMonitorException(
+            f"Failed to get display config with result {display_config_result}"
+        )
+
+    # For every path we retrieve, we identify the target (a monitor) and the source (a display adapter), and pair
+    # them together to create what we call a DisplayMonitor object
+    for path in paths:
+        for mode_info in modes:
             if mode_info.id != path.targetInfo.id:
                 continue
 
@@ -230,8 +528,21 @@ def get_all_display_monitors() -> list[DisplayMonitor]:
                     if adapter.identifier == monitor_source_name:
                         monitor.adapter = adapter
 
+                if not legacy_active_modes:
+                    monitor.adapter.active_mode = _get_active_mode_from_display_config(path, modes)
+
+                # Paths without a usable source mode fall back to the current settings
+                if monitor.adapter.active_mode is None and monitor.adapter.identifier != "":
+                    try:
+                        monitor.adapter.active_mode = get_active_display_mode(
+                            monitor.adapter.identifier
+                        )
+                    except DisplayAdapterException:
+                        pass
+
                 monitor.mode_info = mode_info
-                monitor.color_info = get_monitor_color_info(mode_info)
+                # Only looked up once HDR is asked about, which most mode changes never do
+                monitor.invalidate_color_info(get_monitor_color_info)
 
                 connected_monitors.append(monitor)
 
@@ -0,0 +1,148 @@
+"""Long-lived model of the connected monitors that is kept up to date incrementally."""
+
+from __future__ import annotations
+
+from resolution_switcher.custom_types import (
+    DisplayAdapterException,
+    DisplayMode,
+    DisplayMonitor,
+    DisplayMonitorException,
+)
+from resolution_switcher.display_adapters import (
+    get_active_display_mode,
+    iter_display_modes,
+    set_display_mode_for_device,
+    set_display_modes_for_devices,
+    wait_for_display_mode,
+)
+from resolution_switcher.display_monitors import (
+    get_all_display_monitors,
+    get_display_config_fingerprint,
+    get_monitor_color_info,
+    get_primary_monitor,
+    set_hdr_state_for_monitor,
+    set_hdr_state_for_monitors,
+)
+from resolution_switcher.locking import display_change_lock
+from resolution_switcher.retry import RetryPolicy
+
+# How long the session waits for its own change to show before taking the new fingerprint
+FINGERPRINT_SETTLE_TIMEOUT: float = 1.0
+
+
+class DisplaySession:
+    def __init__(self, retry_policy: RetryPolicy | None = None):
+        self.retry_policy: RetryPolicy | None = retry_policy
+        self.monitors: list[DisplayMonitor] = []
+        self.fingerprint: str = ""
+
+        self.refresh_all()
+
+    def refresh_all(self, fingerprint: str | None = None):
+        # The fingerprint is taken first, so that a change racing the enumeration is picked up by
+        # the next call to refresh_if_changed()
+        self.fingerprint = (
+            fingerprint
+            if fingerprint is not None
+            else get_display_config_fingerprint(self.retry_policy)
+        )
+        # Modes are listed for one adapter at a time, when they are asked for
+        self.monitors = get_all_display_monitors(self.retry_policy, False)
+
+    def refresh_if_changed(self) -> bool:
+        fingerprint: str = get_display_config_fingerprint(self.retry_policy)
+
+        if fingerprint == self.fingerprint:
+            return False
+
+        self.refresh_all(fingerprint)
+        return True
+
+    def refresh(self, monitor: DisplayMonitor):
+        monitor.adapter.active_mode = get_active_display_mode(monitor.identifier())
+
+        if monitor.mode_info is not None:
+            monitor.color_info = get_monitor_color_info(monitor.mode_info)
+
+    def available_modes(self, monitor: DisplayMonitor) -> list[DisplayMode]:
+        if monitor.adapter.available_modes is None:
+            monitor.adapter.available_modes = list(iter_display_modes(monitor.identifier()))
+
+        return monitor.adapter.available_modes
+
+    def find(self, identifier: str) -> DisplayMonitor:
+        for monitor in self.monitors:
+            if monitor.identifier() == identifier:
+                return monitor
+
+        raise DisplayMonitorException(f"Device {identifier} not found")
+
+    def primary(self) -> DisplayMonitor:
+        return get_primary_monitor(self.monitors)
+
+    def _refresh_if_stale(self, monitors: list[DisplayMonitor]) -> list[DisplayMonitor]:
+        # Changes made outside the session since it last looked are picked up before one of its
+        # own, so that the fingerprint taken afterwards only accounts for ours. The monitors to
+        # change are returned from the model as it is now.
+        fingerprint: str = get_display_config_fingerprint(self.retry_policy)
+
+        if fingerprint == self.fingerprint:
+            return monitors
+
+        self.refresh_all(fingerprint)
+
+        return [self.find(monitor.identifier()) for monitor in monitors]
+
+    def _take_fingerprint(self, changes: list[tuple[DisplayMonitor, DisplayMode]]):
+        # Taken over only once every device reports its new mode, as a fingerprint read while a
+        # change is still settling would later look like somebody else's change. A change that
+        # does not settle in time keeps the fingerprint from before it, so the next check refreshes
+        # the model.
+        try:
+            for monitor, display_mode in changes:
+                wait_for_display_mode(
+                    display_mode, monitor.identifier(), FINGERPRINT_SETTLE_TIMEOUT, 0.01
+                )
+        except DisplayAdapterException:
+            return
+
+        self.fingerprint = get_display_config_fingerprint(self.retry_policy)
+
+    def set_display_mode(
+        self, monitor: DisplayMonitor, display_mode: DisplayMode, temp: bool = False
+    ):
+        # Held from the check until the fingerprint is taken, so no other invocation changes the
+        # displays in between
+        with display_change_lock(f"mode:{monitor.identifier()}"):
+            (monitor,) = self._refresh_if_stale([monitor])
+
+            set_display_mode_for_device(display_mode, monitor.identifier(), temp, self.retry_policy)
+            monitor.adapter.active_mode = display_mode
+
+            self._take_fingerprint([(monitor, display_mode)])
+
+    def set_display_modes(self, changes: list[tuple[DisplayMonitor, DisplayMode]]):
+        identifiers: list[str] = [monitor.identifier() for monitor, _ in changes]
+
+        with display_change_lock("mode:" + ",".join(sorted(identifiers))):
+            monitors: list[DisplayMonitor] = self._refresh_if_stale([m for m, _ in changes])
+            changes = [(m, display_mode) for m, (_, display_mode) in zip(monitors, changes)]
+
+            set_display_modes_for_devices(
+                [(display_mode, monitor.identifier()) for monitor, display_mode in changes],
+                self.retry_policy,
+            )
+
+            for monitor, display_mode in changes:
+                monitor.adapter.active_mode = display_mode
+
+            self._take_fingerprint(changes)
+
+    def set_hdr_state(self, monitor: DisplayMonitor, enabled: bool):
+        # The monitor's color info is looked up again the next time it is used
+        set_hdr_state_for_monitor(enabled, monitor)
+
+    def set_hdr_states(
+        self, monitors: list[DisplayMonitor], enabled: bool
+    ) -> list[DisplayMonitorException | None]:
+        return set_hdr_state_for_monitors(enabled, monitors)
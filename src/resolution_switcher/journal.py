@@ -0,0 +1,471 @@
+"""Append-only journal of the mode and HDR changes made, from which they can be undone.
+
+Every change is a fixed-size record holding what the monitor was set to before and after it. Undoing
+changes appends records that mark them reverted, and recovering appends a checkpoint, so both only
+ever read the journal back from its end to the last checkpoint.
+"""
+
+from __future__ import annotations
+
+import atexit
+import os
+import struct
+import time
+import zlib
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator
+
+from resolution_switcher.custom_types import DisplayMode, JournalException
+from resolution_switcher.locking import LOCK_DIRECTORY, file_lock, make_directory
+
+JOURNAL_FILE: str = os.path.join(LOCK_DIRECTORY, "journal.bin")
+
+# Size past which the journal is rotated, keeping only what has not been undone yet
+JOURNAL_MAX_BYTES: int = 256 * 1024
+
+# Records are written as they happen, which survives the process crashing, and flushed to disk
+# once this many are pending or this long after the last flush, and when the process exits
+FSYNC_BATCH: int = 16
+FSYNC_INTERVAL: float = 1.0
+
+# Records read at a time while reading the journal back from its end
+READ_BATCH: int = 64
+
+MAGIC: bytes = b"RSJN"
+VERSION: int = 1
+
+# Magic, version and record size
+HEADER = struct.Struct("<4sII")
+
+# Sequence, sequence of the change a revert undoes, time, flags, monitor, mode before and after,
+# HDR state before and after (-1 if unknown) and result code, followed by a CRC32 of all of them
+RECORD = struct.Struct("<QQdH64sIIIIIIbbi")
+CHECKSUM = struct.Struct("<I")
+RECORD_SIZE: int = RECORD.size + CHECKSUM.size
+
+MODE_CHANGE: int = 0x1
+HDR_CHANGE: int = 0x2
+TEMP: int = 0x4
+REVERT: int = 0x8
+CHECKPOINT: int = 0x10
+FAILED: int = 0x20
+# The call was abandoned before it returned, so the change may or may not have been made
+UNCERTAIN: int = 0x40
+
+
+class JournalEntry:
+    def __init__(
+        self,
+        flags: int,
+        monitor: str = "",
+        before_mode: DisplayMode | None = None,
+        after_mode: DisplayMode | None = None,
+        hdr_before: bool | None = None,
+        hdr_after: bool | None = None,
+        result: int = 0,
+        reverts: int = 0,
+    ):
+        # Both assigned when the entry is appended
+        self.sequence: int = 0
+        self.timestamp: float = 0.0
+        self.flags: int = flags
+        self.monitor: str = monitor
+        self.before_mode: DisplayMode | None = before_mode
+        self.after_mode: DisplayMode | None = after_mode
+        self.hdr_before: bool | None = hdr_before
+        self.hdr_after: bool | None = hdr_after
+        # Win32 result code of a failed change, 0 if the call did not return one
+        self.result: int = result
+        # Sequence of the change that a revert undid, 0 for anything else
+        self.reverts: int = reverts
+
+    def is_change(self) -> bool:
+        return self.flags & (MODE_CHANGE | HDR_CHANGE) != 0 and self.flags & REVERT == 0
+
+    def is_revertible(self) -> bool:
+        if not self.is_change() or self.flags & FAILED:
+            return False
+
+        if self.flags & MODE_CHANGE:
+            return self.before_mode is not None
+
+        return self.hdr_before is not None
+
+    def revert(self) -> JournalEntry:
+        return JournalEntry(
+            (self.flags & (MODE_CHANGE | HDR_CHANGE)) | REVERT,
+            self.monitor,
+            self.after_mode,
+            self.before_mode,
+            self.hdr_after,
+            self.hdr_before,
+            reverts=self.sequence,
+        )
+
+    def __str__(self) -> str:
+        if self.flags & MODE_CHANGE:
+            return f"{self.monitor} from {self.before_mode} to {self.after_mode}"
+
+        return f"{self.monitor} HDR from {_describe_hdr(self.hdr_before)} to " + _describe_hdr(
+            self.hdr_after
+        )
+
+
+def _describe_hdr(state: bool | None) -> str:
+    return "unknown" if state is None else "on" if state else "off"
+
+
+def _pack_mode(mode: DisplayMode | None) -> tuple[int, int, int]:
+    return (mode.width, mode.height, mode.refresh) if mode is not None else (0, 0, 0)
+
+
+def _unpack_mode(width: int, height: int, refresh: int) -> DisplayMode | None:
+    return DisplayMode(width, height, refresh) if width != 0 else None
+
+
+def _pack_hdr(state: bool | None) -> int:
+    return -1 if state is None else int(state)
+
+
+def _pack(entry: JournalEntry) -> bytes:
+    monitor: bytes = entry.monitor.encode("utf-8")
+
+    if len(monitor) > 64:
+        raise JournalException(f"'{entry.monitor}' does not fit in a journal record")
+
+    record: bytes = RECORD.pack(
+        entry.sequence,
+        entry.reverts,
+        entry.timestamp,
+        entry.flags,
+        monitor,
+        *_pack_mode(entry.before_mode),
+        *_pack_mode(entry.after_mode),
+        _pack_hdr(entry.hdr_before),
+        _pack_hdr(entry.hdr_after),
+        entry.result,
+    )
+
+    return record + CHECKSUM.pack(zlib.crc32(record))
+
+
+def _unpack(data: bytes) -> JournalEntry | None:
+    # None for a record that was torn by a crash or otherwise corrupted
+    record: bytes = data[: RECORD.size]
+
+    if CHECKSUM.unpack_from(data, RECORD.size)[0] != zlib.crc32(record):
+        return None
+
+    (
+        sequence,
+        reverts,
+        timestamp,
+        flags,
+        monitor,
+        before_width,
+        before_height,
+        before_refresh,
+        after_width,
+        after_height,
+        after_refresh,
+        hdr_before,
+        hdr_after,
+        result,
+    ) = RECORD.unpack(record)
+
+    entry = JournalEntry(
+        flags,
+        monitor.rstrip(b"\0").decode("utf-8", errors="replace"),
+        _unpack_mode(before_width, before_height, before_refresh),
+        _unpack_mode(after_width, after_height, after_refresh),
+        None if hdr_before < 0 else bool(hdr_before),
+        None if hdr_after < 0 else bool(hdr_after),
+        result,
+        reverts,
+    )
+    entry.sequence = sequence
+    entry.timestamp = timestamp
+
+    return entry
+
+
+def _prepare(file: BinaryIO, path: str) -> int:
+    # Size of the journal's whole records, writing the header of a new journal
+    size: int = os.fstat(file.fileno()).st_size
+
+    if size == 0:
+        file.write(HEADER.pack(MAGIC, VERSION, RECORD_SIZE))
+        file.flush()
+        return HEADER.size
+
+    file.seek(0)
+    header: bytes = file.read(HEADER.size)
+
+    if len(header) < HEADER.size or HEADER.unpack(header) != (MAGIC, VERSION, RECORD_SIZE):
+        raise JournalException(f"{path} is not a journal of this version")
+
+    whole: int = HEADER.size + (size - HEADER.size) // RECORD_SIZE * RECORD_SIZE
+
+    # What is left of a record torn by a crash would misalign every record appended after it
+    if whole != size:
+        file.truncate(whole)
+
+    return whole
+
+
+def _read_backward(file: BinaryIO, size: int) -> Iterator[JournalEntry]:
+    end: int = size
+
+    while end > HEADER.size:
+        start: int = max(HEADER.size, end - READ_BATCH * RECORD_SIZE)
+        file.seek(start)
+        data: bytes = file.read(end - start)
+
+        for offset in range(len(data) - RECORD_SIZE, -1, -RECORD_SIZE):
+            entry: JournalEntry | None = _unpack(data[offset : offset + RECORD_SIZE])
+
+            if entry is not None:
+                yield entry
+
+        end = start
+
+
+def _pending(file: BinaryIO, size: int, count: int | None) -> tuple[list[JournalEntry], int]:
+    # Changes not undone yet since the last checkpoint, newest first, and the last sequence
+    pending: list[JournalEntry] = []
+    reverted: set[int] = set()
+    last_sequence: int = 0
+
+    for entry in _read_backward(file, size):
+        last_sequence = max(last_sequence, entry.sequence)
+
+        if entry.flags & CHECKPOINT or (count is not None and len(pending) >= count):
+            break
+
+        if entry.flags & REVERT:
+            reverted.add(entry.reverts)
+        elif entry.sequence not in reverted and entry.is_revertible():
+            pending.append(entry)
+
+    return pending, last_sequence
+
+
+def _last_sequence(file: BinaryIO, size: int) -> int:
+    return next((entry.sequence for entry in _read_backward(file, size)), 0)
+
+
+def _compact(pending: list[JournalEntry]) -> list[JournalEntry]:
+    # One change per monitor and kind, from the state before the oldest pending change to the one
+    # after the newest, which undoes to the same state as undoing every one of them
+    compacted: dict[tuple[str, int], JournalEntry] = {}
+
+    for entry in pending:
+        key: tuple[str, int] = (entry.monitor, entry.flags & (MODE_CHANGE | HDR_CHANGE))
+        newest: JournalEntry | None = compacted.get(key)
+
+        if newest is None:
+            compacted[key] = JournalEntry(
+                entry.flags,
+                entry.monitor,
+                entry.before_mode,
+                entry.after_mode,
+                entry.hdr_before,
+                entry.hdr_after,
+            )
+        else:
+            newest.before_mode = entry.before_mode
+            newest.hdr_before = entry.hdr_before
+
+    # Changes that were undone by later ones need nothing undone
+    return [
+        entry
+        for entry in reversed(compacted.values())
+        if entry.before_mode != entry.after_mode or entry.hdr_before != entry.hdr_after
+    ]
+
+
+_path: str | None = None
+_suspended: int = 0
+_unsynced: int = 0
+_last_sync: float = 0.0
+
+
+def _sync(file: BinaryIO, records: int):
+    global _unsynced, _last_sync
+
+    _unsynced += records
+
+    if _unsynced >= FSYNC_BATCH or time.monotonic() - _last_sync >= FSYNC_INTERVAL:
+        os.fsync(file.fileno())
+        _unsynced = 0
+        _last_sync = time.monotonic()
+
+
+def _rotate(path: str, carried: list[JournalEntry], entries: list[JournalEntry], last: int):
+    # The old journal is kept next to the new one, which starts from a checkpoint followed by the
+    # changes still to be undone
+    os.replace(path, f"{path}.1")
+
+    records: list[JournalEntry] = [JournalEntry(CHECKPOINT), *carried, *entries]
+
+    for offset, entry in enumerate(records):
+        entry.sequence = last + 1 + offset
+        entry.timestamp = time.time()
+
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, RECORD_SIZE))
+        file.write(b"".join(_pack(entry) for entry in records))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def append_entries(entries: list[JournalEntry], path: str | None = None):
+    path = path if path is not None else _path
+
+    if path is None or len(entries) == 0:
+        return
+
+    directory: str = os.path.dirname(path)
+
+    if directory != "":
+        make_directory(directory)
+
+    try:
+        with file_lock(f"{path}.lock"):
+            with open(path, "a+b") as file:
+                size: int = _prepare(file, path)
+
+                if size == HEADER.size or size + len(entries) * RECORD_SIZE <= JOURNAL_MAX_BYTES:
+                    last: int = _last_sequence(file, size)
+
+                    for offset, entry in enumerate(entries):
+                        entry.sequence = last + 1 + offset
+                        entry.timestamp = time.time()
+
+                    # A single write, so that a batch of changes is never split by a crash
+                    file.write(b"".join(_pack(entry) for entry in entries))
+                    file.flush()
+                    _sync(file, len(entries))
+                    return
+
+                pending, last = _pending(file, size, None)
+
+            _rotate(path, _compact(pending), entries, last)
+    except OSError as e:
+        raise JournalException(f"Failed to write to journal {path}: {e}")
+
+
+def read_pending(path: str = JOURNAL_FILE, count: int | None = None) -> list[JournalEntry]:
+    try:
+        with file_lock(f"{path}.lock"):
+            with open(path, "rb") as file:
+                size: int = os.fstat(file.fileno()).st_size
+
+                if size < HEADER.size:
+                    return []
+
+                header: bytes = file.read(HEADER.size)
+
+                if HEADER.unpack(header) != (MAGIC, VERSION, RECORD_SIZE):
+                    raise JournalException(f"{path} is not a journal of this version")
+
+                whole: int = HEADER.size + (size - HEADER.size) // RECORD_SIZE * RECORD_SIZE
+
+                return _pending(file, whole, count)[0]
+    except FileNotFoundError:
+        return []
+    except OSError as e:
+        raise JournalException(f"Failed to read journal {path}: {e}")
+
+
+def plan_undo(
+    entries: list[JournalEntry],
+) -> tuple[list[tuple[DisplayMode, str]], dict[bool, list[str]]]:
+    # The mode and HDR state to put every monitor back to, which is the one from before the oldest
+    # of its changes being undone. Entries are newest first.
+    modes: dict[str, DisplayMode] = {}
+    hdr_states: dict[str, bool] = {}
+
+    for entry in entries:
+        if entry.flags & MODE_CHANGE and entry.before_mode is not None:
+            modes[entry.monitor] = entry.before_mode
+        elif entry.flags & HDR_CHANGE and entry.hdr_before is not None:
+            hdr_states[entry.monitor] = entry.hdr_before
+
+    hdr_changes: dict[bool, list[str]] = {}
+
+    for monitor, enabled in sorted(hdr_states.items()):
+        hdr_changes.setdefault(enabled, []).append(monitor)
+
+    return [(mode, monitor) for monitor, mode in sorted(modes.items())], hdr_changes
+
+
+def sync_journal():
+    global _unsynced
+
+    if _path is None or _unsynced == 0:
+        return
+
+    try:
+        with open(_path, "ab") as file:
+            os.fsync(file.fileno())
+    except OSError:
+        pass
+
+    _unsynced = 0
+
+
+def set_journal(path: str | None):
+    global _path, _last_sync
+
+    if _path is None and path is not None:
+        atexit.register(sync_journal)
+
+    _path = path
+    _last_sync = time.monotonic()
+
+
+def is_journaling() -> bool:
+    return _path is not None and _suspended == 0
+
+
+@contextmanager
+def suspended_journal() -> Iterator[None]:
+    # Undoing changes records reverts instead of new changes
+    global _suspended
+
+    _suspended += 1
+
+    try:
+        yield
+    finally:
+        _suspended -= 1
+
+
+def record_mode_changes(
+    changes: list[tuple[str, DisplayMode | None, DisplayMode]],
+    temp: bool,
+    outcome: int = 0,
+    result: int = 0,
+):
+    # The outcome is 0 for a change that was made, FAILED or UNCERTAIN
+    flags: int = MODE_CHANGE | (TEMP if temp else 0) | outcome
+
+    append_entries(
+        [
+            JournalEntry(flags, monitor, before, after, result=result)
+            for monitor, before, after in changes
+        ]
+    )
+
+
+def record_hdr_changes(changes: list[tuple[str, bool | None, bool, int, int]]):
+    # Monitor, HDR state before and after, outcome and result code of every change
+    append_entries(
+        [
+            JournalEntry(
+                HDR_CHANGE | outcome, monitor, hdr_before=before, hdr_after=after, result=result
+            )
+            for monitor, before, after, outcome, result in changes
+        ]
+    )
@@ -0,0 +1,205 @@
+"""Machine-wide serialization of display changes, collapsing queued requests to the latest one."""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import IO, Iterator
+
+from resolution_switcher.custom_types import SupersededException
+
+
+def _machine_directory() -> str:
+    # %TEMP% is per user on Windows, while %ProgramData% is the same for every user, session and
+    # service
+    if sys.platform == "win32":
+        return os.path.join(os.environ.get("ProgramData", "C:\\ProgramData"), "ResolutionSwitcher")
+
+    return os.path.join(tempfile.gettempdir(), "ResolutionSwitcher")
+
+
+# Shared by every process on the machine, so that concurrent invocations queue behind each other
+LOCK_DIRECTORY: str = _machine_directory()
+
+# Full access for authenticated users, the system and administrators, inherited by every file in
+# the directory. Without it, files one user creates in %ProgramData% are read-only for the others.
+SHARED_DIRECTORY_SDDL: str = "D:(A;OICI;FA;;;AU)(A;OICI;FA;;;SY)(A;OICI;FA;;;BA)"
+
+# The latest ticket of every key is kept after its request is done, so that requests queued before
+# it still see that they were superseded. Only the keys that were requested longest ago are pruned.
+MAX_LATEST_TICKETS: int = 256
+
+# Held while a display change is in flight
+CHANGE_LOCK_FILE: str = "display-change.lock"
+
+# Held briefly while a request registers itself as the latest one for its key
+REQUESTS_LOCK_FILE: str = "display-requests.lock"
+REQUESTS_FILE: str = "display-requests.json"
+
+_held = threading.local()
+
+
+def _lock_file(file: IO[bytes]):
+    if sys.platform == "win32":
+        import msvcrt
+
+        # LK_LOCK gives up after ten attempts, so keep trying until the current holder is done
+        while True:
+            try:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue
+    else:
+        import fcntl
+
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+
+def _unlock_file(file: IO[bytes]):
+    if sys.platform == "win32":
+        import msvcrt
+
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+def _make_shared_directory(path: str):
+    if sys.platform != "win32" or os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+        return
+
+    import ctypes
+    from ctypes import wintypes
+
+    class SECURITY_ATTRIBUTES(ctypes.Structure):
+        _fields_ = [
+            ("nLength", wintypes.DWORD),
+            ("lpSecurityDescriptor", wintypes.LPVOID),
+            ("bInheritHandle", wintypes.BOOL),
+        ]
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    advapi32 = ctypes.WinDLL("advapi32", use_last_error=True)
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    descriptor = wintypes.LPVOID()
+
+    if not advapi32.ConvertStringSecurityDescriptorToSecurityDescriptorW(
+        SHARED_DIRECTORY_SDDL, 1, ctypes.byref(descriptor), None
+    ):
+        raise ctypes.WinError(ctypes.get_last_error())
+
+    try:
+        attributes = SECURITY_ATTRIBUTES(ctypes.sizeof(SECURITY_ATTRIBUTES), descriptor, False)
+
+        # Another process may have created it in the meantime
+        if not kernel32.CreateDirectoryW(path, ctypes.byref(attributes)) and not os.path.isdir(
+            path
+        ):
+            raise ctypes.WinError(ctypes.get_last_error())
+    finally:
+        kernel32.LocalFree(descriptor)
+
+
+def make_directory(directory: str):
+    # The lock directory is shared with every other user of the machine, anything else is not
+    if os.path.normcase(os.path.abspath(directory)) == os.path.normcase(LOCK_DIRECTORY):
+        _make_shared_directory(directory)
+    else:
+        os.makedirs(directory, exist_ok=True)
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    directory: str = os.path.dirname(path)
+
+    if directory != "":
+        make_directory(directory)
+
+    with open(path, "a+b") as file:
+        _lock_file(file)
+
+        try:
+            yield
+        finally:
+            _unlock_file(file)
+
+
+def _read_requests(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as requests_file:
+            requests = json.load(requests_file)
+
+        return requests if isinstance(requests, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _take_ticket(key: str, directory: str) -> int:
+    requests_path: str = os.path.join(directory, REQUESTS_FILE)
+
+    with file_lock(os.path.join(directory, REQUESTS_LOCK_FILE)):
+        requests: dict = _read_requests(requests_path)
+        ticket: int = int(requests.get("counter", 0)) + 1
+
+        latest: dict = requests.setdefault("latest", {})
+
+        # Tickets only grow, so this is the high-water mark of the key
+        requests["counter"] = ticket
+        latest.pop(key, None)
+        latest[key] = ticket
+
+        for stale in list(latest)[: max(0, len(latest) - MAX_LATEST_TICKETS)]:
+            del latest[stale]
+
+        with open(requests_path, "w", encoding="utf-8") as requests_file:
+            json.dump(requests, requests_file)
+
+    return ticket
+
+
+def _latest_ticket(key: str, ticket: int, directory: str) -> int:
+    with file_lock(os.path.join(directory, REQUESTS_LOCK_FILE)):
+        requests: dict = _read_requests(os.path.join(directory, REQUESTS_FILE))
+
+    # A key is only missing once MAX_LATEST_TICKETS other keys were requested after it
+    return int(requests.get("latest", {}).get(key, ticket))
+
+
+@contextmanager
+def display_change_lock(key: str, directory: str | None = None) -> Iterator[None]:
+    # Nested changes made while this process already holds the lock run as part of the outer one
+    if getattr(_held, "depth", 0) > 0:
+        _held.depth += 1
+
+        try:
+            yield
+        finally:
+            _held.depth -= 1
+
+        return
+
+    lock_directory: str = directory if directory is not None else LOCK_DIRECTORY
+    ticket: int = _take_ticket(key, lock_directory)
+
+    with file_lock(os.path.join(lock_directory, CHANGE_LOCK_FILE)):
+        # Requests queued behind an in-flight change collapse into the most recent one for the key
+        if _latest_ticket(key, ticket, lock_directory) != ticket:
+            raise SupersededException(f"Request for {key} was superseded by a newer request")
+
+        _held.depth = 1
+
+        try:
+            yield
+        finally:
+            _held.depth = 0
@@ -0,0 +1,209 @@
+"""Switch latency and failure metrics, exported in the Prometheus textfile collector format."""
+
+from __future__ import annotations
+
+import os
+import re
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Iterator
+
+from resolution_switcher.locking import file_lock
+from resolution_switcher.windows_types import (
+    DISP_CHANGE_BADDUALVIEW,
+    DISP_CHANGE_BADFLAGS,
+    DISP_CHANGE_BADMODE,
+    DISP_CHANGE_BADPARAM,
+    DISP_CHANGE_FAILED,
+    DISP_CHANGE_NOTUPDATED,
+    DISP_CHANGE_RESTART,
+    DISP_CHANGE_SUCCESSFUL,
+    win32_call_counts,
+)
+
+PHASE_DURATION: str = "resolution_switcher_phase_duration_seconds"
+HDR_SETTLE_DURATION: str = "resolution_switcher_hdr_settle_seconds"
+RESULTS: str = "resolution_switcher_results_total"
+WIN32_CALLS: str = "resolution_switcher_win32_calls_total"
+CACHE_LOOKUPS: str = "resolution_switcher_cache_lookups_total"
+
+# Name, type and help text of every metric family, in the order they are written
+FAMILIES: list[tuple[str, str, str]] = [
+    (PHASE_DURATION, "histogram", "Time spent enumerating displays or applying a change"),
+    (
+        HDR_SETTLE_DURATION,
+        "histogram",
+        "Time until a display reported the requested HDR state after it was changed",
+    ),
+    (RESULTS, "counter", "Result codes returned by display changes"),
+    (WIN32_CALLS, "counter", "Win32 calls made while enumerating displays or applying a change"),
+    (CACHE_LOOKUPS, "counter", "Lookups served from (hit) or missing in (miss) a cache"),
+]
+
+LE_LABEL = re.compile(r',le="([^"]*)"')
+
+DURATION_BUCKETS: list[float] = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+DISP_CHANGE_RESULT_NAMES: dict[int, str] = {
+    DISP_CHANGE_SUCCESSFUL: "DISP_CHANGE_SUCCESSFUL",
+    DISP_CHANGE_RESTART: "DISP_CHANGE_RESTART",
+    DISP_CHANGE_FAILED: "DISP_CHANGE_FAILED",
+    DISP_CHANGE_BADMODE: "DISP_CHANGE_BADMODE",
+    DISP_CHANGE_NOTUPDATED: "DISP_CHANGE_NOTUPDATED",
+    DISP_CHANGE_BADFLAGS: "DISP_CHANGE_BADFLAGS",
+    DISP_CHANGE_BADPARAM: "DISP_CHANGE_BADPARAM",
+    DISP_CHANGE_BADDUALVIEW: "DISP_CHANGE_BADDUALVIEW",
+}
+
+# Samples recorded by this process and not yet written, keyed by their exposition line prefix.
+# Sums of durations are not whole numbers, so they are kept as floats rather than in a Counter.
+_samples: dict[str, float] = {}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _sample_key(name: str, labels: list[tuple[str, str]]) -> str:
+    if len(labels) == 0:
+        return name
+
+    return name + "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _add(samples: dict[str, float], key: str, value: float):
+    samples[key] = samples.get(key, 0) + value
+
+
+def _observe(name: str, labels: list[tuple[str, str]], value: float):
+    # Every bucket is written, even empty ones, so that the histogram is complete
+    for bucket in DURATION_BUCKETS:
+        _add(
+            _samples,
+            _sample_key(f"{name}_bucket", labels + [("le", str(bucket))]),
+            1 if value <= bucket else 0,
+        )
+
+    _add(_samples, _sample_key(f"{name}_bucket", labels + [("le", "+Inf")]), 1)
+    _add(_samples, _sample_key(f"{name}_sum", labels), value)
+    _add(_samples, _sample_key(f"{name}_count", labels), 1)
+
+
+def count_result(phase: str, monitor: str, result: str):
+    _add(
+        _samples,
+        _sample_key(RESULTS, [("phase", phase), ("monitor", monitor), ("result", result)]),
+        1,
+    )
+
+
+def count_cache_lookup(cache: str, result: str):
+    _add(_samples, _sample_key(CACHE_LOOKUPS, [("cache", cache), ("result", result)]), 1)
+
+
+def observe_hdr_settle(monitor: str, seconds: float):
+    _observe(HDR_SETTLE_DURATION, [("monitor", monitor)], seconds)
+
+
+@contextmanager
+def measure_phase(phase: str, monitor: str) -> Iterator[None]:
+    calls_before: Counter[str] = Counter(win32_call_counts)
+    start: float = perf_counter()
+
+    try:
+        yield
+    finally:
+        _observe(PHASE_DURATION, [("phase", phase), ("monitor", monitor)], perf_counter() - start)
+
+        for function, calls in (win32_call_counts - calls_before).items():
+            _add(
+                _samples,
+                _sample_key(
+                    WIN32_CALLS, [("phase", phase), ("monitor", monitor), ("function", function)]
+                ),
+                calls,
+            )
+
+
+def _read_textfile(path: str) -> dict[str, float]:
+    samples: dict[str, float] = {}
+
+    try:
+        with open(path, encoding="utf-8") as textfile:
+            for line in textfile:
+                line = line.strip()
+
+                if line == "" or line.startswith("#"):
+                    continue
+
+                key, _, value = line.rpartition(" ")
+
+                try:
+                    _add(samples, key, float(value))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+
+    return samples
+
+
+def _sort_key(key: str) -> tuple[str, float]:
+    # Histogram buckets are ordered by their upper bound rather than alphabetically
+    bound = LE_LABEL.search(key)
+
+    if bound is None:
+        return key, 0.0
+
+    return LE_LABEL.sub("", key), float(bound.group(1).replace("+Inf", "inf"))
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+def _family_of(key: str) -> str:
+    name: str = key.split("{", 1)[0]
+
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith(suffix) and name[: -len(suffix)] in (f[0] for f in FAMILIES):
+            return name[: -len(suffix)]
+
+    return name
+
+
+def write_textfile(path: str):
+    # Counters and histograms only ever add up, so the samples of every invocation are merged into
+    # whatever earlier invocations left in the file. The merge happens under a lock and the file
+    # is replaced atomically, so the collector never scrapes a partially written file.
+    with file_lock(f"{path}.lock"):
+        samples: dict[str, float] = _read_textfile(path)
+
+        for key, value in _samples.items():
+            _add(samples, key, value)
+
+        lines: list[str] = []
+        families: dict[str, list[str]] = {}
+
+        for key in sorted(samples, key=_sort_key):
+            families.setdefault(_family_of(key), []).append(f"{key} {_format_value(samples[key])}")
+
+        for name, metric_type, description in FAMILIES:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(families.pop(name, []))
+
+        for remaining in families.values():
+            lines.extend(remaining)
+
+        temporary_path: str = f"{path}.{os.getpid()}.tmp"
+
+        with open(temporary_path, "w", encoding="utf-8") as textfile:
+            textfile.write("\n".join(lines) + "\n")
+            textfile.flush()
+            os.fsync(textfile.fileno())
+
+        os.replace(temporary_path, path)
+
+    _samples.clear()
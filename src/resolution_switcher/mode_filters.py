@@ -0,0 +1,277 @@
+"""Selection of display modes by resolution, refresh rate and aspect ratio."""
+
+from __future__ import annotations
+
+from typing import Callable, Iterable
+
+from resolution_switcher.custom_types import DisplayMode
+
+# Relative difference between aspect ratios that is still considered a match, so that e.g.
+# 1366x768 counts as 16:9
+ASPECT_RATIO_TOLERANCE: float = 0.01
+
+SORT_KEYS: dict[str, Callable[[DisplayMode], tuple[int, ...]]] = {
+    "resolution": lambda mode: (mode.width * mode.height, mode.width, mode.refresh),
+    "refresh": lambda mode: (mode.refresh, mode.width * mode.height, mode.width),
+}
+
+
+class ModeFilter:
+    def __init__(
+        self,
+        min_refresh: int | None = None,
+        max_refresh: int | None = None,
+        aspect: tuple[int, int] | None = None,
+        min_width: int | None = None,
+        exact_width: int | None = None,
+        sort: str | None = None,
+        limit: int | None = None,
+    ):
+        self.min_refresh: int | None = min_refresh
+        self.max_refresh: int | None = max_refresh
+        self.aspect: tuple[int, int] | None = aspect
+        self.min_width: int | None = min_width
+        self.exact_width: int | None = exact_width
+        # One of SORT_KEYS, sorting from the largest value down, or None to keep the driver's order
+        self.sort: str | None = sort
+        self.limit: int | None = limit
+
+    def predicates(self) -> list[Callable[[DisplayMode], bool]]:
+        predicates: list[Callable[[DisplayMode], bool]] = []
+
+        if self.min_refresh is not None:
+            min_refresh: int = self.min_refresh
+            predicates.append(lambda mode: mode.refresh >= min_refresh)
+
+        if self.max_refresh is not None:
+            max_refresh: int = self.max_refresh
+            predicates.append(lambda mode: mode.refresh <= max_refresh)
+
+        if self.min_width is not None:
+            min_width: int = self.min_width
+            predicates.append(lambda mode: mode.width >= min_width)
+
+        if self.exact_width is not None:
+            exact_width: int = self.exact_width
+            predicates.append(lambda mode: mode.width == exact_width)
+
+        if self.aspect is not None:
+            aspect_width, aspect_height = self.aspect
+            predicates.append(
+                lambda mode: abs(mode.width * aspect_height - mode.height * aspect_width)
+                <= ASPECT_RATIO_TOLERANCE * mode.height * aspect_width
+            )
+
+        return predicates
+
+
+def parse_aspect_ratio(text: str) -> tuple[int, int]:
+    width, separator, height = text.partition(":")
+
+    if separator == "" or not width.strip().isdigit() or not height.strip().isdigit():
+        raise ValueError(f"Invalid aspect ratio '{text}', expected <width>:<height> (e.g. 16:9)")
+
+    if int(width) == 0 or int(height) == 0:
+        raise ValueError(f"Invalid aspect ratio '{text}'")
+
+    return int(width), int(height)
+
+
+def find_first_candidate(modes: Iterable[DisplayMode], candidates: list[DisplayMode]) -> int | None:
+    # Index of the first candidate the modes include, None if they include none. Nothing can beat
+    # the first candidate, so streamed modes stop being enumerated as soon as it turns up.
+    indices: dict[DisplayMode, int] = {}
+
+    for index, candidate in enumerate(candidates):
+        indices.setdefault(candidate, index)
+
+    if len(indices) == 0:
+        return None
+
+    best: int | None = None
+
+    for mode in modes:
+        index: int | None = indices.get(mode)
+
+        if index is not None and (best is None or index < best):
+            best = index
+
+            if best == 0:
+                break
+
+    return best
+
+
+def filter_display_modes(
+    modes: Iterable[DisplayMode], mode_filter: ModeFilter
+) -> list[DisplayMode]:
+    # All predicates are evaluated in a single pass over the modes, and duplicates are dropped
+    # before they get formatted
+    predicates = mode_filter.predicates()
+    seen: set[DisplayMode] = set()
+    matches: list[DisplayMode] = []
+
+    # Without sorting, the first matches are the final ones, so there's no need to look further
+    stop_early: bool = mode_filter.sort is None and mode_filter.limit is not None
+
+    for mode in modes:
+        if mode in seen:
+            continue
+
+        seen.add(mode)
+
+        if all(predicate(mode) for predicate in predicates):
+            matches.append(mode)
+
+            if stop_early and len(matches) >= mode_filter.limit:  # type: ignore[reportOperatorIssue]
+                break
+
+    if mode_filter.sort is not None:
+        matches.sort(key=SORT_KEYS[mode_filter.sort], reverse=True)
+
+    if mode_filter.limit is not None:
+        matches = matches[: mode_filter.limit]
+
+    return matches
+
+
+class CommonMode:
+    __slots__ = ("width", "height", "refreshes")
+
+    def __init__(self, width: int, height: int, refreshes: list[int]):
+        self.width: int = width
+        self.height: int = height
+        # Refresh rate used on each monitor, in the order the monitors were given
+        self.refreshes: list[int] = refreshes
+
+    def __str__(self):
+        if self.is_exact():
+            return str(self.mode())
+
+        return f"{self.width}x{self.height} @ {'/'.join(str(r) for r in self.refreshes)}Hz"
+
+    def is_exact(self) -> bool:
+        return all(refresh == self.refreshes[0] for refresh in self.refreshes)
+
+    def mode(self) -> DisplayMode:
+        # The refresh rate every monitor reaches
+        return DisplayMode(self.width, self.height, min(self.refreshes))
+
+
+def _nearest_refresh(refreshes: set[int], target: int) -> int:
+    # Ties go to the higher refresh rate
+    return min(refreshes, key=lambda refresh: (abs(refresh - target), -refresh))
+
+
+def common_display_modes(
+    mode_tables: Iterable[Iterable[DisplayMode]],
+    nearest: bool = False,
+    mode_filter: ModeFilter | None = None,
+) -> list[CommonMode]:
+    # Refresh rates by resolution, one set per table. Every mode is looked at once: resolutions
+    # that the first table lacks, or that an earlier table lacked, are dropped as soon as they are
+    # seen, so the index never grows beyond the first table.
+    resolutions: dict[tuple[int, int], list[set[int]]] = {}
+    number_of_tables: int = 0
+
+    for index, modes in enumerate(mode_tables):
+        number_of_tables += 1
+
+        for mode in modes:
+            refreshes: list[set[int]] | None = resolutions.get((mode.width, mode.height))
+
+            if refreshes is None:
+                if index > 0:
+                    continue
+
+                refreshes = resolutions[(mode.width, mode.height)] = []
+
+            if len(refreshes) == index:
+                refreshes.append(set())
+            elif len(refreshes) < index:
+                continue
+
+            refreshes[index].add(mode.refresh)
+
+    common: list[CommonMode] = []
+
+    for (width, height), refreshes in resolutions.items():
+        if len(refreshes) != number_of_tables:
+            continue
+
+        exact: set[int] = set.intersection(*refreshes)
+        common.extend(CommonMode(width, height, [r] * number_of_tables) for r in exact)
+
+        if not nearest:
+            continue
+
+        # For every other refresh rate any monitor offers, each monitor's closest one
+        seen: set[tuple[int, ...]] = set()
+
+        for target in sorted(set.union(*refreshes) - exact):
+            matched = tuple(_nearest_refresh(rates, target) for rates in refreshes)
+
+            if matched not in seen and len(set(matched)) > 1:
+                seen.add(matched)
+                common.append(CommonMode(width, height, list(matched)))
+
+    if mode_filter is None:
+        mode_filter = ModeFilter()
+
+    predicates = mode_filter.predicates()
+    sort_key = SORT_KEYS[mode_filter.sort if mode_filter.sort is not None else "resolution"]
+
+    common = [c for c in common if all(predicate(c.mode()) for predicate in predicates)]
+    common.sort(key=lambda c: (sort_key(c.mode()), c.is_exact(), max(c.refreshes)), reverse=True)
+
+    if mode_filter.limit is not None:
+        common = common[: mode_filter.limit]
+
+    return common
+
+
+class ModeGroup:
+    __slots__ = ("width", "height", "modes")
+
+    def __init__(self, width: int, height: int, modes: list[DisplayMode]):
+        self.width: int = width
+        self.height: int = height
+        # Modes of this resolution, from the lowest refresh rate up
+        self.modes: list[DisplayMode] = modes
+
+    def __str__(self):
+        refreshes: list[str] = [
+            f"{m.refresh_rate:.2f}"
+            if m.refresh_rate is not None and round(m.refresh_rate, 2) != m.refresh
+            else str(m.refresh)
+            for m in self.modes
+        ]
+
+        return f"{self.width}x{self.height}: {', '.join(refreshes)} Hz"
+
+    def max_refresh(self) -> int:
+        return self.modes[-1].refresh
+
+
+def group_display_modes(modes: Iterable[DisplayMode], sort: str | None = None) -> list[ModeGroup]:
+    # One sort puts every resolution's modes next to each other, in refresh order, so a single pass
+    # builds the groups. Without a sort key, resolutions are listed from the lowest up.
+    ordered: list[DisplayMode] = sorted(
+        set(modes), key=lambda m: (m.width * m.height, m.width, m.height, m.refresh)
+    )
+    groups: list[ModeGroup] = []
+
+    for mode in ordered:
+        if len(groups) > 0 and groups[-1].width == mode.width and groups[-1].height == mode.height:
+            groups[-1].modes.append(mode)
+        else:
+            groups.append(ModeGroup(mode.width, mode.height, [mode]))
+
+    if sort == "resolution":
+        groups.reverse()
+    elif sort == "refresh":
+        # Stable, so groups with the same highest refresh rate stay largest first
+        groups.reverse()
+        groups.sort(key=ModeGroup.max_refresh, reverse=True)
+
+    return groups
@@ -0,0 +1,233 @@
+"""Recording of the Win32 calls made through windows_types, and replaying them on any platform."""
+
+from __future__ import annotations
+
+import json
+from collections import deque
+from ctypes import Array, Structure, _SimpleCData, addressof, memmove, sizeof, string_at
+from time import perf_counter, sleep
+from typing import Callable, Mapping
+
+from resolution_switcher.windows_types import (
+    DISPLAYCONFIG_DEVICE_INFO_HEADER,
+    ERROR_INSUFFICIENT_BUFFER,
+    get_backend,
+    install_backend,
+)
+
+SizeOf = Callable[[tuple], int]
+
+
+def buffer_target(argument: object) -> Structure | Array | _SimpleCData | None:
+    # Buffers are passed either directly or through byref(), which keeps the object in _obj
+    if isinstance(argument, (Structure, Array, _SimpleCData)):
+        return argument
+
+    return getattr(argument, "_obj", None)
+
+
+def _size_of(index: int) -> SizeOf:
+    def size(arguments: tuple) -> int:
+        target = buffer_target(arguments[index])
+        return 0 if target is None else sizeof(target)
+
+    return size
+
+
+def _header_size(index: int) -> SizeOf:
+    # DISPLAYCONFIG_* requests are passed by their header, which holds the size of the whole request
+    def size(arguments: tuple) -> int:
+        header = buffer_target(arguments[index])
+        return header.size if isinstance(header, DISPLAYCONFIG_DEVICE_INFO_HEADER) else 0
+
+    return size
+
+
+def _array_size(count_index: int, index: int) -> SizeOf:
+    # Arrays are passed by their first element, with the number of elements in another argument
+    def size(arguments: tuple) -> int:
+        count = arguments[count_index]
+        element = buffer_target(arguments[index])
+
+        if not isinstance(count, int):
+            count = buffer_target(count)
+            count = count.value if isinstance(count, _SimpleCData) else None
+
+        if count is None or element is None:
+            return 0
+
+        return count * sizeof(element)
+
+    return size
+
+
+class CallSpec:
+    def __init__(
+        self,
+        inputs: list[tuple[int, SizeOf]] | None = None,
+        outputs: list[tuple[int, SizeOf]] | None = None,
+    ):
+        # Buffers whose contents determine the result of the call
+        self.inputs: list[tuple[int, SizeOf]] = inputs or []
+        # Buffers the call fills in
+        self.outputs: list[tuple[int, SizeOf]] = outputs or []
+
+
+CALL_SPECS: dict[str, CallSpec] = {
+    "ChangeDisplaySettingsExW": CallSpec(inputs=[(1, _size_of(1))]),
+    "EnumDisplaySettingsW": CallSpec(outputs=[(2, _size_of(2))]),
+    "EnumDisplayDevicesW": CallSpec(outputs=[(2, _size_of(2))]),
+    "DisplayConfigGetDeviceInfo": CallSpec(
+        inputs=[(0, lambda _: sizeof(DISPLAYCONFIG_DEVICE_INFO_HEADER))],
+        outputs=[(0, _header_size(0))],
+    ),
+    "DisplayConfigSetDeviceInfo": CallSpec(inputs=[(0, _header_size(0))]),
+    "GetDisplayConfigBufferSizes": CallSpec(outputs=[(1, _size_of(1)), (2, _size_of(2))]),
+    "QueryDisplayConfig": CallSpec(
+        outputs=[
+            (1, _size_of(1)),
+            (2, _array_size(1, 2)),
+            (3, _size_of(3)),
+            (4, _array_size(3, 4)),
+        ]
+    ),
+    "SetDisplayConfig": CallSpec(inputs=[(1, _array_size(0, 1)), (3, _array_size(2, 3))]),
+    "WcsGetCalibrationManagementState": CallSpec(outputs=[(0, _size_of(0))]),
+}
+
+
+def _read_buffer(argument: object, size: int) -> str:
+    target = buffer_target(argument)
+
+    if target is None:
+        return ""
+
+    return string_at(addressof(target), size).hex()
+
+
+def _call_key(name: str, arguments: tuple) -> str:
+    spec: CallSpec = CALL_SPECS.get(name, CallSpec())
+    inputs: dict[int, SizeOf] = dict(spec.inputs)
+    key: list = [name]
+
+    for index, argument in enumerate(arguments):
+        if index in inputs:
+            key.append(_read_buffer(argument, inputs[index](arguments)))
+        elif argument is None or isinstance(argument, (int, str)):
+            key.append(argument)
+        elif buffer_target(argument) is not None:
+            # Output buffers do not identify the call
+            key.append("<buffer>")
+        else:
+            key.append(str(argument))
+
+    return json.dumps(key)
+
+
+class CallRecorder:
+    def __init__(self, path: str, backend: Mapping[str, Callable[..., int]]):
+        self.path: str = path
+        self.backend: dict[str, Callable[..., int]] = dict(backend)
+        # Every call is written as soon as it returns, so a crash still leaves a usable recording
+        self.file = open(path, "w", encoding="utf-8")
+        # Backend to go back to once recording stops
+        self.previous_backend: dict[str, Callable[..., int]] | None = None
+
+    def _record(self, name: str, function: Callable[..., int]) -> Callable[..., int]:
+        def recorded_call(*arguments) -> int:
+            key: str = _call_key(name, arguments)
+            start: float = perf_counter()
+
+            result: int = function(*arguments)
+
+            elapsed: float = perf_counter() - start
+            outputs: list[tuple[int, str]] = [
+                (index, _read_buffer(arguments[index], size(arguments)))
+                for index, size in CALL_SPECS.get(name, CallSpec()).outputs
+            ]
+
+            self.file.write(
+                json.dumps({"key": key, "result": result, "elapsed": elapsed, "outputs": outputs})
+                + "\n"
+            )
+            self.file.flush()
+
+            return result
+
+        return recorded_call
+
+    def functions(self) -> dict[str, Callable[..., int]]:
+        return {name: self._record(name, function) for name, function in self.backend.items()}
+
+    def close(self):
+        if self.previous_backend is not None:
+            install_backend(self.previous_backend)
+            self.previous_backend = None
+
+        self.file.close()
+
+
+class CallReplayer:
+    def __init__(self, path: str, with_timing: bool = False):
+        # Recorded calls, in order, for every distinct function and set of inputs
+        self.calls: dict[str, deque[dict]] = {}
+        # Whether to take as long as the recorded calls did
+        self.with_timing: bool = with_timing
+
+        with open(path, encoding="utf-8") as recording:
+            for line in recording:
+                if line.strip() == "":
+                    continue
+
+                call: dict = json.loads(line)
+                self.calls.setdefault(call["key"], deque()).append(call)
+
+    def _replay(self, name: str) -> Callable[..., int]:
+        def replayed_call(*arguments) -> int:
+            key: str = _call_key(name, arguments)
+            calls = self.calls.get(key)
+
+            if calls is None:
+                raise OSError(f"No recorded call to {name} matches {key}")
+
+            # Repeated calls are served in recorded order, and the last one keeps being served
+            call: dict = calls.popleft() if len(calls) > 1 else calls[0]
+            spec: CallSpec = CALL_SPECS.get(name, CallSpec())
+
+            capacities: dict[int, int] = {index: size(arguments) for index, size in spec.outputs}
+
+            for index, data in call["outputs"]:
+                if len(bytes.fromhex(data)) > capacities.get(index, 0):
+                    return ERROR_INSUFFICIENT_BUFFER
+
+            for index, data in call["outputs"]:
+                target = buffer_target(arguments[index])
+                contents: bytes = bytes.fromhex(data)
+
+                if target is not None:
+                    memmove(addressof(target), contents, len(contents))
+
+            if self.with_timing:
+                sleep(call["elapsed"])
+
+            return call["result"]
+
+        return replayed_call
+
+    def functions(self) -> dict[str, Callable[..., int]]:
+        names: set[str] = {json.loads(key)[0] for key in self.calls} | set(CALL_SPECS)
+        return {name: self._replay(name) for name in names}
+
+
+def start_recording(path: str) -> CallRecorder:
+    recorder = CallRecorder(path, get_backend())
+    recorder.previous_backend = install_backend(recorder.functions())
+
+    return recorder
+
+
+def start_replaying(path: str, with_timing: bool = False) -> CallReplayer:
+    replayer = CallReplayer(path, with_timing)
+    install_backend(replayer.functions())
+
+    return replayer
@@ -0,0 +1,92 @@
+"""Retrying of Win32 calls whose result codes are known to be transient."""
+
+from __future__ import annotations
+
+from random import uniform
+from time import perf_counter, sleep
+from typing import Callable, TypeVar
+
+from resolution_switcher.windows_types import (
+    DISP_CHANGE_FAILED,
+    ERROR_GEN_FAILURE,
+    ERROR_INSUFFICIENT_BUFFER,
+)
+
+# The driver briefly rejects mode changes while a session or a headless display is still coming up
+TRANSIENT_DISP_CHANGE_RESULTS: frozenset[int] = frozenset({DISP_CHANGE_FAILED})
+
+# The topology can change between sizing the buffers and querying the display config
+TRANSIENT_DISPLAY_CONFIG_RESULTS: frozenset[int] = frozenset(
+    {ERROR_GEN_FAILURE, ERROR_INSUFFICIENT_BUFFER}
+)
+
+T = TypeVar("T")
+
+
+class RetryRecord:
+    def __init__(self, operation: str, attempts: int, elapsed: float, gave_up: bool):
+        self.operation: str = operation
+        self.attempts: int = attempts
+        self.elapsed: float = elapsed
+        # Whether the last attempt still failed with a transient result
+        self.gave_up: bool = gave_up
+
+    def __str__(self):
+        message: str = (
+            f"{self.operation} took {self.attempts} attempt(s) in {self.elapsed * 1000:.0f} ms"
+        )
+        return message + " (gave up on transient failures)" if self.gave_up else message
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 0.1,
+        max_delay: float = 2.0,
+        jitter: float = 0.2,
+        deadline: float = 10.0,
+    ):
+        self.max_attempts: int = max_attempts
+        # Seconds to wait after the first failed attempt, doubled after every further one
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        # Fraction of every delay that is randomized, so that concurrent callers spread out
+        self.jitter: float = jitter
+        # Seconds after which no further attempt is started
+        self.deadline: float = deadline
+        self.records: list[RetryRecord] = []
+
+    def delay_before_attempt(self, attempt: int) -> float:
+        delay: float = min(self.max_delay, self.base_delay * 2 ** (attempt - 2))
+        return max(0.0, delay * (1 + uniform(-self.jitter, self.jitter)))
+
+
+def run_with_retry(
+    operation: str,
+    attempt: Callable[[], T],
+    is_transient: Callable[[T], bool],
+    policy: RetryPolicy | None,
+) -> T:
+    if policy is None:
+        return attempt()
+
+    start: float = perf_counter()
+    attempts: int = 1
+    result: T = attempt()
+
+    while is_transient(result) and attempts < policy.max_attempts:
+        delay: float = policy.delay_before_attempt(attempts + 1)
+
+        if perf_counter() - start + delay > policy.deadline:
+            break
+
+        sleep(delay)
+        attempts += 1
+        result = attempt()
+
+    policy.records.append(
+        RetryRecord(operation, attempts, perf_counter() - start, is_transient(result))
+    )
+
+    return result
@@ -0,0 +1,265 @@
+"""Rules mapping a streaming client's requested mode to a display mode the monitor supports."""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+from hashlib import sha1
+from time import perf_counter
+from typing import Mapping
+
+from resolution_switcher.custom_types import DisplayMode, DisplayMonitor, RulesException
+from resolution_switcher.display_adapters import iter_display_modes
+from resolution_switcher.display_monitors import get_topology_fingerprint
+from resolution_switcher.mode_filters import find_first_candidate
+
+# Candidate that stands for the mode requested by the client
+CLIENT_CANDIDATE: str = "client"
+
+# Client pattern (or pattern component) that matches any value
+WILDCARD: str = "*"
+
+# Upper bound on the number of decisions kept in the cache file
+MAX_CACHED_DECISIONS: int = 256
+
+MODE_PATTERN = re.compile(
+    r"^\s*(\d+|\*)\s*x\s*(\d+|\*)\s*(?:@\s*(\d+|\*)\s*(?:hz)?)?\s*$", re.IGNORECASE
+)
+
+
+class ModeRule:
+    def __init__(
+        self,
+        name: str,
+        client: tuple[int | None, int | None, int | None],
+        candidates: list[DisplayMode | None],
+    ):
+        self.name: str = name
+        # Width, height and refresh the client must request, None meaning any value
+        self.client: tuple[int | None, int | None, int | None] = client
+        # Modes to try in order, None standing for the client's own mode
+        self.candidates: list[DisplayMode | None] = candidates
+
+    def matches(self, client_mode: DisplayMode) -> bool:
+        requested = (client_mode.width, client_mode.height, client_mode.refresh)
+
+        return all(
+            expected is None or expected == value for expected, value in zip(self.client, requested)
+        )
+
+
+class RuleSet:
+    def __init__(
+        self,
+        rules: list[ModeRule],
+        monitor_rules: dict[str, list[ModeRule]],
+        digest: str,
+    ):
+        self.rules: list[ModeRule] = rules
+        self.monitor_rules: dict[str, list[ModeRule]] = monitor_rules
+        # Hash of the rules file contents, so cached decisions are dropped when the rules change
+        self.digest: str = digest
+
+    def rules_for_monitor(self, identifier: str) -> list[ModeRule]:
+        # Per-monitor overrides are tried before the global rules
+        return self.monitor_rules.get(identifier, []) + self.rules
+
+
+class RulesDecision:
+    def __init__(
+        self,
+        rule_name: str,
+        mode: DisplayMode,
+        candidate_index: int,
+        elapsed: float,
+        cached: bool,
+    ):
+        self.rule_name: str = rule_name
+        self.mode: DisplayMode = mode
+        self.candidate_index: int = candidate_index
+        self.elapsed: float = elapsed
+        self.cached: bool = cached
+
+
+def parse_display_mode(text: str) -> DisplayMode:
+    match = MODE_PATTERN.match(text)
+
+    if match is None or WILDCARD in match.groups() or match.group(3) is None:
+        raise RulesException(f"Invalid display mode '{text}', expected <width>x<height>@<refresh>")
+
+    return DisplayMode(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+
+
+def parse_client_pattern(text: str) -> tuple[int | None, int | None, int | None]:
+    if text.strip() == WILDCARD:
+        return None, None, None
+
+    match = MODE_PATTERN.match(text)
+
+    if match is None:
+        raise RulesException(
+            f"Invalid client pattern '{text}', expected <width>x<height>@<refresh>"
+        )
+
+    width, height, refresh = (
+        None if value is None or value == WILDCARD else int(value) for value in match.groups()
+    )
+
+    return width, height, refresh
+
+
+def client_mode_from_environment(environment: Mapping[str, str] = os.environ) -> DisplayMode:
+    try:
+        return DisplayMode(
+            int(environment["SUNSHINE_CLIENT_WIDTH"]),
+            int(environment["SUNSHINE_CLIENT_HEIGHT"]),
+            int(environment["SUNSHINE_CLIENT_FPS"]),
+        )
+    except KeyError as e:
+        raise RulesException(f"Environment variable {e} is not set")
+    except ValueError as e:
+        raise RulesException(f"Invalid client mode in environment: {e}")
+
+
+def _parse_rules(entries: object, source: str) -> list[ModeRule]:
+    if not isinstance(entries, list):
+        raise RulesException(f"Rules for {source} must be a list")
+
+    rules: list[ModeRule] = []
+
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not isinstance(entry.get("modes"), list):
+            raise RulesException(f"Rule {index} for {source} must be an object with a 'modes' list")
+
+        candidates: list[DisplayMode | None] = [
+            None if candidate == CLIENT_CANDIDATE else parse_display_mode(str(candidate))
+            for candidate in entry["modes"]
+        ]
+
+        rules.append(
+            ModeRule(
+                str(entry.get("name", f"{source}#{index}")),
+                parse_client_pattern(str(entry.get("client", WILDCARD))),
+                candidates,
+            )
+        )
+
+    return rules
+
+
+def load_rules(path: str) -> RuleSet:
+    try:
+        with open(path, "rb") as rules_file:
+            contents: bytes = rules_file.read()
+
+        document = json.loads(contents)
+    except OSError as e:
+        raise RulesException(f"Failed to read rules file {path} with error {e}")
+    except ValueError as e:
+        raise RulesException(f"Failed to parse rules file {path} with error {e}")
+
+    if not isinstance(document, dict):
+        raise RulesException(f"Rules file {path} must contain a JSON object")
+
+    monitors = document.get("monitors", {})
+
+    if not isinstance(monitors, dict):
+        raise RulesException("'monitors' must map monitor identifiers to lists of rules")
+
+    return RuleSet(
+        _parse_rules(document.get("rules", []), "rules"),
+        {identifier: _parse_rules(entries, identifier) for identifier, entries in monitors.items()},
+        sha1(contents).hexdigest(),
+    )
+
+
+def _read_decision_cache(cache_path: str) -> dict[str, dict]:
+    try:
+        with open(cache_path, encoding="utf-8") as cache_file:
+            cache = json.load(cache_file)
+
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_decision_cache(cache_path: str, cache: dict[str, dict]):
+    # Keep only the most recent decisions and replace the file atomically, so that concurrent
+    # invocations never observe a partially written cache
+    entries = list(cache.items())[-MAX_CACHED_DECISIONS:]
+    temporary_path = f"{cache_path}.{os.getpid()}.tmp"
+
+    try:
+        with open(temporary_path, "w", encoding="utf-8") as cache_file:
+            json.dump(dict(entries), cache_file)
+
+        os.replace(temporary_path, cache_path)
+    except OSError:
+        # The cache only speeds up future lookups, failing to write it is not an error
+        pass
+
+
+def resolve_display_mode(
+    rule_set: RuleSet,
+    monitor: DisplayMonitor,
+    client_mode: DisplayMode,
+    all_monitors: list[DisplayMonitor],
+    cache_path: str | None = None,
+) -> RulesDecision:
+    start: float = perf_counter()
+    identifier: str = monitor.identifier()
+
+    cache_key: str = sha1(
+        f"{get_topology_fingerprint(all_monitors)}|{rule_set.digest}|{identifier}|"
+        f"{client_mode.width}x{client_mode.height}@{client_mode.refresh}".encode()
+    ).hexdigest()
+
+    cache: dict[str, dict] = _read_decision_cache(cache_path) if cache_path is not None else {}
+    cached_decision = cache.get(cache_key)
+
+    if cached_decision is not None:
+        try:
+            return RulesDecision(
+                cached_decision["rule"],
+                parse_display_mode(cached_decision["mode"]),
+                cached_decision["candidate"],
+                perf_counter() - start,
+                True,
+            )
+        except (KeyError, TypeError, RulesException):
+            # Malformed entries are simply resolved again
+            pass
+
+    # Every candidate of every matching rule, in the order they are tried
+    candidates: list[tuple[ModeRule, int, DisplayMode]] = [
+        (rule, candidate_index, client_mode if candidate is None else candidate)
+        for rule in rule_set.rules_for_monitor(identifier)
+        if rule.matches(client_mode)
+        for candidate_index, candidate in enumerate(rule.candidates)
+    ]
+
+    # Only a cache miss lists the monitor's modes, unless enumeration already did, and only until
+    # the first candidate turns up
+    found: int | None = find_first_candidate(
+        monitor.adapter.available_modes
+        if monitor.adapter.available_modes is not None
+        else iter_display_modes(identifier),
+        [mode for _, _, mode in candidates],
+    )
+
+    if found is not None:
+        rule, candidate_index, mode = candidates[found]
+
+        if cache_path is not None:
+            cache.pop(cache_key, None)
+            cache[cache_key] = {
+                "rule": rule.name,
+                "mode": f"{mode.width}x{mode.height}@{mode.refresh}",
+                "candidate": candidate_index,
+            }
+            _write_decision_cache(cache_path, cache)
+
+        return RulesDecision(rule.name, mode, candidate_index, perf_counter() - start, False)
+
+    raise RulesException(f"No rule produced a mode supported by {identifier} for {client_mode}")
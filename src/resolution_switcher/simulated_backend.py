@@ -0,0 +1,345 @@
+"""In-memory display topology that serves the Win32 calls made through windows_types."""
+
+from __future__ import annotations
+
+from ctypes import POINTER, addressof, c_ulong, cast
+from ctypes.wintypes import BOOL
+from time import perf_counter, sleep
+from typing import Callable, TypeVar
+
+from resolution_switcher.recording import buffer_target
+from resolution_switcher.windows_types import (
+    CDS_NORESET,
+    CDS_TEST,
+    DEVMODEW,
+    DISP_CHANGE_BADMODE,
+    DISP_CHANGE_BADPARAM,
+    DISP_CHANGE_SUCCESSFUL,
+    DISPLAY_DEVICE_ATTACHED_TO_DESKTOP,
+    DISPLAY_DEVICE_PRIMARY_DEVICE,
+    DISPLAY_DEVICEW,
+    DISPLAYCONFIG_ADAPTER_NAME,
+    DISPLAYCONFIG_DEVICE_INFO_HEADER,
+    DISPLAYCONFIG_DEVICE_INFO_TYPE,
+    DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO,
+    DISPLAYCONFIG_MODE_INFO,
+    DISPLAYCONFIG_MODE_INFO_TYPE,
+    DISPLAYCONFIG_PATH_ACTIVE,
+    DISPLAYCONFIG_PATH_INFO,
+    DISPLAYCONFIG_PATH_MODE_IDX_INVALID,
+    DISPLAYCONFIG_SET_ADVANCED_COLOR_STATE,
+    DISPLAYCONFIG_SOURCE_DEVICE_NAME,
+    DISPLAYCONFIG_TARGET_DEVICE_NAME,
+    DISPLAYCONFIG_VIDEO_OUTPUT_TECHNOLOGY,
+    ENUM_CURRENT_SETTINGS,
+    ERROR_INSUFFICIENT_BUFFER,
+    ERROR_INVALID_PARAMETER,
+    ERROR_SUCCESS,
+    SDC_APPLY,
+    install_backend,
+)
+
+REFRESH_RATES: list[int] = [60, 120, 144, 165, 240]
+
+# Targets are numbered apart from sources, as they are on real hardware
+TARGET_ID_OFFSET: int = 0x100
+
+ADAPTER_LUID: int = 0x1234
+
+
+T = TypeVar("T")
+
+
+def _buffer(argument: object, kind: type[T]) -> T:
+    buffer = buffer_target(argument)
+
+    if not isinstance(buffer, kind):
+        raise TypeError(f"Expected a {kind.__name__} or a reference to one, got {argument!r}")
+
+    return buffer
+
+
+class SimulatedDisplays:
+    def __init__(self, monitors: int = 2, modes: int = 20):
+        self.devices: list[str] = [f"\\\\.\\DISPLAY{index + 1}" for index in range(monitors)]
+        # Distinct 16:9 modes, every resolution at each of REFRESH_RATES
+        self.modes: list[tuple[int, int, int]] = [
+            (
+                1280 + 16 * (index // len(REFRESH_RATES)),
+                720 + 9 * (index // len(REFRESH_RATES)),
+                REFRESH_RATES[index % len(REFRESH_RATES)],
+            )
+            for index in range(modes)
+        ]
+        self.active: dict[str, tuple[int, int, int]] = {
+            device: self.modes[0] for device in self.devices
+        }
+        self.hdr_enabled: dict[str, bool] = {device: False for device in self.devices}
+        # Seconds after an HDR change before the color info reports it, like a slow display
+        self.hdr_report_delay: float = 0
+        # When the HDR state of a device last changed, and what it was before
+        self.hdr_changed: dict[str, tuple[float, bool]] = {}
+        # Friendly name of the monitor connected to each device
+        self.names: dict[str, str] = {
+            device: f"Simulated Monitor {index + 1}" for index, device in enumerate(self.devices)
+        }
+        # DISPLAYCONFIG_VIDEO_OUTPUT_TECHNOLOGY of the connector behind each device
+        self.output_technologies: dict[str, int] = {
+            device: DISPLAYCONFIG_VIDEO_OUTPUT_TECHNOLOGY.DISPLAYCONFIG_OUTPUT_TECHNOLOGY_HDMI
+            for device in self.devices
+        }
+        # Modes written with CDS_NORESET, applied by the next reset
+        self.staged: dict[str, tuple[int, int, int]] = {}
+        # Number of times the displays were reconfigured
+        self.resets: int = 0
+        # Seconds that calls to a function block for before returning, like a hung driver
+        self.delays: dict[str, float] = {}
+
+    def EnumDisplayDevicesW(self, device, index, display_device) -> int:
+        display_device = _buffer(display_device, DISPLAY_DEVICEW)
+
+        if device is not None or index >= len(self.devices):
+            return 0
+
+        display_device.DeviceName = self.devices[index]
+        display_device.DeviceString = "Simulated Display Adapter"
+        display_device.StateFlags = DISPLAY_DEVICE_ATTACHED_TO_DESKTOP | (
+            DISPLAY_DEVICE_PRIMARY_DEVICE if index == 0 else 0
+        )
+
+        return 1
+
+    def EnumDisplaySettingsW(self, device, index, devmode) -> int:
+        devmode = _buffer(devmode, DEVMODEW)
+
+        if device not in self.active:
+            return 0
+
+        if index in (ENUM_CURRENT_SETTINGS, ENUM_CURRENT_SETTINGS & 0xFFFFFFFF):
+            mode = self.active[device]
+        elif index < len(self.modes):
+            mode = self.modes[index]
+        else:
+            return 0
+
+        devmode.dmPelsWidth, devmode.dmPelsHeight, devmode.dmDisplayFrequency = mode
+
+        return 1
+
+    def ChangeDisplaySettingsExW(self, device, devmode, window, flags, parameter) -> int:
+        if device is None and devmode is None:
+            self.active.update(self.staged)
+            self.staged.clear()
+            self.resets += 1
+
+            return DISP_CHANGE_SUCCESSFUL
+
+        if device not in self.active:
+            return DISP_CHANGE_BADPARAM
+
+        devmode = _buffer(devmode, DEVMODEW)
+        mode = (devmode.dmPelsWidth, devmode.dmPelsHeight, devmode.dmDisplayFrequency)
+
+        if mode not in self.modes:
+            return DISP_CHANGE_BADMODE
+
+        if flags & CDS_TEST:
+            return DISP_CHANGE_SUCCESSFUL
+
+        if flags & CDS_NORESET:
+            self.staged[device] = mode
+            return DISP_CHANGE_SUCCESSFUL
+
+        self.active[device] = mode
+        self.resets += 1
+
+        return DISP_CHANGE_SUCCESSFUL
+
+    def GetDisplayConfigBufferSizes(self, flags, number_of_paths, number_of_modes) -> int:
+        _buffer(number_of_paths, c_ulong).value = len(self.devices)
+        _buffer(number_of_modes, c_ulong).value = 2 * len(self.devices)
+
+        return ERROR_SUCCESS
+
+    def QueryDisplayConfig(
+        self, flags, number_of_paths, path_array, number_of_modes, mode_array, topology
+    ) -> int:
+        number_of_paths = _buffer(number_of_paths, c_ulong)
+        number_of_modes = _buffer(number_of_modes, c_ulong)
+
+        if number_of_paths.value < len(self.devices) or number_of_modes.value < 2 * len(
+            self.devices
+        ):
+            return ERROR_INSUFFICIENT_BUFFER
+
+        number_of_paths.value = len(self.devices)
+        number_of_modes.value = 2 * len(self.devices)
+
+        paths = cast(
+            addressof(_buffer(path_array, DISPLAYCONFIG_PATH_INFO)),
+            POINTER(DISPLAYCONFIG_PATH_INFO),
+        )
+        modes = cast(
+            addressof(_buffer(mode_array, DISPLAYCONFIG_MODE_INFO)),
+            POINTER(DISPLAYCONFIG_MODE_INFO),
+        )
+
+        for index, device in enumerate(self.devices):
+            width, height, refresh = self.active[device]
+
+            path = paths[index]
+            path.flags = DISPLAYCONFIG_PATH_ACTIVE
+            path.sourceInfo.adapterId.lowPart = ADAPTER_LUID
+            path.sourceInfo.id = index
+            path.sourceInfo.dummyUnion.modeInfoIdx = 2 * index
+            path.targetInfo.adapterId.lowPart = ADAPTER_LUID
+            path.targetInfo.id = TARGET_ID_OFFSET + index
+            path.targetInfo.dummyUnion.modeInfoIdx = 2 * index + 1
+            path.targetInfo.outputTechnology = self.output_technologies[device]
+            path.targetInfo.rational.numerator = refresh
+            path.targetInfo.rational.denominator = 1
+            path.targetInfo.targetAvailable = 1
+
+            source_mode = modes[2 * index]
+            source_mode.infoType = DISPLAYCONFIG_MODE_INFO_TYPE.DISPLAYCONFIG_MODE_INFO_TYPE_SOURCE
+            source_mode.id = index
+            source_mode.adapterId.lowPart = ADAPTER_LUID
+            source_mode.dummyUnion.sourceMode.width = width
+            source_mode.dummyUnion.sourceMode.height = height
+
+            target_mode = modes[2 * index + 1]
+            target_mode.infoType = DISPLAYCONFIG_MODE_INFO_TYPE.DISPLAYCONFIG_MODE_INFO_TYPE_TARGET
+            target_mode.id = TARGET_ID_OFFSET + index
+            target_mode.adapterId.lowPart = ADAPTER_LUID
+            signal = target_mode.dummyUnion.targetMode.targetVideoSignalInfo
+            signal.vSyncFreq.numerator = refresh * 1000
+            signal.vSyncFreq.denominator = 1000
+            signal.activeSize.cx = width
+            signal.activeSize.cy = height
+
+        return ERROR_SUCCESS
+
+    def _device_of(self, header) -> str | None:
+        index: int = header.id - TARGET_ID_OFFSET if header.id >= TARGET_ID_OFFSET else header.id
+
+        return self.devices[index] if 0 <= index < len(self.devices) else None
+
+    def DisplayConfigGetDeviceInfo(self, header) -> int:
+        header = _buffer(header, DISPLAYCONFIG_DEVICE_INFO_HEADER)
+        device: str | None = self._device_of(header)
+        address: int = addressof(header)
+
+        if device is None:
+            return ERROR_INVALID_PARAMETER
+
+        if header.type == DISPLAYCONFIG_DEVICE_INFO_TYPE.DISPLAYCONFIG_DEVICE_INFO_GET_SOURCE_NAME:
+            DISPLAYCONFIG_SOURCE_DEVICE_NAME.from_address(address).viewGdiDeviceName = device
+        elif (
+            header.type == DISPLAYCONFIG_DEVICE_INFO_TYPE.DISPLAYCONFIG_DEVICE_INFO_GET_TARGET_NAME
+        ):
+            DISPLAYCONFIG_TARGET_DEVICE_NAME.from_address(
+                address
+            ).monitorFriendlyDeviceName = self.names[device]
+        elif (
+            header.type == DISPLAYCONFIG_DEVICE_INFO_TYPE.DISPLAYCONFIG_DEVICE_INFO_GET_ADAPTER_NAME
+        ):
+            DISPLAYCONFIG_ADAPTER_NAME.from_address(address).adapterDevicePath = "simulated"
+        elif (
+            header.type
+            == DISPLAYCONFIG_DEVICE_INFO_TYPE.DISPLAYCONFIG_DEVICE_INFO_GET_ADVANCED_COLOR_INFO
+        ):
+            changed_at, previous = self.hdr_changed.get(device, (0.0, self.hdr_enabled[device]))
+            enabled: bool = (
+                previous
+                if perf_counter() - changed_at < self.hdr_report_delay
+                else self.hdr_enabled[device]
+            )
+
+            color_info = DISPLAYCONFIG_GET_ADVANCED_COLOR_INFO.from_address(address)
+            color_info.value = 0x1 | (0x2 if enabled else 0)
+            color_info.bitsPerColorChannel = 10 if enabled else 8
+        else:
+            return ERROR_INVALID_PARAMETER
+
+        return ERROR_SUCCESS
+
+    def DisplayConfigSetDeviceInfo(self, header) -> int:
+        header = _buffer(header, DISPLAYCONFIG_DEVICE_INFO_HEADER)
+        device: str | None = self._device_of(header)
+
+        if (
+            device is None
+            or header.type
+            != DISPLAYCONFIG_DEVICE_INFO_TYPE.DISPLAYCONFIG_DEVICE_INFO_SET_ADVANCED_COLOR_STATE
+        ):
+            return ERROR_INVALID_PARAMETER
+
+        color_state = DISPLAYCONFIG_SET_ADVANCED_COLOR_STATE.from_address(addressof(header))
+        self.hdr_changed[device] = (perf_counter(), self.hdr_enabled[device])
+        self.hdr_enabled[device] = bool(color_state.enableAdvancedColor)
+
+        return ERROR_SUCCESS
+
+    def SetDisplayConfig(self, number_of_paths, path_array, number_of_modes, mode_array, flags):
+        paths = cast(
+            addressof(_buffer(path_array, DISPLAYCONFIG_PATH_INFO)),
+            POINTER(DISPLAYCONFIG_PATH_INFO),
+        )
+        modes = cast(
+            addressof(_buffer(mode_array, DISPLAYCONFIG_MODE_INFO)),
+            POINTER(DISPLAYCONFIG_MODE_INFO),
+        )
+        configured: dict[str, tuple[int, int, int]] = {}
+
+        for index in range(number_of_paths):
+            path = paths[index]
+            device: str = self.devices[path.sourceInfo.id]
+            source_mode = modes[path.sourceInfo.dummyUnion.modeInfoIdx].dummyUnion.sourceMode
+
+            if path.targetInfo.dummyUnion.modeInfoIdx == DISPLAYCONFIG_PATH_MODE_IDX_INVALID:
+                refresh: int = path.targetInfo.rational.numerator // max(
+                    path.targetInfo.rational.denominator, 1
+                )
+            else:
+                refresh = self.active[device][2]
+
+            mode = (source_mode.width, source_mode.height, refresh)
+
+            if mode not in self.modes:
+                return ERROR_INVALID_PARAMETER
+
+            configured[device] = mode
+
+        if flags & SDC_APPLY:
+            self.active.update(configured)
+            self.resets += 1
+
+        return ERROR_SUCCESS
+
+    def WcsGetCalibrationManagementState(self, enabled) -> int:
+        _buffer(enabled, BOOL).value = 1
+        return 1
+
+    def InternalRefreshCalibration(self, first, second) -> int:
+        return 0
+
+    def _delayed(self, name: str, function: Callable[..., int]) -> Callable[..., int]:
+        def call(*args) -> int:
+            delay: float = self.delays.get(name, 0)
+
+            if delay > 0:
+                sleep(delay)
+
+            return function(*args)
+
+        return call
+
+    def functions(self) -> dict[str, Callable[..., int]]:
+        return {
+            name: self._delayed(name, getattr(self, name))
+            for name in dir(self)
+            if name[0].isupper() and callable(getattr(self, name))
+        }
+
+    def install(self) -> dict[str, Callable[..., int]]:
+        return install_backend(self.functions())
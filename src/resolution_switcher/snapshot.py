@@ -0,0 +1,221 @@
+"""Shared memory snapshot of the monitors, which other processes read without any Win32 calls.
+
+The snapshot is a fixed-size memory-mapped file guarded by a sequence counter. The writer makes the
+counter odd before changing the records and even again afterwards, and readers retry any copy that
+was taken while it was odd or changed in between.
+"""
+
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+import time
+
+from resolution_switcher.custom_types import (
+    DisplayAdapter,
+    DisplayMode,
+    DisplayMonitor,
+    SnapshotException,
+)
+from resolution_switcher.locking import LOCK_DIRECTORY, file_lock
+
+SNAPSHOT_FILE: str = os.path.join(LOCK_DIRECTORY, "monitors.snapshot")
+
+# Snapshots older than this are considered stale by default
+SNAPSHOT_MAX_AGE: float = 10.0
+
+MAX_MONITORS: int = 16
+
+MAGIC: bytes = b"RSMS"
+VERSION: int = 2
+
+# Magic, version, sequence, publish time and number of monitors
+HEADER = struct.Struct("<4sIQdI4x")
+SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET: int = 8
+
+# Identifier, monitor name, adapter name, active mode, flags, bits per color channel, color
+# encoding, target id, adapter LUID and exact refresh rate (0 if unknown)
+RECORD = struct.Struct("<64s128s128sIIIIIIIIid")
+
+SNAPSHOT_SIZE: int = HEADER.size + MAX_MONITORS * RECORD.size
+
+HAS_ACTIVE_MODE: int = 0x1
+PRIMARY: int = 0x2
+ATTACHED: int = 0x4
+HDR_SUPPORTED: int = 0x8
+HDR_ENABLED: int = 0x10
+
+NO_TARGET_ID: int = 0xFFFFFFFF
+
+
+class Snapshot:
+    def __init__(self, sequence: int, published_at: float, monitors: list[DisplayMonitor]):
+        self.sequence: int = sequence
+        # Wall clock time, comparable across processes
+        self.published_at: float = published_at
+        self.monitors: list[DisplayMonitor] = monitors
+
+    def age(self) -> float:
+        return time.time() - self.published_at
+
+
+def _encode(text: str, size: int) -> bytes:
+    encoded: bytes = text.encode("utf-8")
+
+    if len(encoded) > size:
+        raise SnapshotException(f"'{text}' does not fit in a snapshot record")
+
+    return encoded
+
+
+def _decode(field: bytes) -> str:
+    return field.rstrip(b"\0").decode("utf-8", errors="replace")
+
+
+def _pack_monitor(monitor: DisplayMonitor) -> bytes:
+    monitor.load_color_info()
+    mode: DisplayMode | None = monitor.active_mode()
+    flags: int = (
+        (HAS_ACTIVE_MODE if mode is not None else 0)
+        | (PRIMARY if monitor.is_primary() else 0)
+        | (ATTACHED if monitor.is_attached() else 0)
+        | (HDR_SUPPORTED if monitor.is_hdr_supported() else 0)
+        | (HDR_ENABLED if monitor.is_hdr_enabled() else 0)
+    )
+
+    return RECORD.pack(
+        _encode(monitor.identifier(), 64),
+        _encode(monitor.name, 128),
+        _encode(monitor.adapter.display_name, 128),
+        mode.width if mode is not None else 0,
+        mode.height if mode is not None else 0,
+        mode.refresh if mode is not None else 0,
+        flags,
+        monitor.bits_per_color_channel,
+        monitor.color_encoding,
+        monitor.target_id if monitor.target_id is not None else NO_TARGET_ID,
+        monitor.adapter_id_low,
+        monitor.adapter_id_high,
+        mode.refresh_rate if mode is not None and mode.refresh_rate is not None else 0.0,
+    )
+
+
+def _unpack_monitor(record: bytes) -> DisplayMonitor:
+    (
+        identifier,
+        name,
+        display_name,
+        width,
+        height,
+        refresh,
+        flags,
+        bits_per_color_channel,
+        color_encoding,
+        target_id,
+        adapter_id_low,
+        adapter_id_high,
+        refresh_rate,
+    ) = RECORD.unpack(record)
+
+    adapter = DisplayAdapter(
+        _decode(identifier),
+        _decode(display_name),
+        DisplayMode(width, height, refresh, refresh_rate if refresh_rate > 0 else None)
+        if flags & HAS_ACTIVE_MODE
+        else None,
+        is_attached=bool(flags & ATTACHED),
+        is_primary=bool(flags & PRIMARY),
+    )
+    monitor = DisplayMonitor(_decode(name), adapter)
+    monitor.adapter_id_low = adapter_id_low
+    monitor.adapter_id_high = adapter_id_high
+    monitor.target_id = target_id if target_id != NO_TARGET_ID else None
+    monitor.hdr_supported = bool(flags & HDR_SUPPORTED)
+    monitor.hdr_enabled = bool(flags & HDR_ENABLED)
+    monitor.bits_per_color_channel = bits_per_color_channel
+    monitor.color_encoding = color_encoding
+
+    return monitor
+
+
+def publish_snapshot(monitors: list[DisplayMonitor], path: str = SNAPSHOT_FILE):
+    if len(monitors) > MAX_MONITORS:
+        raise SnapshotException(f"A snapshot holds at most {MAX_MONITORS} monitors")
+
+    # Encoded up front, so that a monitor that does not fit leaves the snapshot untouched
+    records: bytes = b"".join(_pack_monitor(monitor) for monitor in monitors)
+
+    # Readers never lock, only concurrent writers exclude each other
+    with file_lock(f"{path}.lock"):
+        with open(path, "a+b") as file:
+            # The size never changes once created, as readers may have the file mapped
+            if os.fstat(file.fileno()).st_size < SNAPSHOT_SIZE:
+                file.truncate(SNAPSHOT_SIZE)
+
+            with mmap.mmap(file.fileno(), SNAPSHOT_SIZE) as mapping:
+                (sequence,) = SEQUENCE.unpack_from(mapping, SEQUENCE_OFFSET)
+
+                # A writer that died halfway left the sequence odd
+                sequence += 1 if sequence % 2 == 0 else 0
+                SEQUENCE.pack_into(mapping, SEQUENCE_OFFSET, sequence)
+
+                HEADER.pack_into(mapping, 0, MAGIC, VERSION, sequence, time.time(), len(monitors))
+                mapping[HEADER.size : HEADER.size + len(records)] = records
+
+                SEQUENCE.pack_into(mapping, SEQUENCE_OFFSET, sequence + 1)
+
+
+def _read_consistent(mapping: mmap.mmap, attempts: int) -> bytes | None:
+    for _ in range(attempts):
+        (before,) = SEQUENCE.unpack_from(mapping, SEQUENCE_OFFSET)
+
+        if before % 2 == 0:
+            data: bytes = mapping[:SNAPSHOT_SIZE]
+            (after,) = SEQUENCE.unpack_from(mapping, SEQUENCE_OFFSET)
+
+            if before == after:
+                return data
+
+        # Yields to the writer, which only holds the sequence odd for a few microseconds
+        time.sleep(0)
+
+    return None
+
+
+def read_snapshot(
+    path: str = SNAPSHOT_FILE, max_age: float | None = SNAPSHOT_MAX_AGE, attempts: int = 100
+) -> Snapshot | None:
+    # None whenever the snapshot cannot be trusted, so that callers fall back to enumerating
+    try:
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size < SNAPSHOT_SIZE:
+                return None
+
+            with mmap.mmap(file.fileno(), SNAPSHOT_SIZE, access=mmap.ACCESS_READ) as mapping:
+                data: bytes | None = _read_consistent(mapping, attempts)
+    except OSError:
+        return None
+
+    if data is None:
+        return None
+
+    magic, version, sequence, published_at, count = HEADER.unpack_from(data)
+
+    if magic != MAGIC or version != VERSION or sequence == 0 or count > MAX_MONITORS:
+        return None
+
+    snapshot = Snapshot(
+        sequence,
+        published_at,
+        [
+            _unpack_monitor(data[offset : offset + RECORD.size])
+            for offset in range(HEADER.size, HEADER.size + count * RECORD.size, RECORD.size)
+        ],
+    )
+
+    if max_age is not None and not 0 <= snapshot.age() <= max_age:
+        return None
+
+    return snapshot
@@ -0,0 +1,200 @@
+"""Sunshine "do" and "undo" hooks, which change a monitor for a stream and put it back afterwards."""
+
+from __future__ import annotations
+
+import json
+import os
+from typing import Mapping
+
+from resolution_switcher.custom_types import (
+    DisplayMode,
+    DisplayMonitor,
+    DisplayMonitorException,
+    RulesException,
+    SunshineException,
+)
+from resolution_switcher.display_adapters import set_display_mode_for_device
+from resolution_switcher.display_monitors import HDR_SETTLE_SECONDS, set_hdr_state_for_monitor
+from resolution_switcher.locking import LOCK_DIRECTORY, file_lock, make_directory
+from resolution_switcher.retry import RetryPolicy
+from resolution_switcher.rules import parse_display_mode
+
+# Where "do" leaves what it changed, for "undo" to put back
+STATE_FILE: str = os.path.join(LOCK_DIRECTORY, "sunshine-state.json")
+
+
+class SunshineState:
+    def __init__(
+        self,
+        monitor: str,
+        mode: DisplayMode | None = None,
+        hdr: bool | None = None,
+        temp: bool = False,
+    ):
+        self.monitor: str = monitor
+        # What the monitor was set to before the stream, None for whatever was not changed
+        self.mode: DisplayMode | None = mode
+        self.hdr: bool | None = hdr
+        # Whether the mode was changed without persisting it, which undo does the same way
+        self.temp: bool = temp
+
+    def to_dict(self) -> dict:
+        mode: DisplayMode | None = self.mode
+
+        return {
+            "monitor": self.monitor,
+            "mode": f"{mode.width}x{mode.height}@{mode.refresh}" if mode is not None else None,
+            "hdr": self.hdr,
+            "temp": self.temp,
+        }
+
+    @staticmethod
+    def from_dict(entries: dict) -> SunshineState:
+        mode = entries.get("mode")
+        hdr = entries.get("hdr")
+
+        if not isinstance(entries.get("monitor"), str) or not isinstance(hdr, (bool, type(None))):
+            raise SunshineException("Invalid Sunshine state")
+
+        try:
+            display_mode: DisplayMode | None = (
+                parse_display_mode(mode) if isinstance(mode, str) else None
+            )
+        except RulesException as e:
+            raise SunshineException(f"Invalid Sunshine state: {e}")
+
+        return SunshineState(
+            entries["monitor"], display_mode, hdr, bool(entries.get("temp", False))
+        )
+
+
+def client_hdr_from_environment(environment: Mapping[str, str] = os.environ) -> bool | None:
+    hdr: str | None = environment.get("SUNSHINE_CLIENT_HDR")
+
+    if hdr is None or hdr.strip() == "":
+        return None
+
+    if hdr.strip().lower() not in ("true", "false"):
+        raise SunshineException(f"Invalid SUNSHINE_CLIENT_HDR value '{hdr}'")
+
+    return hdr.strip().lower() == "true"
+
+
+def load_state(path: str = STATE_FILE) -> SunshineState | None:
+    try:
+        with open(path, encoding="utf-8") as state_file:
+            entries = json.load(state_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        raise SunshineException(f"Failed to read Sunshine state from {path}: {e}")
+
+    if not isinstance(entries, dict):
+        raise SunshineException(f"Invalid Sunshine state in {path}")
+
+    return SunshineState.from_dict(entries)
+
+
+def save_state(state: SunshineState, path: str = STATE_FILE):
+    directory: str = os.path.dirname(path)
+
+    if directory != "":
+        make_directory(directory)
+
+    temporary_path: str = f"{path}.{os.getpid()}.tmp"
+
+    with open(temporary_path, "w", encoding="utf-8") as state_file:
+        json.dump(state.to_dict(), state_file)
+
+    os.replace(temporary_path, path)
+
+
+def clear_state(path: str = STATE_FILE):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def start_session(
+    monitor: DisplayMonitor,
+    display_mode: DisplayMode | None,
+    hdr: bool | None,
+    path: str = STATE_FILE,
+    temp: bool = False,
+    retry_policy: RetryPolicy | None = None,
+    settle_seconds: float = HDR_SETTLE_SECONDS,
+) -> SunshineState:
+    with file_lock(f"{path}.lock"):
+        state: SunshineState | None = load_state(path)
+
+        # Replacing the state of another monitor would lose what undo has to put back on it
+        if (
+            state is not None
+            and state.monitor != monitor.identifier()
+            and (state.mode is not None or state.hdr is not None)
+        ):
+            raise SunshineException(
+                f"A session changed {state.monitor} and was not undone, run sunshine-undo "
+                f"before changing {monitor.identifier()}"
+            )
+
+        # A client that reconnects before undo ran must not replace what the monitor was set to
+        # before the first stream
+        if state is None or state.monitor != monitor.identifier():
+            state = SunshineState(monitor.identifier(), temp=temp)
+
+        active_mode: DisplayMode | None = monitor.active_mode()
+
+        # The previous settings are saved before every change, so that undo can still put them
+        # back if the change fails halfway
+        if display_mode is not None and display_mode != active_mode:
+            if state.mode is None:
+                state.mode = active_mode
+                state.temp = temp
+                save_state(state, path)
+
+            set_display_mode_for_device(display_mode, monitor.identifier(), temp, retry_policy)
+            monitor.adapter.active_mode = display_mode
+
+        if hdr is not None and monitor.is_hdr_supported() and hdr != monitor.is_hdr_enabled():
+            if state.hdr is None:
+                state.hdr = monitor.is_hdr_enabled()
+                save_state(state, path)
+
+            set_hdr_state_for_monitor(hdr, monitor, settle_seconds)
+
+        return state
+
+
+def end_session(
+    monitors: list[DisplayMonitor],
+    path: str = STATE_FILE,
+    retry_policy: RetryPolicy | None = None,
+    settle_seconds: float = HDR_SETTLE_SECONDS,
+) -> SunshineState | None:
+    with file_lock(f"{path}.lock"):
+        state: SunshineState | None = load_state(path)
+
+        if state is None:
+            return None
+
+        monitor: DisplayMonitor | None = next(
+            (m for m in monitors if m.identifier() == state.monitor), None
+        )
+
+        if monitor is None:
+            raise DisplayMonitorException(f"Device {state.monitor} not found")
+
+        # Undone in the reverse order of do, as some displays only support HDR in certain modes
+        if state.hdr is not None and monitor.is_hdr_supported():
+            if monitor.is_hdr_enabled() != state.hdr:
+                set_hdr_state_for_monitor(state.hdr, monitor, settle_seconds)
+
+        if state.mode is not None and monitor.active_mode() != state.mode:
+            set_display_mode_for_device(state.mode, monitor.identifier(), state.temp, retry_policy)
+            monitor.adapter.active_mode = state.mode
+
+        clear_state(path)
+
+        return state
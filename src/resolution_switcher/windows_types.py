@@ -1,4 +1,5 @@
-from ctypes import POINTER, Structure, Union, WinDLL, c_uint16, c_uint32, c_uint64
+from collections import Counter
+from ctypes import POINTER, Structure, Union, c_uint16, c_uint32, c_uint64
 from ctypes.wintypes import (
     BOOL,
     DWORD,
@@ -12,6 +13,13 @@ from ctypes.wintypes import (
     WCHAR,
 )
 from enum import IntEnum
+from typing import Callable, Mapping
+
+try:
+    from ctypes import WinDLL
+except ImportError:
+    # Not available outside of Windows, where calls can only be served by a replay backend
+    WinDLL = None
 
 CCHDEVICENAME: int = 32
 
@@ -22,12 +30,21 @@ ERROR_NOT_SUPPORTED = 50
 ERROR_ACCESS_DENIED = 5
 ERROR_GEN_FAILURE = 31
 ERROR_INSUFFICIENT_BUFFER = 122
+ERROR_BAD_CONFIGURATION = 1610
 
 # https://learn.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-querydisplayconfig
 QDC_ONLY_ACTIVE_PATHS = 0x00000002
 
 # https://learn.microsoft.com/en-us/windows/win32/api/wingdi/ns-wingdi-displayconfig_path_info
 DISPLAYCONFIG_PATH_ACTIVE = 0x00000001
+DISPLAYCONFIG_PATH_MODE_IDX_INVALID = 0xFFFFFFFF
+
+# https://learn.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-setdisplayconfig
+SDC_VALIDATE = 0x00000040
+SDC_APPLY = 0x00000080
+SDC_SAVE_TO_DATABASE = 0x00000200
+SDC_ALLOW_CHANGES = 0x00000400
+SDC_USE_SUPPLIED_DISPLAY_CONFIG = 0x00000020
 
 # https://learn.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-enumdisplaysettingsw
 ENUM_CURRENT_SETTINGS = -1
@@ -47,6 +64,11 @@ DISPLAY_DEVICE_PRIMARY_DEVICE = 4
 # The graphics mode for the current screen will be changed dynamically and the graphics mode will be updated in the registry.
 # The mode information is stored in the USER profile.
 CDS_UPDATEREGISTRY = 0x00000001
+# The settings are written to the registry but only take effect with the next call to
+# ChangeDisplaySettingsExW, which lets changes to several devices be applied in a single reset
+CDS_NORESET = 0x10000000
+# The mode is only checked against what the graphics hardware supports, nothing is changed
+CDS_TEST = 0x00000002
 DISP_CHANGE_SUCCESSFUL = 0
 DISP_CHANGE_RESTART = 1
 DISP_CHANGE_FAILED = -1
@@ -394,57 +416,149 @@ class DISPLAYCONFIG_SET_ADVANCED_COLOR_STATE(Structure):
     ]
 
 
-# Imported API functions
-user32DLL = WinDLL("user32")
-mscmsDLL = WinDLL("mscms")
+# Number of calls made through each of the API functions below since the process started
+win32_call_counts: Counter[str] = Counter()
+
+# The functions API calls are dispatched to, by name. These are the real Win32 functions unless a
+# different backend (e.g. one replaying recorded calls) has been installed.
+_native_functions: dict[str, Callable[..., int]] = {}
+_backend: dict[str, Callable[..., int]] = _native_functions
+
+# Runs every call instead of the caller when installed, e.g. to abandon calls that hang
+CallRunner = Callable[[str, Callable[..., int], tuple], int]
+_call_runner: CallRunner | None = None
+
+
+class Win32Function:
+    def __init__(self, name: str):
+        self.name: str = name
+
+    def __call__(self, *args) -> int:
+        win32_call_counts[self.name] += 1
+
+        function = _backend.get(self.name)
+
+        if function is None:
+            raise OSError(f"{self.name} is not available on this platform")
+
+        if _call_runner is not None:
+            return _call_runner(self.name, function, args)
+
+        return function(*args)
+
+
+def get_backend() -> dict[str, Callable[..., int]]:
+    return _backend
+
+
+def get_native_backend() -> dict[str, Callable[..., int]]:
+    return _native_functions
+
+
+def install_backend(functions: Mapping[str, Callable[..., int]]) -> dict[str, Callable[..., int]]:
+    global _backend
+
+    previous_backend = _backend
+    _backend = dict(functions)
+
+    return previous_backend
+
+
+def install_call_runner(runner: CallRunner | None) -> CallRunner | None:
+    global _call_runner
+
+    previous_runner = _call_runner
+    _call_runner = runner
 
+    return previous_runner
+
+
+def _bind(dll_name: str, name: str, restype: type, argtypes: list[type]) -> Win32Function:
+    if WinDLL is not None:
+        function = getattr(WinDLL(dll_name), name)
+        function.restype = restype
+        function.argtypes = argtypes
+
+        _native_functions[name] = function
+
+    return Win32Function(name)
+
+
+# Imported API functions
 # https://learn.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-changedisplaysettingsexw
-ChangeDisplaySettingsExW = user32DLL.ChangeDisplaySettingsExW
-ChangeDisplaySettingsExW.restype = LONG
-ChangeDisplaySettingsExW.argtypes = [LPCWSTR, POINTER(DEVMODEW), HWND, DWORD, LPCVOID]
+ChangeDisplaySettingsExW = _bind(
+    "user32",
+    "ChangeDisplaySettingsExW",
+    LONG,
+    [LPCWSTR, POINTER(DEVMODEW), HWND, DWORD, LPCVOID],
+)
 
 # https://learn.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-enumdisplaysettingsw
-EnumDisplaySettingsW = user32DLL.EnumDisplaySettingsW
-EnumDisplaySettingsW.restype = LONG
-EnumDisplaySettingsW.argtypes = [LPCWSTR, DWORD, POINTER(DEVMODEW)]
+EnumDisplaySettingsW = _bind(
+    "user32", "EnumDisplaySettingsW", LONG, [LPCWSTR, DWORD, POINTER(DEVMODEW)]
+)
 
 # https://learn.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-enumdisplaydevicesw
-EnumDisplayDevicesW = user32DLL.EnumDisplayDevicesW
-EnumDisplayDevicesW.restype = LONG
-EnumDisplayDevicesW.argtypes = [LPCWSTR, DWORD, POINTER(DISPLAY_DEVICEW)]
+EnumDisplayDevicesW = _bind(
+    "user32", "EnumDisplayDevicesW", LONG, [LPCWSTR, DWORD, POINTER(DISPLAY_DEVICEW)]
+)
 
 # https://learn.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-displayconfiggetdeviceinfo
-DisplayConfigGetDeviceInfo = user32DLL.DisplayConfigGetDeviceInfo
-DisplayConfigGetDeviceInfo.restype = LONG
-DisplayConfigGetDeviceInfo.argtypes = [POINTER(DISPLAYCONFIG_DEVICE_INFO_HEADER)]
+DisplayConfigGetDeviceInfo = _bind(
+    "user32",
+    "DisplayConfigGetDeviceInfo",
+    LONG,
+    [POINTER(DISPLAYCONFIG_DEVICE_INFO_HEADER)],
+)
 
 # https://learn.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-displayconfigsetdeviceinfo
-DisplayConfigSetDeviceInfo = user32DLL.DisplayConfigSetDeviceInfo
-DisplayConfigSetDeviceInfo.restype = LONG
-DisplayConfigSetDeviceInfo.argtypes = [POINTER(DISPLAYCONFIG_DEVICE_INFO_HEADER)]
+DisplayConfigSetDeviceInfo = _bind(
+    "user32",
+    "DisplayConfigSetDeviceInfo",
+    LONG,
+    [POINTER(DISPLAYCONFIG_DEVICE_INFO_HEADER)],
+)
 
 # https://learn.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-getdisplayconfigbuffersizes
-GetDisplayConfigBufferSizes = user32DLL.GetDisplayConfigBufferSizes
-GetDisplayConfigBufferSizes.restype = LONG
-GetDisplayConfigBufferSizes.argtypes = [c_uint32, POINTER(c_uint32), POINTER(c_uint32)]
+GetDisplayConfigBufferSizes = _bind(
+    "user32",
+    "GetDisplayConfigBufferSizes",
+    LONG,
+    [c_uint32, POINTER(c_uint32), POINTER(c_uint32)],
+)
 
 # https://learn.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-querydisplayconfig
-QueryDisplayConfig = user32DLL.QueryDisplayConfig
-QueryDisplayConfig.restype = LONG
-QueryDisplayConfig.argtypes = [
-    c_uint32,
-    POINTER(c_uint32),
-    POINTER(DISPLAYCONFIG_PATH_INFO),
-    POINTER(c_uint32),
-    POINTER(DISPLAYCONFIG_MODE_INFO),
-    POINTER(c_uint32),
-]
+QueryDisplayConfig = _bind(
+    "user32",
+    "QueryDisplayConfig",
+    LONG,
+    [
+        c_uint32,
+        POINTER(c_uint32),
+        POINTER(DISPLAYCONFIG_PATH_INFO),
+        POINTER(c_uint32),
+        POINTER(DISPLAYCONFIG_MODE_INFO),
+        POINTER(c_uint32),
+    ],
+)
+
+# https://learn.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-setdisplayconfig
+SetDisplayConfig = _bind(
+    "user32",
+    "SetDisplayConfig",
+    LONG,
+    [
+        c_uint32,
+        POINTER(DISPLAYCONFIG_PATH_INFO),
+        c_uint32,
+        POINTER(DISPLAYCONFIG_MODE_INFO),
+        c_uint32,
+    ],
+)
 
 # https://learn.microsoft.com/en-us/windows/win32/api/icm/nf-icm-wcsgetcalibrationmanagementstate
-WcsGetCalibrationManagementState = mscmsDLL.WcsGetCalibrationManagementState
-WcsGetCalibrationManagementState.restype = BOOL
-WcsGetCalibrationManagementState.argtypes = [POINTER(BOOL)]
+WcsGetCalibrationManagementState = _bind(
+    "mscms", "WcsGetCalibrationManagementState", BOOL, [POINTER(BOOL)]
+)
 
-InternalRefreshCalibration = mscmsDLL.InternalRefreshCalibration
-InternalRefreshCalibration.restype = LONG
-InternalRefreshCalibration.argtypes = [LONG, LONG]
+InternalRefreshCalibration = _bind("mscms", "InternalRefreshCalibration", LONG, [LONG, LONG])
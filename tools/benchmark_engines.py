@@ -0,0 +1,138 @@
+"""Compares the Win32 calls and display resets of the legacy and displayconfig engines.
+
+Every monitor of a simulated topology is changed to the same mode: one device at a time and staged
+with the legacy engine, then with a single SetDisplayConfig call. The dry run of each engine is
+compared the same way. The check fails if a change leaves any monitor in another mode, if the
+displayconfig engine resets the displays more than once, or if a dry run resets them at all.
+
+    python tools/benchmark_engines.py --monitors 1 2 4 8
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+from collections import Counter
+from typing import Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from resolution_switcher.custom_types import DisplayMode  # noqa: E402
+from resolution_switcher.device_info_cache import device_info_cache  # noqa: E402
+from resolution_switcher.display_adapters import (  # noqa: E402
+    set_display_mode_for_device,
+    set_display_modes_for_devices,
+    test_display_mode_for_device,
+)
+from resolution_switcher.display_config import (  # noqa: E402
+    set_display_modes_with_display_config,
+    validate_display_modes_with_display_config,
+)
+from resolution_switcher.simulated_backend import SimulatedDisplays  # noqa: E402
+from resolution_switcher.windows_types import win32_call_counts  # noqa: E402
+
+Changes = list[tuple[DisplayMode, str]]
+
+
+def _per_device(changes: Changes):
+    for display_mode, device_identifier in changes:
+        set_display_mode_for_device(display_mode, device_identifier)
+
+
+def _test_per_device(changes: Changes):
+    for display_mode, device_identifier in changes:
+        test_display_mode_for_device(display_mode, device_identifier)
+
+
+# Name, whether it changes the mode, and the most resets it may take for any number of monitors
+ENGINES: list[tuple[str, Callable[[Changes], None], bool, int | None]] = [
+    ("legacy per device", _per_device, True, None),
+    ("legacy staged", set_display_modes_for_devices, True, None),
+    ("displayconfig", set_display_modes_with_display_config, True, 1),
+    ("legacy dry run", _test_per_device, False, 0),
+    ("displayconfig dry run", validate_display_modes_with_display_config, False, 0),
+]
+
+
+def run_engine(
+    engine: Callable[[Changes], None], monitors: int, modes: int
+) -> tuple[SimulatedDisplays, tuple[int, int, int], Counter[str]]:
+    displays = SimulatedDisplays(monitors, modes)
+    displays.install()
+    # Every engine runs as if it were the first one in the process
+    device_info_cache.clear()
+
+    mode: tuple[int, int, int] = displays.modes[-1]
+    changes: Changes = [(DisplayMode(*mode), device) for device in displays.devices]
+    calls_before: Counter[str] = Counter(win32_call_counts)
+
+    engine(changes)
+
+    return displays, mode, win32_call_counts - calls_before
+
+
+def benchmark(monitor_counts: list[int], modes: int) -> list[str]:
+    failures: list[str] = []
+
+    for monitors in monitor_counts:
+        for name, engine, changes_mode, max_resets in ENGINES:
+            displays, mode, calls = run_engine(engine, monitors, modes)
+            breakdown: str = ", ".join(f"{f}={c}" for f, c in sorted(calls.items()))
+
+            print(
+                f"n={monitors:<3} {name:22} {sum(calls.values()):4} calls "
+                f"{displays.resets:3} resets  {breakdown}"
+            )
+
+            mismatched: list[str] = [
+                device
+                for device, active in displays.active.items()
+                if (active == mode) is not changes_mode
+            ]
+
+            if len(mismatched) > 0:
+                failures.append(
+                    f"{name} (n={monitors}) {'did not change' if changes_mode else 'changed'} "
+                    f"{', '.join(mismatched)}"
+                )
+
+            if max_resets is not None and displays.resets > max_resets:
+                failures.append(
+                    f"{name} (n={monitors}) reset the displays {displays.resets} times, "
+                    f"at most {max_resets} allowed"
+                )
+
+    return failures
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--monitors",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        help="Monitor counts of the simulated topologies",
+    )
+    parser.add_argument("--modes", type=int, default=20, help="Modes of every simulated monitor")
+    arguments = parser.parse_args()
+
+    if min(arguments.monitors) < 1 or arguments.modes < 2:
+        parser.error("At least one monitor and two modes are needed")
+
+    return arguments
+
+
+def main():
+    arguments = parse_arguments()
+    failures: list[str] = benchmark(arguments.monitors, arguments.modes)
+
+    for failure in failures:
+        print(f"Error: {failure}", file=sys.stderr)
+
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Checks that malformed batch operations fail on their own line instead of failing the batch.
+
+A script that mixes valid operations with malformed ones runs with --continue-on-error semantics
+against a simulated topology. Every malformed line must come back as a failed result with an error,
+every valid line must succeed, and nothing may escape run_batch as an exception.
+
+    python tools/check_batch.py
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from resolution_switcher.batch import run_batch  # noqa: E402
+from resolution_switcher.display_session import DisplaySession  # noqa: E402
+from resolution_switcher.simulated_backend import SimulatedDisplays  # noqa: E402
+
+
+def script(displays: SimulatedDisplays) -> list[tuple[str, str, bool]]:
+    # Description, line and whether the operation should succeed
+    width, height, refresh = displays.modes[-1]
+    mode: str = f"{width}x{height}@{refresh}"
+    first, second = displays.devices[0], displays.devices[1]
+
+    def verify(**fields) -> str:
+        return json.dumps({"op": "verify", "monitor": first, "mode": mode, **fields})
+
+    return [
+        ("invalid JSON", "{", False),
+        ("unknown op", json.dumps({"op": "reboot"}), False),
+        ("staged change", json.dumps({"op": "set_mode", "monitor": first, "mode": mode}), True),
+        (
+            "malformed staged change",
+            json.dumps({"op": "set_mode", "monitor": second, "mode": "bogus"}),
+            False,
+        ),
+        ("verify", verify(), True),
+        ("verify with a timeout", verify(timeout=1, interval=0.01), True),
+        ("verify with a text timeout", verify(timeout="abc"), False),
+        ("verify with a null timeout", verify(timeout=None), False),
+        ("verify with a list timeout", verify(timeout=[1]), False),
+        ("verify with a boolean timeout", verify(timeout=True), False),
+        ("verify with a negative timeout", verify(timeout=-1), False),
+        ("verify with a NaN timeout", verify().replace("}", ', "timeout": NaN}'), False),
+        ("verify with a text interval", verify(interval="fast"), False),
+        (
+            "verify with an infinite interval",
+            verify().replace("}", ', "interval": Infinity}'),
+            False,
+        ),
+        ("list", json.dumps({"op": "list"}), True),
+    ]
+
+
+def check() -> list[str]:
+    displays = SimulatedDisplays(2, 10)
+    displays.install()
+
+    operations: list[tuple[str, str, bool]] = script(displays)
+    results: list[dict] = []
+
+    try:
+        run_batch([line for _, line, _ in operations], DisplaySession(), results.append, True)
+    except Exception as e:
+        return [f"The batch failed with {type(e).__name__}: {e}"]
+
+    by_line: dict[int, dict] = {result["line"]: result for result in results}
+    failures: list[str] = []
+
+    for number, (description, _, ok) in enumerate(operations, start=1):
+        result: dict | None = by_line.get(number)
+
+        if result is None:
+            failures.append(f"{description} (line {number}) has no result")
+            continue
+
+        print(
+            f"{'ok' if result['ok'] == ok else 'FAILED':6} line {number:<3} {description:34} "
+            f"{result.get('error', 'succeeded')}"
+        )
+
+        if result["ok"] != ok:
+            failures.append(
+                f"{description} (line {number}) {'failed' if ok else 'succeeded'}: {result}"
+            )
+        elif not ok and not result.get("error"):
+            failures.append(f"{description} (line {number}) failed without an error")
+
+    return failures
+
+
+def main():
+    failures: list[str] = check()
+
+    for failure in failures:
+        print(f"Error: {failure}", file=sys.stderr)
+
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
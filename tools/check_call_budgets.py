@@ -0,0 +1,285 @@
+"""Checks that every CLI command stays within its budget of Win32 calls.
+
+Commands run against simulated topologies of different sizes, and the calls they make are compared
+with an upper bound that grows with the number of monitors (n) and modes per monitor (m). A change
+that makes a command issue calls per mode, or per monitor pair, fails the check.
+
+    python tools/check_call_budgets.py
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import tempfile
+from collections import Counter
+from typing import Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from resolution_switcher import cli  # noqa: E402
+from resolution_switcher.device_info_cache import device_info_cache  # noqa: E402
+from resolution_switcher.display_monitors import HDR_POLL_INTERVAL  # noqa: E402
+from resolution_switcher.display_session import DisplaySession  # noqa: E402
+from resolution_switcher.simulated_backend import SimulatedDisplays  # noqa: E402
+from resolution_switcher.windows_types import win32_call_counts  # noqa: E402
+
+# Monitors and modes per monitor of the simulated topologies
+TOPOLOGIES: list[tuple[int, int]] = [(1, 10), (4, 10), (4, 200), (16, 200)]
+
+Arguments = Callable[[SimulatedDisplays], list[str]]
+Budget = Callable[[int, int], int]
+SessionStep = Callable[[DisplaySession, SimulatedDisplays], object]
+
+
+def _enumeration(n: int) -> int:
+    # Adapters and their monitors, the display config, which also holds the active modes, and the
+    # source and target name of every path. Color info is only looked up for monitors whose HDR
+    # state is asked about.
+    return (n + 2) + 2 + 2 * n
+
+
+def _mode_change(displays: SimulatedDisplays) -> list[str]:
+    width, height, refresh = displays.modes[-1]
+
+    return ["--width", str(width), "--height", str(height), "--refresh", str(refresh)]
+
+
+# Settle wait of the HDR commands run against displays that never report their new state
+HDR_SLOW_SETTLE: float = 0.5
+
+
+def _hdr_reads(settle_seconds: float) -> int:
+    # Times the HDR state of a display that never reports it is read back during the settle wait
+    reads: int = 1
+    elapsed: float = 0
+    interval: float = HDR_POLL_INTERVAL
+
+    while elapsed < settle_seconds:
+        elapsed = min(elapsed + interval, settle_seconds)
+        interval *= 2
+        reads += 1
+
+    return reads
+
+
+def _slow_hdr(arguments: list[str]) -> Arguments:
+    def slow(displays: SimulatedDisplays) -> list[str]:
+        displays.hdr_report_delay = float("inf")
+        return [*arguments, "--hdr-settle", str(HDR_SLOW_SETTLE)]
+
+    return slow
+
+
+def _client_rules(displays: SimulatedDisplays) -> list[str]:
+    # A rule whose decision is not cached yet, as every topology gets a fresh rules file
+    width, height, refresh = displays.modes[-1]
+    rules_path: str = os.path.join(tempfile.mkdtemp(), "rules.json")
+
+    with open(rules_path, "w", encoding="utf-8") as rules_file:
+        json.dump(
+            {
+                "rules": [
+                    {"name": "native", "client": "*", "modes": [f"{width}x{height}@{refresh}"]}
+                ]
+            },
+            rules_file,
+        )
+
+    return ["--rules", rules_path, "--client", "1920x1080@60"]
+
+
+COMMANDS: list[tuple[str, Arguments, Budget]] = [
+    ("--monitors", lambda displays: ["--monitors"], lambda n, m: _enumeration(n) + n),
+    (
+        "--monitor ID",
+        lambda displays: ["--monitor", displays.devices[0]],
+        lambda n, m: _enumeration(n) + 1 + m + 1,
+    ),
+    (
+        "--modes --min-refresh 120",
+        lambda displays: ["--modes", "--min-refresh", "120"],
+        lambda n, m: _enumeration(n) + m + 1,
+    ),
+    (
+        "--common-modes all --nearest",
+        lambda displays: ["--common-modes", "all", "--nearest"],
+        lambda n, m: _enumeration(n) + n * (m + 1),
+    ),
+    ("mode change", _mode_change, lambda n, m: _enumeration(n) + 1),
+    ("--rules --client", _client_rules, lambda n, m: _enumeration(n) + m + 2),
+    (
+        "mode change --engine displayconfig",
+        lambda displays: _mode_change(displays) + ["--engine", "displayconfig"],
+        lambda n, m: _enumeration(n) + 3,
+    ),
+    (
+        "--wait-for-monitor ID --monitors",
+        lambda displays: ["--wait-for-monitor", displays.devices[-1], "--monitors"],
+        lambda n, m: _enumeration(n) + 2 * n,
+    ),
+    # Every switched monitor reads its HDR state back once, as simulated displays settle at once
+    (
+        "--hdr true",
+        lambda displays: ["--hdr", "true", "--hdr-settle", "0"],
+        lambda n, m: _enumeration(n) + 5,
+    ),
+    (
+        "--hdr true --monitor all",
+        lambda displays: ["--hdr", "true", "--monitor", "all", "--hdr-settle", "0"],
+        lambda n, m: _enumeration(n) + 3 * n + 2,
+    ),
+    # Displays that never report the new state are read back for the whole wait, on a backoff
+    (
+        "--hdr true never reported",
+        _slow_hdr(["--hdr", "true"]),
+        lambda n, m: _enumeration(n) + 4 + _hdr_reads(HDR_SLOW_SETTLE),
+    ),
+    (
+        "--hdr true --monitor all never reported",
+        _slow_hdr(["--hdr", "true", "--monitor", "all"]),
+        lambda n, m: _enumeration(n) + 2 * n + 2 + n * _hdr_reads(HDR_SLOW_SETTLE),
+    ),
+    ("--hdr-status", lambda displays: ["--hdr-status"], lambda n, m: _enumeration(n) + 1),
+    (
+        "--hdr-status --monitor all",
+        lambda displays: ["--hdr-status", "--monitor", "all"],
+        lambda n, m: _enumeration(n) + n,
+    ),
+]
+
+
+def _change_outside(session: DisplaySession, displays: SimulatedDisplays) -> object:
+    # As if another program changed the mode, which the session has to pick up
+    displays.active[displays.devices[-1]] = displays.modes[-1]
+
+    return session.refresh_if_changed()
+
+
+# Run in order against one long-lived session, as a batch or the snapshot server would
+SESSION_STEPS: list[tuple[str, SessionStep, Budget]] = [
+    (
+        "session refresh_if_changed unchanged",
+        lambda session, displays: session.refresh_if_changed(),
+        lambda n, m: 2,
+    ),
+    # The names are looked up again, as the modes are part of the topology they are cached for
+    ("session refresh_if_changed changed", _change_outside, lambda n, m: 2 + _enumeration(n)),
+    (
+        "session available_modes",
+        lambda session, displays: session.available_modes(session.monitors[0]),
+        lambda n, m: m + 1,
+    ),
+    (
+        "session available_modes again",
+        lambda session, displays: session.available_modes(session.monitors[0]),
+        lambda n, m: 0,
+    ),
+]
+
+
+def run_command(arguments: list[str]) -> tuple[int, Counter[str]]:
+    # Every command runs as if it were the first one in the process
+    device_info_cache.clear()
+
+    calls_before: Counter[str] = Counter(win32_call_counts)
+    status: int = 0
+
+    sys.argv = ["ResolutionSwitcher", *arguments]
+    sys.stdout.flush()
+
+    # The command's own output is not of interest here
+    stdout: int = os.dup(1)
+    devnull: int = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+
+    try:
+        cli.main()
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    finally:
+        sys.stdout.flush()
+        os.dup2(stdout, 1)
+        os.close(devnull)
+        os.close(stdout)
+
+    return status, win32_call_counts - calls_before
+
+
+def check(
+    commands: list[tuple[str, Arguments, Budget]], topologies: list[tuple[int, int]]
+) -> list[str]:
+    failures: list[str] = []
+
+    for monitors, modes in topologies:
+        for name, arguments, budget in commands:
+            displays = SimulatedDisplays(monitors, modes)
+            displays.install()
+
+            status, calls = run_command(arguments(displays))
+            total: int = sum(calls.values())
+            limit: int = budget(monitors, modes)
+            verdict: str = "ok" if status == 0 and total <= limit else "FAILED"
+
+            print(
+                f"{verdict:6} n={monitors:<3} m={modes:<4} {name:40} {total:5} calls "
+                f"(budget {limit})"
+            )
+
+            if status != 0:
+                failures.append(f"{name} (n={monitors}, m={modes}) exited with {status}")
+            elif total > limit:
+                breakdown: str = ", ".join(f"{f}={c}" for f, c in sorted(calls.items()))
+                failures.append(
+                    f"{name} (n={monitors}, m={modes}) made {total} calls, over its budget of "
+                    f"{limit}: {breakdown}"
+                )
+
+    return failures
+
+
+def check_session(
+    steps: list[tuple[str, SessionStep, Budget]], topologies: list[tuple[int, int]]
+) -> list[str]:
+    failures: list[str] = []
+
+    for monitors, modes in topologies:
+        displays = SimulatedDisplays(monitors, modes)
+        displays.install()
+        device_info_cache.clear()
+        session = DisplaySession()
+
+        for name, step, budget in steps:
+            calls_before: Counter[str] = Counter(win32_call_counts)
+            step(session, displays)
+            calls: Counter[str] = win32_call_counts - calls_before
+            total: int = sum(calls.values())
+            limit: int = budget(monitors, modes)
+
+            print(
+                f"{'ok' if total <= limit else 'FAILED':6} n={monitors:<3} m={modes:<4} {name:40} "
+                f"{total:5} calls (budget {limit})"
+            )
+
+            if total > limit:
+                breakdown: str = ", ".join(f"{f}={c}" for f, c in sorted(calls.items()))
+                failures.append(
+                    f"{name} (n={monitors}, m={modes}) made {total} calls, over its budget of "
+                    f"{limit}: {breakdown}"
+                )
+
+    return failures
+
+
+def main():
+    failures: list[str] = check(COMMANDS, TOPOLOGIES) + check_session(SESSION_STEPS, TOPOLOGIES)
+
+    for failure in failures:
+        print(f"Error: {failure}", file=sys.stderr)
+
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Checks that cached monitor names are reused while the topology stays and looked up when it changes.
+
+A simulated topology is enumerated twice without changes, which must not look up any name again.
+A different monitor is then swapped in behind the first device, coming up in a mode of its own,
+and the connector behind the second device changes, without a mode change. Both must be looked up
+again and report their new names, while the monitors that did not change keep theirs.
+
+    python tools/check_device_info_cache.py
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from resolution_switcher.device_info_cache import device_info_cache  # noqa: E402
+from resolution_switcher.display_monitors import get_all_display_monitors  # noqa: E402
+from resolution_switcher.simulated_backend import SimulatedDisplays  # noqa: E402
+from resolution_switcher.windows_types import (  # noqa: E402
+    DISPLAYCONFIG_VIDEO_OUTPUT_TECHNOLOGY,
+    win32_call_counts,
+)
+
+
+def enumerate_names(displays: SimulatedDisplays) -> tuple[dict[str, str], int]:
+    # Names of the monitors by device, and the device info lookups it took to get them
+    calls_before: Counter[str] = Counter(win32_call_counts)
+    names: dict[str, str] = {
+        monitor.identifier(): monitor.name for monitor in get_all_display_monitors(None, False)
+    }
+
+    return names, (win32_call_counts - calls_before)["DisplayConfigGetDeviceInfo"]
+
+
+def check() -> list[str]:
+    displays = SimulatedDisplays(3, 10)
+    displays.install()
+    device_info_cache.clear()
+    failures: list[str] = []
+
+    _, first_lookups = enumerate_names(displays)
+    _, unchanged_lookups = enumerate_names(displays)
+
+    print(f"first enumeration     {first_lookups} lookups")
+    print(f"unchanged topology    {unchanged_lookups} lookups")
+
+    if unchanged_lookups > 0:
+        failures.append(f"An unchanged topology looked up {unchanged_lookups} names again")
+
+    swapped, connector_changed = displays.devices[0], displays.devices[1]
+
+    def swap_monitor():
+        displays.names[swapped] = "Replacement Monitor"
+        displays.active[swapped] = displays.modes[-1]
+
+    def change_connector():
+        displays.names[connector_changed] = "Monitor Behind DisplayPort"
+        displays.output_technologies[connector_changed] = (
+            DISPLAYCONFIG_VIDEO_OUTPUT_TECHNOLOGY.DISPLAYCONFIG_OUTPUT_TECHNOLOGY_DISPLAYPORT_EXTERNAL
+        )
+
+    # One at a time, so that each change has to invalidate the cache on its own
+    for description, change, device in [
+        ("swapped monitor", swap_monitor, swapped),
+        ("changed connector", change_connector, connector_changed),
+    ]:
+        change()
+        names, lookups = enumerate_names(displays)
+
+        print(f"{description:21} {lookups} lookups, {device} named '{names.get(device)}'")
+
+        if names.get(device) != displays.names[device]:
+            failures.append(
+                f"After a {description}, {device} is still named '{names.get(device)}' instead "
+                f"of '{displays.names[device]}'"
+            )
+
+        if names.get(displays.devices[2]) != displays.names[displays.devices[2]]:
+            failures.append(f"After a {description}, {displays.devices[2]} lost its name")
+
+    return failures
+
+
+def main():
+    failures: list[str] = check()
+
+    for failure in failures:
+        print(f"Error: {failure}", file=sys.stderr)
+
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""Checks that display changes made by concurrent processes never overlap and collapse to the latest.
+
+Worker processes change modes against their own simulated topology while sharing one lock
+directory, as separate invocations on the same machine would. Every change marks itself as in
+flight with a file that only one process can create at a time, so any two changes that overlap are
+caught. A second run queues several requests for the same monitor behind one that is in flight,
+and only the most recent of them may go ahead once it is done. A third replays requests A, B and C
+for one monitor, with C done before the older two get their turn, which must not let them go ahead.
+
+    python tools/check_lock_contention.py --processes 8
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+from multiprocessing.synchronize import Event
+from time import perf_counter, sleep
+from typing import Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from resolution_switcher import locking  # noqa: E402
+from resolution_switcher.custom_types import DisplayMode, SupersededException  # noqa: E402
+from resolution_switcher.display_adapters import set_display_mode_for_device  # noqa: E402
+from resolution_switcher.simulated_backend import SimulatedDisplays  # noqa: E402
+from resolution_switcher.windows_types import install_backend  # noqa: E402
+
+IN_FLIGHT_FILE: str = "in-flight"
+
+# How long to wait for a queued request to register before giving up
+REGISTER_TIMEOUT: float = 30.0
+
+
+def install_displays(
+    directory: str, monitors: int, hold: Callable[[], None]
+) -> tuple[SimulatedDisplays, list[int]]:
+    # Changes go through the lock directory of the check instead of the machine's
+    locking.LOCK_DIRECTORY = directory
+
+    displays = SimulatedDisplays(monitors, 4)
+    functions = displays.functions()
+    change = functions["ChangeDisplaySettingsExW"]
+    overlaps: list[int] = [0]
+
+    def exclusive_change(*args) -> int:
+        marker: str = os.path.join(directory, IN_FLIGHT_FILE)
+
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            overlaps[0] += 1
+            return change(*args)
+
+        try:
+            hold()
+            return change(*args)
+        finally:
+            os.remove(marker)
+
+    functions["ChangeDisplaySettingsExW"] = exclusive_change
+    install_backend(functions)
+
+    return displays, overlaps
+
+
+def change_repeatedly(directory: str, index: int, monitors: int, changes: int, queue):
+    # Each worker has a monitor of its own, so none of its requests can be superseded
+    displays, overlaps = install_displays(directory, monitors, lambda: sleep(0.001))
+    device: str = displays.devices[index]
+    waits: list[float] = []
+    superseded: int = 0
+
+    for change in range(changes):
+        width, height, refresh = displays.modes[change % 2 + 1]
+        start: float = perf_counter()
+
+        try:
+            set_display_mode_for_device(DisplayMode(width, height, refresh), device)
+        except SupersededException:
+            superseded += 1
+
+        waits.append(perf_counter() - start)
+
+    queue.put((index, overlaps[0], superseded, waits))
+
+
+def change_once(directory: str, index: int, release: Event | None, queue):
+    # The holder blocks inside its change until released, everybody else queues behind it
+    displays, overlaps = install_displays(
+        directory, 1, (lambda: release.wait()) if release is not None else lambda: None
+    )
+    width, height, refresh = displays.modes[index % 2 + 1]
+
+    try:
+        set_display_mode_for_device(DisplayMode(width, height, refresh), displays.devices[0])
+        queue.put((index, overlaps[0], "changed"))
+    except SupersededException:
+        queue.put((index, overlaps[0], "superseded"))
+
+
+def read_requests(directory: str) -> dict:
+    try:
+        with open(os.path.join(directory, locking.REQUESTS_FILE), encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def wait_until(condition: Callable[[], bool], what: str):
+    deadline: float = perf_counter() + REGISTER_TIMEOUT
+
+    while not condition():
+        if perf_counter() > deadline:
+            raise TimeoutError(f"Timed out waiting for {what}")
+
+        sleep(0.005)
+
+
+def percentile(samples: list[float], percent: int) -> float:
+    ordered: list[float] = sorted(samples)
+
+    return ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
+
+
+def check_exclusion(context, directory: str, processes: int, changes: int) -> list[str]:
+    queue = context.Queue()
+    workers = [
+        context.Process(
+            target=change_repeatedly, args=(directory, index, processes, changes, queue)
+        )
+        for index in range(processes)
+    ]
+    start: float = perf_counter()
+
+    for worker in workers:
+        worker.start()
+
+    results = [queue.get() for _ in workers]
+    elapsed: float = perf_counter() - start
+
+    for worker in workers:
+        worker.join()
+
+    overlaps: int = sum(result[1] for result in results)
+    superseded: int = sum(result[2] for result in results)
+    waits: list[float] = [wait for result in results for wait in result[3]]
+
+    print(
+        f"exclusion    {processes} processes x {changes} changes in {elapsed:.2f} s, "
+        f"{overlaps} overlapping, {superseded} superseded, "
+        f"wait p50 {percentile(waits, 50) * 1000:.1f} ms p99 {percentile(waits, 99) * 1000:.1f} ms"
+    )
+
+    failures: list[str] = []
+
+    if overlaps > 0:
+        failures.append(f"{overlaps} changes ran while another process was changing")
+
+    if superseded > 0:
+        failures.append(f"{superseded} changes to monitors of their own were superseded")
+
+    return failures
+
+
+def check_latest_wins(context, directory: str, waiters: int) -> list[str]:
+    queue = context.Queue()
+    release = context.Event()
+    marker: str = os.path.join(directory, IN_FLIGHT_FILE)
+
+    holder = context.Process(target=change_once, args=(directory, 0, release, queue))
+    holder.start()
+    wait_until(lambda: os.path.exists(marker), "the first change to start")
+
+    # Started one at a time, so that their tickets are taken in order
+    queued = []
+
+    for index in range(1, waiters + 1):
+        counter: int = int(read_requests(directory).get("counter", 0))
+        worker = context.Process(target=change_once, args=(directory, index, None, queue))
+        worker.start()
+        queued.append(worker)
+        wait_until(
+            lambda: int(read_requests(directory).get("counter", 0)) > counter,
+            f"request {index} to queue",
+        )
+
+    release.set()
+    results = sorted(queue.get() for _ in range(waiters + 1))
+
+    for worker in [holder, *queued]:
+        worker.join()
+
+    outcomes: list[str] = [outcome for _, _, outcome in results]
+    expected: list[str] = ["changed", *["superseded"] * (waiters - 1), "changed"]
+
+    print(f"latest wins  {waiters} requests queued behind one in flight: {', '.join(outcomes)}")
+
+    failures: list[str] = []
+
+    if sum(result[1] for result in results) > 0:
+        failures.append("Queued changes overlapped")
+
+    if outcomes != expected:
+        failures.append(f"Expected {', '.join(expected)}")
+
+    return failures
+
+
+def check_interleaving(directory: str) -> list[str]:
+    # A and B have taken their tickets and wait for the change lock, while C takes its own and gets
+    # the lock first. Once C is done, A and B must find that they were superseded.
+    key: str = "mode:\\\\.\\DISPLAY1"
+    waiting: list[tuple[str, int]] = [
+        (name, locking._take_ticket(key, directory)) for name in ("A", "B")
+    ]
+    outcomes: list[str] = []
+
+    with locking.display_change_lock(key, directory):
+        outcomes.append("C changed")
+
+    for name, ticket in reversed(waiting):
+        latest: bool = locking._latest_ticket(key, ticket, directory) == ticket
+        outcomes.append(f"{name} {'changed' if latest else 'superseded'}")
+
+    print(f"interleaving tickets A < B < C, C done first: {', '.join(outcomes)}")
+
+    if outcomes != ["C changed", "B superseded", "A superseded"]:
+        return ["Requests queued before a newer one that was done went ahead"]
+
+    return []
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--processes", type=int, default=8, help="Processes changing modes at the same time"
+    )
+    parser.add_argument("--changes", type=int, default=50, help="Changes made by every process")
+    parser.add_argument(
+        "--waiters",
+        type=int,
+        default=4,
+        help="Requests for the same monitor queued behind one that is in flight",
+    )
+    arguments = parser.parse_args()
+
+    if arguments.processes < 2 or arguments.changes < 1 or arguments.waiters < 1:
+        parser.error("At least two processes, one change and one waiter are needed")
+
+    return arguments
+
+
+def main():
+    arguments = parse_arguments()
+
+    # Like separate invocations, workers share nothing but the lock directory
+    context = multiprocessing.get_context("spawn")
+    failures: list[str] = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        failures += check_exclusion(context, directory, arguments.processes, arguments.changes)
+
+    with tempfile.TemporaryDirectory() as directory:
+        failures += check_latest_wins(context, directory, arguments.waiters)
+
+    with tempfile.TemporaryDirectory() as directory:
+        failures += check_interleaving(directory)
+
+    for failure in failures:
+        print(f"Error: {failure}", file=sys.stderr)
+
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""Checks that repeated switching does not leak memory or slow down over time.
+
+Cycles of enumerate, change mode, enable and disable HDR, attempt a mode the monitor rejects and
+restore the original mode run against a simulated topology, as a process that stays resident (the
+snapshot server, or a script switching for every stream) would run them. After a warmup, the median
+latency of the last cycles is compared with that of the first ones, and resident memory with what
+it was before them. Further cycles then run under tracemalloc, which points at the lines that
+allocated whatever they left behind. The check fails if any of these grew past its threshold.
+
+    python tools/soak.py --cycles 5000
+"""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+from array import array
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from resolution_switcher.custom_types import (  # noqa: E402
+    DisplayAdapterException,
+    DisplayMode,
+    DisplayMonitor,
+)
+from resolution_switcher.display_adapters import set_display_mode_for_device  # noqa: E402
+from resolution_switcher.display_monitors import (  # noqa: E402
+    get_all_display_monitors,
+    get_primary_monitor,
+    set_hdr_state_for_monitor,
+)
+from resolution_switcher.simulated_backend import SimulatedDisplays  # noqa: E402
+
+PERCENTILES: list[int] = [50, 95, 99]
+
+TRACED_WARMUP: int = 20
+
+# A mode no simulated monitor supports, so that every cycle also goes through the error path
+REJECTED_MODE = DisplayMode(1, 1, 1)
+
+
+def resident_set_size() -> int | None:
+    # Current resident memory in bytes, or the peak where only that is available
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(
+            process, ctypes.byref(counters), counters.cb
+        ):
+            return None
+
+        return counters.WorkingSetSize
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Kilobytes everywhere but macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_cycle(displays: SimulatedDisplays):
+    monitors: list[DisplayMonitor] = get_all_display_monitors(include_modes=False)
+    monitor: DisplayMonitor = get_primary_monitor(monitors)
+    original: DisplayMode | None = monitor.active_mode()
+
+    width, height, refresh = displays.modes[-1]
+    set_display_mode_for_device(DisplayMode(width, height, refresh), monitor.identifier())
+
+    set_hdr_state_for_monitor(True, monitor, 0)
+    set_hdr_state_for_monitor(False, monitor, 0)
+
+    try:
+        set_display_mode_for_device(REJECTED_MODE, monitor.identifier())
+    except DisplayAdapterException:
+        pass
+    else:
+        raise AssertionError("The simulated backend accepted an unsupported mode")
+
+    if original is not None:
+        set_display_mode_for_device(original, monitor.identifier())
+
+
+def percentile(samples: list[float], percent: int) -> float:
+    ordered: list[float] = sorted(samples)
+
+    return ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
+
+
+def describe_latencies(name: str, samples: list[float]) -> str:
+    return f"{name:6} " + "  ".join(
+        f"p{percent} {percentile(samples, percent) * 1000:7.3f} ms" for percent in PERCENTILES
+    )
+
+
+def traced_memory(snapshot: tracemalloc.Snapshot) -> int:
+    return sum(statistic.size for statistic in snapshot.statistics("filename"))
+
+
+def take_snapshot() -> tracemalloc.Snapshot:
+    gc.collect()
+
+    return tracemalloc.take_snapshot().filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ]
+    )
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--cycles",
+        type=int,
+        default=5000,
+        help="Cycles whose latency and resident memory are measured",
+    )
+    parser.add_argument(
+        "--traced-cycles",
+        type=int,
+        default=1000,
+        help="Cycles run afterwards with tracemalloc, whose leftover allocations are measured",
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=200, help="Cycles run before measuring, to fill the caches"
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=200,
+        help="Cycles at the start and end of the run whose latencies are compared",
+    )
+    parser.add_argument("--monitors", type=int, default=4, help="Simulated monitors")
+    parser.add_argument("--modes", type=int, default=20, help="Simulated modes per monitor")
+    parser.add_argument(
+        "--max-rss-growth",
+        type=int,
+        default=4096,
+        metavar="KIB",
+        help="Resident memory the process may grow by over the measured cycles",
+    )
+    parser.add_argument(
+        "--max-traced-growth",
+        type=int,
+        default=32,
+        metavar="KIB",
+        help="Memory traced by tracemalloc that may be left over after the measured cycles",
+    )
+    parser.add_argument(
+        "--max-latency-drift",
+        type=float,
+        default=1.5,
+        metavar="RATIO",
+        help="How many times slower the median cycle of the last window may be than the first",
+    )
+    arguments = parser.parse_args()
+
+    if arguments.cycles < 2 * arguments.window or arguments.window < 1:
+        parser.error("--cycles must cover two windows of at least one cycle")
+
+    return arguments
+
+
+def main():
+    arguments = parse_arguments()
+
+    displays = SimulatedDisplays(arguments.monitors, arguments.modes)
+    displays.install()
+
+    # Allocated up front, so that recording latencies does not show up as growth
+    latencies = array("d", bytes(8 * arguments.cycles))
+
+    for _ in range(arguments.warmup):
+        run_cycle(displays)
+
+    gc.collect()
+    baseline_rss: int | None = resident_set_size()
+
+    # Latencies are measured without tracing, which makes every allocation several times slower
+    for cycle in range(arguments.cycles):
+        start: float = perf_counter()
+        run_cycle(displays)
+        latencies[cycle] = perf_counter() - start
+
+    gc.collect()
+    final_rss: int | None = resident_set_size()
+
+    tracemalloc.start()
+
+    # Allocations made before tracing started are not seen when they are freed, so a few cycles
+    # replace them first. The first snapshot compiles the filters, which would also count as growth.
+    for _ in range(TRACED_WARMUP):
+        run_cycle(displays)
+
+    take_snapshot()
+    baseline: tracemalloc.Snapshot = take_snapshot()
+
+    for _ in range(arguments.traced_cycles):
+        run_cycle(displays)
+
+    final: tracemalloc.Snapshot = take_snapshot()
+    tracemalloc.stop()
+
+    first: list[float] = list(latencies[: arguments.window])
+    last: list[float] = list(latencies[-arguments.window :])
+    drift: float = percentile(last, 50) / percentile(first, 50)
+    traced_growth: int = traced_memory(final) - traced_memory(baseline)
+
+    print(
+        f"{arguments.cycles} cycles and {arguments.traced_cycles} traced cycles after "
+        f"{arguments.warmup} warmup cycles, n={arguments.monitors} m={arguments.modes}"
+    )
+    print(describe_latencies("first", first))
+    print(describe_latencies("last", last))
+    print(f"latency drift {drift:.2f}x (limit {arguments.max_latency_drift:.2f}x)")
+    print(
+        f"traced growth {traced_growth / 1024:+.1f} KiB (limit {arguments.max_traced_growth} KiB)"
+    )
+
+    failures: list[str] = []
+
+    if baseline_rss is not None and final_rss is not None:
+        rss_growth: int = final_rss - baseline_rss
+        print(
+            f"rss growth    {rss_growth / 1024:+.1f} KiB (limit {arguments.max_rss_growth} KiB, "
+            f"{final_rss / 1024 / 1024:.1f} MiB resident)"
+        )
+
+        if rss_growth > arguments.max_rss_growth * 1024:
+            failures.append(f"Resident memory grew by {rss_growth / 1024:.1f} KiB")
+    else:
+        print("rss growth    unavailable on this platform")
+
+    if traced_growth > arguments.max_traced_growth * 1024:
+        failures.append(f"Traced memory grew by {traced_growth / 1024:.1f} KiB")
+
+        for statistic in final.compare_to(baseline, "lineno")[:10]:
+            print(f"  {statistic}", file=sys.stderr)
+
+    if drift > arguments.max_latency_drift:
+        failures.append(f"Cycles got {drift:.2f} times slower")
+
+    for failure in failures:
+        print(f"Error: {failure}", file=sys.stderr)
+
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()